@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Author, Genre, Book, BookInstance, Language
+from .models import Author, Genre, Book, BookInstance, Hold, Language
 
 # Register your models here.
 
@@ -33,10 +33,15 @@ class BookAdmin(admin.ModelAdmin):
     list_display = ('title', 'author', 'display_genre')
     inlines = [BooksInstanceInline]
 
+    def get_queryset(self, request):
+        #display_genre shows the genres of every book in the list
+        return super().get_queryset(request).select_related('author').prefetch_related('genre')
+
 # Register the Admin classes for BookInstance using the decorator
 @admin.register(BookInstance)
 class BookInstanceAdmin(admin.ModelAdmin):
     list_display = ("book", "status", 'borrower', "due_back", "id")
+    list_select_related = ('book', 'borrower')
     list_filter = ('status', 'due_back')
 
     fieldsets = (
@@ -47,3 +52,11 @@ class BookInstanceAdmin(admin.ModelAdmin):
             'fields': ('status', 'due_back', 'borrower')
         }),
     )
+
+
+@admin.register(Hold)
+class HoldAdmin(admin.ModelAdmin):
+    list_display = ('book', 'patron', 'status', 'created')
+    list_select_related = ('book', 'patron')
+    list_filter = ('status',)
+    raw_id_fields = ('book', 'patron', 'copy')
@@ -1,5 +1,8 @@
+import os
+from typing import List, Optional, Tuple
+from django.db.models import QuerySet
 from rest_framework.serializers import ModelSerializer
-from catalog.models import Author, Book, BookInstance, Genre, Language
+from catalog.models import Author, Book, BookInstance, Genre, Hold, Language
 from rest_framework import (
     generics, 
     viewsets, 
@@ -16,37 +19,196 @@ from .serializers import (
     HomePageSerializer,
     BookInstanceSerializer,
     BookSerializer,
+    ExpandableBookSerializer,
+    ValuesSerializer,
+    CheckoutSerializer,
+    RenewSerializer,
+    ReturnSerializer,
+    HoldSerializer,
+    OverdueLoanSerializer,
+)
+from .permissions import IsLibrarian, OnlyLibrarians #importing our custom permissions
+from .authentication import get_principal
+from .pagination import (
+    AuthorCursorPagination,
+    BookAvailabilityPagination,
+    BookCursorPagination,
+    BookInstanceCursorPagination,
+    CatalogCursorPagination,
+    OverdueCursorPagination,
+    NameCursorPagination,
 )
-from .permissions import IsLibrarian, OnlyLibrarians, JWT_authenticator #importing our custom permissions
 from rest_framework.response import Response
+from rest_framework.decorators import action
+from .parsers import NDJSONParser, ORJSONParser
+from .bulk import bulk_upsert_books
+from .search import search_books
+from .caching import ConditionalCacheMixin
+from .summary import catalog_summary
+from .loans import LoanError, cancel_hold, checkout, lock_stats, place_hold, renew, return_copies, return_copy
+from locallibrary.db_pool import pool_stats
 from rest_framework.request import Request
 from django.contrib.auth.models import User
-from rest_framework_simplejwt.tokens import RefreshToken
+from .custom_tokens import CachedBlacklistRefreshToken
 from rest_framework.views import  APIView
-from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework import status
+from rest_framework.exceptions import ParseError
+from django.core.exceptions import ValidationError
+from django.http import StreamingHttpResponse
+from .export import (
+    BOOK_EXPORT_FIELDS,
+    BOOKINSTANCE_EXPORT_FIELDS,
+    CONTENT_TYPES,
+    EXPORT_FORMATS,
+    book_rows,
+    bookinstance_rows,
+    export_stream,
+)
+
+
+class ValuesListMixin:
+    '''Builds the list responses of a viewset from QuerySet.values() rows with values_serializer (see ValuesSerializer)'''
+    values_serializer = None
 
+    def get_values_serializer(self) -> Optional[ValuesSerializer]:
+        '''Returns None when the list has to be built by the serializer_class'''
+        return self.values_serializer
 
+    def list(self, request: Request, *args, **kwargs) -> Response:
+        values_serializer = self.get_values_serializer()
+        if values_serializer is None:
+            return super().list(request, *args, **kwargs)
+        #The cursor of the next page is read from the ordering fields of the rows
+        ordering = [field.lstrip('-') for field in getattr(self.paginator, 'ordering', ())]
+        rows = values_serializer.values(self.filter_queryset(self.get_queryset()), extra=ordering)
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(values_serializer.to_representation(page))
+        return Response(values_serializer.to_representation(list(rows)))
 
-class BookViewSet(viewsets.ModelViewSet):
+
+class BookViewSet(ConditionalCacheMixin, ValuesListMixin, viewsets.ModelViewSet):
     """This viewset provides create, retrieve, update and delete apis for books"""
 
-    queryset = Book.objects.all()
+    #The genres are fetched for all the books of a page in one query
+    queryset = Book.objects.prefetch_related('genre')
+    #GET responses are cached until a book changes (see catalog/caching.py)
+    cache_model = 'book'
     serializer_class = BookSerializer
+    values_serializer = ValuesSerializer(BookSerializer)
+    pagination_class = BookCursorPagination
+    #Paginations the list can be ordered by with ?ordering=
+    ordering_paginations = {
+        'title': BookCursorPagination,
+        'availability': BookAvailabilityPagination,
+    }
     
     permission_classes = [
         IsLibrarian
     ]
 
-
-class AuthorViewSet(viewsets.ModelViewSet):
+    @property
+    def paginator(self):
+        '''?ordering=availability lists the books with the most available copies first'''
+        if not hasattr(self, '_paginator'):
+            ordering = self.request.query_params.get('ordering', 'title') if self.action == 'list' else 'title'
+            if ordering not in self.ordering_paginations:
+                raise ParseError({'Error_message': f'ordering must be one of {", ".join(self.ordering_paginations)}'})
+            self._paginator = self.ordering_paginations[ordering]()
+        return self._paginator
+
+    def filter_queryset(self, queryset: QuerySet) -> QuerySet:
+        '''?available=true only lists the books that have an available copy, using the copy counters of the books'''
+        queryset = super().filter_queryset(queryset)
+        if self.action == 'list' and self.request.query_params.get('available') in ('true', '1'):
+            queryset = queryset.filter(available_copies__gt=0)
+        return queryset
+
+    def get_fieldsets(self) -> Tuple[Optional[List[str]], List[str]]:
+        '''
+        Returns the fields requested with ?fields= (None for every field) and the related objects to nest
+        requested with ?expand=, both comma separated. Only GET requests can choose their fields.
+        '''
+        if not hasattr(self, '_fieldsets'):
+            fields, expand = None, []
+            if self.action in ('list', 'retrieve'):
+                all_fields = list(BookSerializer().fields)
+                if 'fields' in self.request.query_params:
+                    fields = [name for name in self.request.query_params['fields'].split(',') if name]
+                    unknown = [name for name in fields if name not in all_fields]
+                    if unknown or not fields:
+                        raise ParseError({'Error_message': f'fields must be a list of {", ".join(all_fields)}'})
+                expand = [name for name in self.request.query_params.get('expand', '').split(',') if name]
+                if any(name not in ExpandableBookSerializer.EXPANDABLE_FIELDS for name in expand):
+                    raise ParseError({'Error_message': f'expand must be a list of {", ".join(ExpandableBookSerializer.EXPANDABLE_FIELDS)}'})
+                #Fields that are not returned are not expanded
+                expand = [name for name in dict.fromkeys(expand) if fields is None or name in fields]
+            self._fieldsets = (fields, expand)
+        return self._fieldsets
+
+    def get_cache_models(self) -> List[str]:
+        #Nested objects are part of the cached representation
+        return [self.cache_model, *self.get_fieldsets()[1]]
+
+    def get_queryset(self) -> QuerySet:
+        fields, expand = self.get_fieldsets()
+        if fields is None and not expand:
+            return super().get_queryset()
+
+        #Only the columns of the requested fields (and the ones needed to paginate) are fetched
+        columns = ['id', *(field.lstrip('-') for field in getattr(self.paginator, 'ordering', ()))]
+        queryset = Book.objects.all()
+        for name in fields if fields is not None else BookSerializer().fields:
+            if name == 'genre':
+                queryset = queryset.prefetch_related('genre')
+            elif name in expand:
+                related_model = Book._meta.get_field(name).related_model
+                columns.append(name)
+                columns.extend(f'{name}__{field.attname}' for field in related_model._meta.concrete_fields)
+                queryset = queryset.select_related(name)
+            else:
+                columns.append(name)
+        return queryset.only(*dict.fromkeys(columns))
+
+    def get_values_serializer(self) -> Optional[ValuesSerializer]:
+        fields, expand = self.get_fieldsets()
+        if expand:
+            return None
+        if fields is None:
+            return self.values_serializer
+        return ValuesSerializer(BookSerializer, fields=fields)
+
+    def get_serializer(self, *args, **kwargs) -> ModelSerializer:
+        fields, expand = self.get_fieldsets()
+        if fields is None and not expand:
+            return super().get_serializer(*args, **kwargs)
+        kwargs.setdefault('context', self.get_serializer_context())
+        return ExpandableBookSerializer(*args, fields=fields, expand=expand, **kwargs)
+
+    @action(detail=False, methods=['post'], url_path='bulk', parser_classes=[ORJSONParser, NDJSONParser])
+    def bulk(self, request: Request) -> Response:
+        '''
+        Creates or updates many books and their copies in one transaction, matching existing books by ISBN.
+        Accepts a JSON array or NDJSON (one book per line) and returns a result for every book.
+        '''
+        saved, results = bulk_upsert_books(request.data)
+        return Response(
+            {'results': results},
+            status=status.HTTP_200_OK if saved else status.HTTP_400_BAD_REQUEST,
+        )
+
+
+class AuthorViewSet(ConditionalCacheMixin, ValuesListMixin, viewsets.ModelViewSet):
     queryset = Author.objects.all()
+    pagination_class = AuthorCursorPagination
+    cache_model = 'author'
 
     #Adding our own custom permission to the viewset
     permission_classes = [
         IsLibrarian
     ]
     serializer_class = AuthorSerializer
+    values_serializer = ValuesSerializer(AuthorSerializer)
 
 
 class BlacklistRefreshView(APIView):
@@ -54,7 +216,7 @@ class BlacklistRefreshView(APIView):
         permissions.IsAuthenticated
     ]
     def post(self, request: Request) -> Response:
-        token = RefreshToken(request.data.get('refresh'))
+        token = CachedBlacklistRefreshToken(request.data.get('refresh'))
         token.blacklist()
         return Response("Success")
 
@@ -91,29 +253,10 @@ class HomePageApiView(APIView):
     ]
 
     def get(self, request):
-        num_books = Book.objects.all().count()
-        num_instances = BookInstance.objects.all().count()
-
-        # Available books (status = 'a')
-        num_instances_available = BookInstance.objects.filter(status__exact='a').count()
-
-        num_fantasy_genres = Genre.objects.filter(name__icontains='Fantasy').count()
+        #The counts are read from the materialized snapshot, cached for a few seconds (see catalog/summary.py)
+        summary = catalog_summary()
 
-        num_lotr_books = Book.objects.filter(title__icontains='Lord of the rings').count()
-
-        # The 'all()' is implied by default.
-        num_authors = Author.objects.count()
-
-        home_page_data = {
-        'num_books': num_books,
-        'num_instances': num_instances,
-        'num_instances_available': num_instances_available,
-        'num_authors': num_authors,
-        'num_fantasy_genres' : num_fantasy_genres,
-        'num_lotr_books' : num_lotr_books,
-        }
-
-        result = HomePageSerializer(home_page_data).data
+        result = HomePageSerializer(summary).data
 
         return Response(result)
 
@@ -123,21 +266,20 @@ class UserBorrowedBooksApiView(APIView):
     ]
 
     serializer_class = BookInstanceSerializer
-    JWT_authenticator = JWTAuthentication()
 
     def get(self, request, pk):
         '''This gets the books borrowed by a specific user'''
-        #Getting the username from the provided access token
-        user, _ = self.JWT_authenticator.authenticate(request)
+        #Getting the user that the authentication step found from the provided access token
+        user = get_principal(request).user
 
-        #if the username does not match the userid provided in the api url, 
+        #if the user does not match the userid provided in the api url, 
         #Then the request is unauthorized and returns status code 401 
-        if (user != User.objects.get(id=pk)): 
+        if (user.id != pk): 
             return_message = {'Error_message':'The userID does not match authorization credentials'}
             return Response(return_message,status=status.HTTP_401_UNAUTHORIZED)
 
         #Get the books borrowed by this user and return them
-        query_set = BookInstance.objects.filter(borrower=user).filter(status__exact='o').order_by('due_back')
+        query_set = BookInstance.objects.select_related('book', 'borrower').filter(borrower=user).filter(status__exact='o').order_by('due_back')
         serializer = self.serializer_class(query_set,many=True)
 
         return Response(serializer.data)
@@ -153,11 +295,33 @@ class AllBorrowedBooksApiViewset(
         OnlyLibrarians,
     ]
 
-    queryset = BookInstance.objects.filter(status__exact = 'o').order_by('due_back')
+    #The book and borrower are shown by name, so they are joined in instead of being fetched per row
+    queryset = BookInstance.objects.select_related('book', 'borrower').on_loan().order_by('due_back')
     serializer_class = BookInstanceSerializer
-
-
-class GenreViewSet(viewsets.ModelViewSet):
+    pagination_class = BookInstanceCursorPagination
+
+    def get_queryset(self) -> QuerySet:
+        queryset = super().get_queryset()
+        if self.action == 'list':
+            #Checkout always sets a due date, the copies on loan without one are listed by without_due_date
+            queryset = queryset.filter(due_back__isnull=False)
+        return queryset
+
+    @action(detail=False, url_path='without-due-date', pagination_class=CatalogCursorPagination)
+    def without_due_date(self, request: Request) -> Response:
+        '''The copies on loan without a due date (e.g. set on loan in the admin), which the list by due date leaves out'''
+        page = self.paginate_queryset(self.get_queryset().filter(due_back__isnull=True))
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+    @action(detail=False, pagination_class=OverdueCursorPagination, serializer_class=OverdueLoanSerializer)
+    def overdue(self, request: Request) -> Response:
+        '''The copies on loan that were due back before today, filtered by the database from the partial index of the loans'''
+        queryset = BookInstance.objects.select_related('book', 'borrower').overdue()
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+
+class GenreViewSet(ConditionalCacheMixin, ValuesListMixin, viewsets.ModelViewSet):
     """This viewset provides create, retrieve, update and delete apis for genre"""
 
     permission_classes = [
@@ -165,9 +329,12 @@ class GenreViewSet(viewsets.ModelViewSet):
     ]
     queryset = Genre.objects.all()
     serializer_class = GenreSerializer
+    values_serializer = ValuesSerializer(GenreSerializer)
+    pagination_class = NameCursorPagination
+    cache_model = 'genre'
 
 
-class LanguageViewSet(viewsets.ModelViewSet):
+class LanguageViewSet(ConditionalCacheMixin, ValuesListMixin, viewsets.ModelViewSet):
     """This viewset provides create, retrieve, update and delete apis for language"""
 
     permission_classes = [
@@ -175,3 +342,194 @@ class LanguageViewSet(viewsets.ModelViewSet):
     ]
     queryset = Language.objects.all()
     serializer_class = LanguageSerializer
+    values_serializer = ValuesSerializer(LanguageSerializer)
+    pagination_class = NameCursorPagination
+    cache_model = 'language'
+
+
+class CatalogExportApiView(APIView):
+    '''
+    Streams every row of a dataset as NDJSON (the default) or as CSV with ?output=csv.
+    Rows are ordered by id, an interrupted export can be resumed with ?after=<last id received>.
+    '''
+    model = None
+    rows = None
+    fields = None
+
+    def get(self, request):
+        export_format = request.query_params.get('output', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            return_message = {'Error_message': f'output must be one of {", ".join(EXPORT_FORMATS)}'}
+            return Response(return_message, status=status.HTTP_400_BAD_REQUEST)
+
+        after = request.query_params.get('after')
+        if after is not None:
+            try:
+                after = self.model._meta.pk.to_python(after)
+            except ValidationError:
+                return_message = {'Error_message': 'after must be the id of a row'}
+                return Response(return_message, status=status.HTTP_400_BAD_REQUEST)
+
+        response = StreamingHttpResponse(
+            export_stream(self.rows, self.fields, export_format, after=after),
+            content_type=CONTENT_TYPES[export_format],
+        )
+        response['Content-Disposition'] = f'attachment; filename="{self.model._meta.model_name}.{export_format}"'
+        return response
+
+
+class BookExportApiView(CatalogExportApiView):
+    '''Exports the books with their author, language and genres. Anyone can read the catalog'''
+    permission_classes = [
+        IsLibrarian
+    ]
+    model = Book
+    rows = staticmethod(book_rows)
+    fields = BOOK_EXPORT_FIELDS
+
+
+class BookInstanceExportApiView(CatalogExportApiView):
+    '''Exports every copy of every book. This includes the borrowers so it is only available to librarians'''
+    permission_classes = [
+        OnlyLibrarians
+    ]
+    model = BookInstance
+    rows = staticmethod(bookinstance_rows)
+    fields = BOOKINSTANCE_EXPORT_FIELDS
+
+
+class BookSearchApiView(APIView):
+    '''
+    Full-text search over the title and summary of books and the names of their authors.
+    Returns the books matching every word of ?q= ranked by relevance, at most ?limit= of them (default 20, max 100).
+    With ?available=true only the books that have an available copy are returned.
+    '''
+    permission_classes = [
+        permissions.AllowAny
+    ]
+    default_limit = 20
+    max_limit = 100
+
+    def get(self, request):
+        query = request.query_params.get('q', '')
+        try:
+            limit = min(int(request.query_params.get('limit', self.default_limit)), self.max_limit)
+        except ValueError:
+            return_message = {'Error_message': 'limit must be a number'}
+            return Response(return_message, status=status.HTTP_400_BAD_REQUEST)
+
+        available_only = request.query_params.get('available') in ('true', '1')
+        ranked_ids = search_books(query, max(limit, 0), available_only=available_only)
+        books = Book.objects.prefetch_related('genre').in_bulk([book_id for book_id, _ in ranked_ids])
+        results = [books[book_id] for book_id, _ in ranked_ids if book_id in books]
+
+        return Response({'results': BookSerializer(results, many=True).data})
+
+
+class DatabasePoolApiView(APIView):
+    '''
+    Statistics of the database connection pools of the worker process serving the request (see locallibrary/db_pool),
+    including how long checkouts waited for a connection. Empty when the pooled backends are not used.
+    '''
+    permission_classes = [
+        OnlyLibrarians
+    ]
+
+    def get(self, request):
+        return Response({'pid': os.getpid(), 'pools': pool_stats()})
+
+
+class LoanViewSet(viewsets.GenericViewSet):
+    '''
+    Checkout, return and renewal of copies by librarians, each in a short transaction that locks the copy (see catalog/loans.py).
+    The stats action returns how long the operations of the worker process serving the request waited for their locks.
+    '''
+    permission_classes = [
+        OnlyLibrarians
+    ]
+    queryset = BookInstance.objects.all()
+    serializer_class = BookInstanceSerializer
+    lookup_value_regex = '[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}'
+
+    def loan_response(self, operation, *args, response_status: int = status.HTTP_200_OK, **kwargs) -> Response:
+        try:
+            copy = operation(*args, **kwargs)
+        except LoanError as error:
+            return Response({'Error_message': error.message}, status=error.status_code)
+        return Response(BookInstanceSerializer(copy).data, status=response_status)
+
+    @action(detail=False, methods=['post'])
+    def checkout(self, request: Request) -> Response:
+        '''Lends the given copy, or any available copy of the given book, to the borrower'''
+        serializer = CheckoutSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        return self.loan_response(
+            checkout,
+            data['borrower'],
+            book_id=data.get('book'),
+            copy_id=data.get('copy'),
+            due_back=data.get('due_back'),
+            response_status=status.HTTP_201_CREATED,
+        )
+
+    @action(detail=True, methods=['post'], url_path='return', url_name='return')
+    def return_copy(self, request: Request, pk: str = None) -> Response:
+        return self.loan_response(return_copy, pk)
+
+    @action(detail=False, methods=['post'], url_path='return', url_name='return-many')
+    def return_many(self, request: Request) -> Response:
+        '''Returns all the given copies, or none of them if one can not be returned'''
+        serializer = ReturnSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            copies = return_copies(serializer.validated_data['copies'])
+        except LoanError as error:
+            return Response({'Error_message': error.message}, status=error.status_code)
+        return Response(BookInstanceSerializer(copies, many=True).data)
+
+    @action(detail=True, methods=['post'])
+    def renew(self, request: Request, pk: str = None) -> Response:
+        serializer = RenewSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return self.loan_response(renew, pk, serializer.validated_data['due_back'])
+
+    @action(detail=False, methods=['get'])
+    def stats(self, request: Request) -> Response:
+        return Response({'pid': os.getpid(), 'locks': lock_stats()})
+
+
+class HoldViewSet(
+    mixins.ListModelMixin,
+    mixins.RetrieveModelMixin,
+    viewsets.GenericViewSet
+    ):
+    '''
+    Holds of the authenticated user on books, with their position in the queue of the book (see catalog/loans.py).
+    POST {"book": id} joins the queue, DELETE cancels the hold.
+    '''
+    permission_classes = [
+        permissions.IsAuthenticated
+    ]
+    serializer_class = HoldSerializer
+    pagination_class = None
+    lookup_value_regex = '[0-9]+'
+
+    def get_queryset(self) -> QuerySet:
+        return Hold.objects.select_related('book', 'copy').filter(patron=get_principal(self.request).user, status__in=['w', 'r']).annotate_position()
+
+    def create(self, request: Request) -> Response:
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            hold = place_hold(get_principal(request).user, serializer.validated_data['book'].pk)
+        except LoanError as error:
+            return Response({'Error_message': error.message}, status=error.status_code)
+        return Response(self.get_serializer(hold).data, status=status.HTTP_201_CREATED)
+
+    def destroy(self, request: Request, pk: str = None) -> Response:
+        try:
+            cancel_hold(pk, patron=get_principal(request).user)
+        except LoanError as error:
+            return Response({'Error_message': error.message}, status=error.status_code)
+        return Response(status=status.HTTP_204_NO_CONTENT)
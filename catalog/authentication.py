@@ -0,0 +1,48 @@
+'''
+Authentication used by the REST API.
+
+The access token is decoded and the user is fetched exactly once per request, by DRF's
+authentication step. The result is kept on the request as an AuthenticatedPrincipal
+so the permission classes and views can reuse it instead of authenticating again.
+'''
+from typing import Optional
+from django.contrib.auth.models import User
+from rest_framework.request import Request
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import Token
+
+
+class AuthenticatedPrincipal:
+    '''The user, validated access token and claims of an authenticated API request'''
+    __slots__ = ('user', 'token')
+
+    def __init__(self, user: User, token: Token):
+        self.user = user
+        self.token = token
+
+    @property
+    def claims(self) -> dict:
+        return self.token.payload
+
+    @property
+    def is_librarian_claim(self) -> bool:
+        '''Whether the token says the user is a librarian. This was true when the token was created, not necessarily now'''
+        return self.claims.get('isLibrarian') == True
+
+
+class PrincipalJWTAuthentication(JWTAuthentication):
+    '''JWTAuthentication that also attaches an AuthenticatedPrincipal to the request'''
+
+    def authenticate(self, request: Request):
+        response = super().authenticate(request)
+        if response is not None:
+            user, token = response
+            request.principal = AuthenticatedPrincipal(user, token)
+        return response
+
+
+def get_principal(request: Request) -> Optional[AuthenticatedPrincipal]:
+    '''Returns the principal of the request, or None if the request is not authenticated with a JWT'''
+    #Accessing request.user runs the authentication classes if they have not run yet (DRF only runs them once)
+    request.user
+    return getattr(request, 'principal', None)
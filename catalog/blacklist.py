@@ -0,0 +1,70 @@
+'''
+Cached checks of the refresh token blacklist (rest_framework_simplejwt.token_blacklist), and the purge of expired tokens.
+
+Every token refresh checks whether the refresh token was blacklisted (CachedBlacklistRefreshToken in
+catalog/custom_tokens.py), and so does a logout. When a cache shared by the worker processes is configured (API_CACHE_ALIAS, see
+catalog/caching.py), each worker keeps the JTIs of the blacklisted tokens that have not expired yet in memory,
+so that check does not query the database. The set is reloaded when the version of the blacklist changes, which
+the signal handlers in catalog/signals.py bump whenever a token is blacklisted, and at least every
+BLACKLIST_CACHE_TIMEOUT seconds, which covers tokens removed from the blacklist (e.g. in the admin).
+Without a shared cache a worker would not see the tokens blacklisted by the others, so the database is queried every time.
+Expired tokens are rejected because of their exp claim anyway, so they are left out of the set, and
+purge_expired_tokens() (the purge_expired_tokens command) deletes them from the tables.
+'''
+import threading
+import time
+from typing import FrozenSet, Tuple
+from django.conf import settings
+from django.db import transaction
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.utils import aware_utcnow
+from .caching import caching_enabled, get_version
+
+#Name of the version bumped when a token is blacklisted
+BLACKLIST_VERSION = 'blacklistedtoken'
+
+_lock = threading.Lock()
+#JTIs of the blacklisted tokens that had not expired when they were loaded
+_blacklisted_jtis: FrozenSet[str] = frozenset()
+#Version of the blacklist the JTIs were loaded at, and time at which they have to be loaded again
+_loaded_version = None
+_expires = 0.0
+
+
+def _timeout() -> float:
+    return getattr(settings, 'BLACKLIST_CACHE_TIMEOUT', 60)
+
+
+def is_blacklisted(jti: str) -> bool:
+    '''Returns whether the refresh token with this JTI was blacklisted, from memory when the blacklist did not change'''
+    global _blacklisted_jtis, _loaded_version, _expires
+    if not caching_enabled():
+        return BlacklistedToken.objects.filter(token__jti=jti).exists()
+    version, _ = get_version(BLACKLIST_VERSION)
+    with _lock:
+        if version != _loaded_version or time.monotonic() >= _expires:
+            _blacklisted_jtis = frozenset(
+                BlacklistedToken.objects.filter(token__expires_at__gt=aware_utcnow()).values_list('token__jti', flat=True)
+            )
+            _loaded_version = version
+            _expires = time.monotonic() + _timeout()
+        return jti in _blacklisted_jtis
+
+
+def purge_expired_tokens(batch_size: int = 1000) -> Tuple[int, int]:
+    '''
+    Deletes the expired outstanding tokens and their blacklist entries, batch_size tokens per transaction
+    so that the tables are not locked for long. Returns the number of outstanding and blacklisted tokens deleted
+    '''
+    now = aware_utcnow()
+    outstanding = blacklisted = 0
+    while True:
+        with transaction.atomic():
+            token_ids = list(
+                OutstandingToken.objects.filter(expires_at__lte=now).order_by('id').values_list('id', flat=True)[:batch_size]
+            )
+            if not token_ids:
+                return outstanding, blacklisted
+            #Deleting the blacklist entries first leaves nothing for the cascade of the outstanding tokens to collect
+            blacklisted += BlacklistedToken.objects.filter(token_id__in=token_ids).delete()[0]
+            outstanding += OutstandingToken.objects.filter(id__in=token_ids).delete()[0]
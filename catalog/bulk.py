@@ -0,0 +1,209 @@
+'''
+Bulk creation and update of books and their copies.
+
+All the rows of an upload are validated together, with one query per related model instead of one per row,
+and then written with bulk_create/bulk_update inside a single transaction.
+Books are matched by ISBN: a row with a new ISBN creates a book, a row with an existing ISBN updates it.
+If any row is invalid nothing is written.
+'''
+import uuid
+from typing import Iterable, List, Set, Tuple
+from django.conf import settings
+from django.db import transaction
+from .models import Author, Book, BookInstance, CatalogStats, Genre, Language
+from .serializers import BulkBookSerializer
+from .search import index_books
+from .caching import bump_version
+from .loans import serve_waiting_holds
+
+#Number of rows sent to the database per INSERT/UPDATE, and per IN (...) lookup
+BULK_BATCH_SIZE = 500
+
+
+def bulk_max_rows() -> int:
+    return getattr(settings, 'BULK_MAX_ROWS', 10000)
+
+
+def _batches(values: list, size: int = BULK_BATCH_SIZE) -> Iterable[list]:
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _existing_values(queryset, field: str, values: Iterable) -> set:
+    '''Returns which of the values exist in the given field, querying in batches to stay under the parameter limit'''
+    existing = set()
+    for batch in _batches(list(set(values))):
+        existing.update(queryset.filter(**{f'{field}__in': batch}).values_list(field, flat=True))
+    return existing
+
+
+def _validate(rows: list) -> Tuple[List[dict], List[dict]]:
+    '''Returns the validated data of every row and the errors of every row (empty when the row is valid)'''
+    validated_rows = []
+    errors = []
+    for row in rows:
+        serializer = BulkBookSerializer(data=row)
+        if serializer.is_valid():
+            validated_rows.append(serializer.validated_data)
+            errors.append({})
+        else:
+            validated_rows.append(None)
+            errors.append(dict(serializer.errors))
+
+    valid_rows = [row for row in validated_rows if row is not None]
+    author_ids = _existing_values(Author.objects, 'id', [row['author'] for row in valid_rows if row.get('author') is not None])
+    language_ids = _existing_values(Language.objects, 'id', [row['language'] for row in valid_rows if row.get('language') is not None])
+    genre_ids = _existing_values(Genre.objects, 'id', [genre for row in valid_rows for genre in row.get('genre', [])])
+
+    seen_isbns = set()
+    seen_copy_ids = set()
+    for row, row_errors in zip(validated_rows, errors):
+        if row is None:
+            continue
+        if row['isbn'] in seen_isbns:
+            row_errors['isbn'] = ['This ISBN appears more than once in the upload.']
+        seen_isbns.add(row['isbn'])
+        if row.get('author') is not None and row['author'] not in author_ids:
+            row_errors['author'] = [f'Invalid pk "{row["author"]}" - object does not exist.']
+        if row.get('language') is not None and row['language'] not in language_ids:
+            row_errors['language'] = [f'Invalid pk "{row["language"]}" - object does not exist.']
+        missing_genres = [genre for genre in row.get('genre', []) if genre not in genre_ids]
+        if missing_genres:
+            row_errors['genre'] = [f'Invalid pk "{genre}" - object does not exist.' for genre in missing_genres]
+        for copy in row.get('copies', []):
+            if 'id' not in copy:
+                continue
+            if copy['id'] in seen_copy_ids:
+                row_errors['copies'] = [f'The copy {copy["id"]} appears more than once in the upload.']
+            seen_copy_ids.add(copy['id'])
+    return validated_rows, errors
+
+
+def _save_books(rows: List[dict]) -> Tuple[List[Book], List[bool]]:
+    '''Creates or updates the books, returns them in the order of the rows along with whether they were created'''
+    existing_books = {}
+    for batch in _batches([row['isbn'] for row in rows]):
+        existing_books.update(Book.objects.in_bulk(batch, field_name='isbn'))
+
+    books = []
+    created = []
+    for row in rows:
+        book = existing_books.get(row['isbn'])
+        created.append(book is None)
+        if book is None:
+            book = Book(isbn=row['isbn'])
+        book.title = row['title']
+        book.summary = row['summary']
+        if 'author' in row:
+            book.author_id = row['author']
+        if 'language' in row:
+            book.language_id = row['language']
+        books.append(book)
+
+    new_books = [book for book, is_new in zip(books, created) if is_new]
+    updated_books = [book for book, is_new in zip(books, created) if not is_new]
+    Book.objects.bulk_create(new_books, batch_size=BULK_BATCH_SIZE)
+    Book.objects.bulk_update(updated_books, ['title', 'summary', 'author', 'language'], batch_size=BULK_BATCH_SIZE)
+
+    #Some databases (e.g SQLite) do not return the primary keys of rows created in bulk
+    missing_ids = [book.isbn for book in new_books if book.pk is None]
+    for batch in _batches(missing_ids):
+        created_ids = dict(Book.objects.filter(isbn__in=batch).values_list('isbn', 'id'))
+        for book in new_books:
+            if book.isbn in created_ids:
+                book.pk = created_ids[book.isbn]
+    return books, created
+
+
+def _save_genres(rows: List[dict], books: List[Book]) -> None:
+    '''Replaces the genres of the books whose row lists genres'''
+    through = Book.genre.through
+    book_ids = [book.pk for row, book in zip(rows, books) if 'genre' in row]
+    for batch in _batches(book_ids):
+        through.objects.filter(book_id__in=batch).delete()
+    through.objects.bulk_create([
+        through(book_id=book.pk, genre_id=genre_id)
+        for row, book in zip(rows, books) if 'genre' in row
+        for genre_id in dict.fromkeys(row['genre'])
+    ], batch_size=BULK_BATCH_SIZE)
+
+
+def _save_copies(rows: List[dict], books: List[Book]) -> Tuple[List[List[str]], Set[int]]:
+    '''
+    Creates or updates the copies of every book. Returns the ids of the copies of every row, and the books the
+    updated copies belonged to before, which lose the copies moved to another book
+    '''
+    copy_ids = [copy['id'] for row in rows for copy in row.get('copies', []) if 'id' in copy]
+    existing_copies = {}
+    for batch in _batches(copy_ids):
+        existing_copies.update(BookInstance.objects.in_bulk(batch))
+
+    new_copies = []
+    updated_copies = []
+    row_copy_ids = []
+    previous_book_ids = set()
+    for row, book in zip(rows, books):
+        ids = []
+        for copy in row.get('copies', []):
+            bookinstance = existing_copies.get(copy.get('id'))
+            if bookinstance is None:
+                bookinstance = BookInstance(id=copy.get('id', uuid.uuid4()))
+                new_copies.append(bookinstance)
+            else:
+                updated_copies.append(bookinstance)
+                if bookinstance.book_id is not None:
+                    previous_book_ids.add(bookinstance.book_id)
+            bookinstance.book_id = book.pk
+            bookinstance.imprint = copy['imprint']
+            if 'status' in copy:
+                bookinstance.status = copy['status']
+            if 'due_back' in copy:
+                bookinstance.due_back = copy['due_back']
+            ids.append(str(bookinstance.id))
+        row_copy_ids.append(ids)
+
+    BookInstance.objects.bulk_create(new_copies, batch_size=BULK_BATCH_SIZE)
+    BookInstance.objects.bulk_update(updated_copies, ['book', 'imprint', 'status', 'due_back'], batch_size=BULK_BATCH_SIZE)
+    return row_copy_ids, previous_book_ids
+
+
+def bulk_upsert_books(rows) -> Tuple[bool, List[dict]]:
+    '''
+    Validates and saves a list of books. Returns whether the books were saved and a result for every row:
+    the id of the book and its copies and whether it was created or updated, or the errors of the row.
+    '''
+    if not isinstance(rows, list):
+        return False, [{'index': None, 'status': 'invalid', 'errors': {'non_field_errors': ['Expected a list of books.']}}]
+    if len(rows) > bulk_max_rows():
+        return False, [{'index': None, 'status': 'invalid', 'errors': {'non_field_errors': [f'At most {bulk_max_rows()} books can be uploaded at once.']}}]
+
+    validated_rows, errors = _validate(rows)
+    if any(errors):
+        return False, [
+            {'index': index, 'status': 'invalid', 'errors': row_errors} if row_errors else {'index': index, 'status': 'skipped'}
+            for index, row_errors in enumerate(errors)
+        ]
+
+    with transaction.atomic():
+        books, created = _save_books(validated_rows)
+        _save_genres(validated_rows, books)
+        row_copy_ids, previous_book_ids = _save_copies(validated_rows, books)
+        #bulk_create and bulk_update do not send the signals that maintain the home page counts, the copy counters, the search index
+        #and the cached api responses
+        CatalogStats.rebuild()
+        Book.update_copy_counters(list({book.pk for book in books} | previous_book_ids))
+        #Available copies go to the patrons waiting for their book first
+        serve_waiting_holds([book.pk for book in books])
+        index_books([book.pk for book in books])
+        bump_version('book', 'bookinstance')
+
+    return True, [
+        {
+            'index': index,
+            'status': 'created' if is_new else 'updated',
+            'id': book.pk,
+            'isbn': book.isbn,
+            'copies': copy_ids,
+        }
+        for index, (book, is_new, copy_ids) in enumerate(zip(books, created, row_copy_ids))
+    ]
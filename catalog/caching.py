@@ -0,0 +1,180 @@
+'''
+Conditional GET support and a server-side cache for the read-only catalog endpoints,
+and the keys of the template fragments cached by the HTML pages.
+
+Every cached model has a version number kept in the cache (API_CACHE_ALIAS), bumped by the signal handlers
+in catalog/signals.py whenever a row that changes its representation is written.
+Responses carry an ETag derived from the version and the request path, so a client that repeats a request
+with If-None-Match (or If-Modified-Since) gets a 304 without the database being queried, and
+a new client gets the representation from the cache until the version changes.
+The versions are only correct if every worker process sees the versions bumped by the others, so all of this is
+only turned on when API_CACHE_ALIAS names a cache shared by the workers (e.g. memcached or redis). When it is not set,
+the responses, the counts and the template fragments are not cached and every request reads the database.
+'''
+import hashlib
+import time
+from typing import List, Optional
+from django.conf import settings
+from django.core.cache import caches, BaseCache
+from django.core.exceptions import EmptyResultSet
+from django.db import transaction
+from django.db.models import QuerySet
+from django.utils.http import http_date, parse_http_date_safe, parse_etags
+from rest_framework import status
+from rest_framework.request import Request
+from rest_framework.response import Response
+
+
+def _cache() -> Optional[BaseCache]:
+    alias = getattr(settings, 'API_CACHE_ALIAS', None)
+    if alias is None:
+        return None
+    return caches[alias]
+
+
+def caching_enabled() -> bool:
+    '''Whether a cache shared by the worker processes is configured (API_CACHE_ALIAS), see above'''
+    return _cache() is not None
+
+
+def _cache_timeout() -> int:
+    return getattr(settings, 'API_CACHE_TIMEOUT', 300)
+
+
+def _version_key(model_name: str) -> str:
+    return f'catalog:version:{model_name}'
+
+
+def _modified_key(model_name: str) -> str:
+    return f'catalog:modified:{model_name}'
+
+
+def get_version(model_name: str):
+    '''Returns the current version of a model and the time it was last changed. Only called when caching_enabled()'''
+    cache = _cache()
+    values = cache.get_many([_version_key(model_name), _modified_key(model_name)])
+    version = values.get(_version_key(model_name))
+    modified = values.get(_modified_key(model_name))
+    if version is None or modified is None:
+        # The version was evicted (or never set). A time based value can not be equal to a version used before
+        version, modified = time.time_ns(), int(time.time())
+        cache.set_many({_version_key(model_name): version, _modified_key(model_name): modified}, timeout=None)
+    return version, modified
+
+
+def _bump(model_name: str) -> None:
+    cache = _cache()
+    try:
+        cache.incr(_version_key(model_name))
+    except ValueError:
+        cache.set(_version_key(model_name), time.time_ns(), timeout=None)
+    cache.set(_modified_key(model_name), int(time.time()), timeout=None)
+
+
+def bump_version(*model_names: str) -> None:
+    '''
+    Invalidates the cached representations of the models. The version is bumped right away, so later requests
+    in the same transaction see the change, and again once the transaction commits, so that a representation
+    cached by another request in between (still showing the data from before the commit) is not used.
+    '''
+    if not caching_enabled():
+        return
+    for model_name in model_names:
+        _bump(model_name)
+        transaction.on_commit(lambda model_name=model_name: _bump(model_name))
+
+
+def fragment_version(*model_names: str) -> str:
+    '''Returns a value that changes whenever one of the models changes, used in the keys of cached template fragments'''
+    if not caching_enabled():
+        return ''
+    return '-'.join(str(get_version(model_name)[0]) for model_name in model_names)
+
+
+def cached_count(queryset: QuerySet) -> int:
+    '''
+    Returns queryset.count(), cached until the version of the model of the queryset changes.
+    The version has to be bumped by every write to the model (see catalog/signals.py) for the count to stay exact.
+    '''
+    cache = _cache()
+    if cache is None:
+        return queryset.count()
+    model_name = queryset.model._meta.model_name
+    try:
+        sql = str(queryset.query)
+    except EmptyResultSet:
+        return 0
+    version, _ = get_version(model_name)
+    digest = hashlib.md5(f'{model_name}:{version}:{sql}'.encode()).hexdigest()
+    cache_key = f'catalog:count:{digest}'
+    count = cache.get(cache_key)
+    if count is None:
+        count = queryset.count()
+        cache.set(cache_key, count, timeout=_cache_timeout())
+    return count
+
+
+class ConditionalCacheMixin:
+    '''
+    Adds ETag/Last-Modified headers, 304 responses and a server-side cache to the list and retrieve
+    actions of a viewset. cache_model is the name passed to bump_version when the representation changes.
+    '''
+    cache_model = None
+
+    def get_cache_models(self) -> List[str]:
+        '''Names of the models whose changes invalidate the cached representation'''
+        return [self.cache_model]
+
+    def list(self, request: Request, *args, **kwargs) -> Response:
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request: Request, *args, **kwargs) -> Response:
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
+
+    def cached_response(self, handler, request: Request, *args, **kwargs) -> Response:
+        if not caching_enabled():
+            return handler(request, *args, **kwargs)
+        versions = [(model_name, *get_version(model_name)) for model_name in self.get_cache_models()]
+        version = ':'.join(f'{model_name}:{version}' for model_name, version, _ in versions)
+        modified = max(modified for _, _, modified in versions)
+        #The links in the responses contain the host, and each renderer gives a different representation
+        url = request.build_absolute_uri()
+        digest = hashlib.md5(f'{version}:{url}:{request.accepted_media_type}'.encode()).hexdigest()
+        etag = f'"{digest}"'
+        headers = {'ETag': etag, 'Last-Modified': http_date(modified), 'Cache-Control': 'no-cache', 'Vary': 'Accept'}
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE') or '')
+        if if_none_match is not None:
+            not_modified = etag in parse_etags(if_none_match) or if_none_match.strip() == '*'
+        else:
+            not_modified = if_modified_since is not None and modified <= if_modified_since
+        if not_modified:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        cache = _cache()
+        cache_key = f'catalog:response:{digest}'
+        data = cache.get(cache_key)
+        if data is None:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            data = response.data
+            cache.set(cache_key, data, timeout=_cache_timeout())
+        return Response(data, headers=headers)
+
+
+class FragmentCacheMixin:
+    '''
+    Adds the fragment_version and fragment_cache_timeout variables used by the {% cache %} blocks of the templates
+    to the context of a view. fragment_models are the names of the models shown in the cached fragments.
+    The querysets of the view must be lazy, so that they are only evaluated when the fragment is rendered.
+    Without a shared cache the timeout is 0, so the fragments are rendered on every request.
+    '''
+    fragment_models = ()
+
+    def get_context_data(self, **kwargs) -> dict:
+        context = super().get_context_data(**kwargs)
+        context['fragment_version'] = fragment_version(*self.fragment_models)
+        context['fragment_cache_timeout'] = getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 300) if caching_enabled() else 0
+        return context
@@ -1,7 +1,12 @@
-from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
-from rest_framework_simplejwt.views import TokenObtainPairView
-from rest_framework_simplejwt.tokens import Token
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+from rest_framework_simplejwt.tokens import RefreshToken, Token
 from django.contrib.auth.models import User
+from django.utils.translation import gettext_lazy as _
+from .blacklist import is_blacklisted
+from .roles import is_librarian
 
 class AddIsLibrarianClaimSerializer(TokenObtainPairSerializer):
     '''
@@ -13,13 +18,34 @@ class AddIsLibrarianClaimSerializer(TokenObtainPairSerializer):
         token = super().get_token(user)
 
         # Add custom claims
-        if user.groups.filter(name="Librarians"):
-            token['isLibrarian'] = True
-        else:
-            token['isLibrarian'] = False
+        token['isLibrarian'] = is_librarian(user)
 
         return token
 
 class AddIsLibrarianClaimView(TokenObtainPairView):
     '''View used to obtain token pairs'''
     serializer_class = AddIsLibrarianClaimSerializer
+
+
+class CachedBlacklistRefreshToken(RefreshToken):
+    '''Refresh token whose blacklist check goes through catalog/blacklist.py, which can answer from memory'''
+    def check_blacklist(self):
+        if is_blacklisted(self.payload[api_settings.JTI_CLAIM]):
+            raise TokenError(_('Token is blacklisted'))
+
+
+class CachedBlacklistTokenRefreshSerializer(TokenRefreshSerializer):
+    '''
+    Creates a new access token from a refresh token whose blacklist check goes through catalog/blacklist.py.
+    When refresh tokens are rotated the old one is blacklisted, which writes to the database anyway, so simplejwt does it
+    '''
+    def validate(self, attrs: dict) -> dict:
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            return super().validate(attrs)
+        refresh = CachedBlacklistRefreshToken(attrs['refresh'])
+        return {'access': str(refresh.access_token)}
+
+
+class CachedBlacklistTokenRefreshView(TokenRefreshView):
+    '''View used to create a new access token once the current one expires'''
+    serializer_class = CachedBlacklistTokenRefreshSerializer
@@ -0,0 +1,130 @@
+'''
+Streaming export of the whole catalog as NDJSON or CSV.
+
+Rows are read in keyset batches ordered by id (WHERE id > last id LIMIT chunk size) and written to the
+response as they are produced, so memory use does not depend on the size of the catalog.
+The same id watermark lets a client resume an interrupted export with ?after=<last id received>.
+'''
+import csv
+import json
+from typing import Callable, Iterable, Iterator, List
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import QuerySet
+from .models import Book, BookInstance
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+BOOK_EXPORT_FIELDS = ['id', 'title', 'summary', 'isbn', 'author_id', 'author', 'language_id', 'language', 'genre']
+BOOKINSTANCE_EXPORT_FIELDS = ['id', 'book_id', 'book', 'imprint', 'status', 'due_back', 'borrower_id', 'borrower']
+
+
+def export_chunk_size() -> int:
+    return getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+
+
+def iterate_in_chunks(queryset: QuerySet, after=None, chunk_size: int = None) -> Iterator[List[dict]]:
+    '''Yields lists of rows of a values() queryset ordered by id, each list fetched with a single query'''
+    chunk_size = chunk_size or export_chunk_size()
+    queryset = queryset.order_by('id')
+    while True:
+        chunk_queryset = queryset if after is None else queryset.filter(id__gt=after)
+        chunk = list(chunk_queryset[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        after = chunk[-1]['id']
+
+
+def book_rows(after=None, chunk_size: int = None) -> Iterator[dict]:
+    '''Books with the names of their author, language and genres'''
+    queryset = Book.objects.values(
+        'id', 'title', 'summary', 'isbn',
+        'author_id', 'author__first_name', 'author__last_name',
+        'language_id', 'language__name',
+    )
+    for chunk in iterate_in_chunks(queryset, after, chunk_size):
+        #prefetch_related does not work with values(), so the genres of the whole chunk are fetched in one query
+        genres = {}
+        genre_rows = Book.genre.through.objects.filter(
+            book_id__in=[book['id'] for book in chunk]
+        ).order_by('genre__name').values_list('book_id', 'genre__name')
+        for book_id, genre_name in genre_rows:
+            genres.setdefault(book_id, []).append(genre_name)
+
+        for book in chunk:
+            author = None
+            if book['author_id'] is not None:
+                author = f"{book['author__last_name']}, {book['author__first_name']}"
+            yield {
+                'id': book['id'],
+                'title': book['title'],
+                'summary': book['summary'],
+                'isbn': book['isbn'],
+                'author_id': book['author_id'],
+                'author': author,
+                'language_id': book['language_id'],
+                'language': book['language__name'],
+                'genre': genres.get(book['id'], []),
+            }
+
+
+def bookinstance_rows(after=None, chunk_size: int = None) -> Iterator[dict]:
+    '''Every copy of every book, with the title of the book and the username of the borrower'''
+    queryset = BookInstance.objects.values(
+        'id', 'book_id', 'book__title', 'imprint', 'status', 'due_back', 'borrower_id', 'borrower__username',
+    )
+    for chunk in iterate_in_chunks(queryset, after, chunk_size):
+        for bookinstance in chunk:
+            yield {
+                'id': bookinstance['id'],
+                'book_id': bookinstance['book_id'],
+                'book': bookinstance['book__title'],
+                'imprint': bookinstance['imprint'],
+                'status': bookinstance['status'],
+                'due_back': bookinstance['due_back'],
+                'borrower_id': bookinstance['borrower_id'],
+                'borrower': bookinstance['borrower__username'],
+            }
+
+
+def to_ndjson(rows: Iterable[dict], fields: List[str]) -> Iterator[str]:
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+
+
+class _Echo:
+    '''File-like object that returns what is written to it, so csv.writer can be used to produce strings'''
+    def write(self, value: str) -> str:
+        return value
+
+
+def to_csv(rows: Iterable[dict], fields: List[str]) -> Iterator[str]:
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        values = []
+        for field in fields:
+            value = row[field]
+            if isinstance(value, list):
+                value = ', '.join(value)
+            values.append('' if value is None else value)
+        yield writer.writerow(values)
+
+
+ENCODERS = {
+    'ndjson': to_ndjson,
+    'csv': to_csv,
+}
+
+
+def export_stream(rows: Callable[..., Iterator[dict]], fields: List[str], export_format: str, after=None) -> Iterator[str]:
+    '''Returns the lines of the export in the requested format'''
+    return ENCODERS[export_format](rows(after=after), fields)
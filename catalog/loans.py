@@ -0,0 +1,323 @@
+'''
+Checkout, return and renewal of copies of books, and the queue of holds on books.
+
+Every operation is a short transaction that locks the row of the copy it changes with SELECT ... FOR UPDATE,
+so two desks can not lend the same copy or return it twice. A checkout by book takes any available copy and skips
+the ones locked by other checkouts (SKIP LOCKED) instead of waiting for them, so desks lending the same popular
+book do not queue up behind each other. Returns and renewals wait for the row of their copy, for at most
+LOAN_LOCK_TIMEOUT seconds on PostgreSQL.
+
+A returned copy goes to the oldest waiting hold on its book, if there is one: the copy is reserved for the patron
+of the hold (status 'r', due back being the pickup deadline) and the hold is ready until the copy is lent to them.
+The next hold is found with the (book, created) index of the waiting holds, so a return does not depend on the
+length of the queue, and a return of many copies takes the next holds of each book with one query per book.
+A copy that is not picked up by its pickup deadline is passed on by expire_holds(), run daily by the expire_holds command.
+Copies that become available without being returned (added, edited in the admin, bulk uploaded) are given to the
+waiting holds too, by serve_waiting_holds(), so nobody at the desk gets them ahead of the queue.
+
+The time spent waiting for the locks is recorded per operation (see lock_stats()), and waits longer than
+LOAN_SLOW_LOCK_WAIT_MS milliseconds are logged, so contention shows up during busy hours.
+SQLite has no row locks, Django leaves FOR UPDATE out of the query there and the whole database is locked by the write instead.
+The copies are changed with an UPDATE conditioned on the status they were read with, so a change made meanwhile is
+noticed there too.
+'''
+import datetime
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional
+from uuid import UUID
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import Q, QuerySet
+from .models import Book, BookInstance, Hold
+from .signals import record_status_change
+
+logger = logging.getLogger(__name__)
+
+#Number of days a copy is lent for when no due date is given
+DEFAULT_LOAN_DAYS = 21
+#Number of days a patron has to pick up the copy reserved for their hold
+HOLD_PICKUP_DAYS = 7
+
+
+class LoanError(Exception):
+    '''Raised when an operation can not be done, with the message and HTTP status returned by the api'''
+    def __init__(self, message: str, status_code: int = 409):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+_stats_lock = threading.Lock()
+#Lock wait statistics of this process by operation
+_stats: Dict[str, dict] = {}
+
+
+def _record_wait(operation: str, waited: float, found: bool) -> None:
+    with _stats_lock:
+        stats = _stats.setdefault(operation, {'count': 0, 'not_found': 0, 'total_wait': 0.0, 'max_wait': 0.0})
+        stats['count'] += 1
+        stats['not_found'] += not found
+        stats['total_wait'] += waited
+        stats['max_wait'] = max(stats['max_wait'], waited)
+    if waited * 1000 >= getattr(settings, 'LOAN_SLOW_LOCK_WAIT_MS', 200):
+        logger.warning('The %s of a copy waited %.1f ms for its lock', operation, waited * 1000)
+
+
+def lock_stats() -> Dict[str, dict]:
+    '''Returns the number of locking queries of each operation in this process, and how long they waited for their locks'''
+    with _stats_lock:
+        return {
+            operation: {
+                'count': stats['count'],
+                'not_found': stats['not_found'],
+                'total_wait_ms': round(stats['total_wait'] * 1000, 3),
+                'average_wait_ms': round(stats['total_wait'] * 1000 / stats['count'], 3),
+                'max_wait_ms': round(stats['max_wait'] * 1000, 3),
+            }
+            for operation, stats in _stats.items()
+        }
+
+
+def reset_lock_stats() -> None:
+    with _stats_lock:
+        _stats.clear()
+
+
+def _is_lock_timeout(error: OperationalError) -> bool:
+    '''Whether the error is a lock that could not be taken in time (lock_not_available on PostgreSQL, a busy database on SQLite)'''
+    return getattr(error.__cause__, 'pgcode', None) == '55P03' or 'database is locked' in str(error)
+
+
+def _timed(operation: str, queryset: QuerySet) -> list:
+    '''Evaluates a locking queryset, recording how long it waited. The rows stay locked until the end of the transaction'''
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            #SET LOCAL only lasts until the end of the transaction
+            cursor.execute('SET LOCAL lock_timeout = %s', [f'{int(getattr(settings, "LOAN_LOCK_TIMEOUT", 5) * 1000)}ms'])
+    start = time.perf_counter()
+    try:
+        rows = list(queryset)
+    except OperationalError as error:
+        _record_wait(operation, time.perf_counter() - start, False)
+        if not _is_lock_timeout(error):
+            raise
+        raise LoanError('The copy is being changed by another request, try again.', 409) from error
+    _record_wait(operation, time.perf_counter() - start, bool(rows))
+    return rows
+
+
+def _lock(operation: str, queryset: QuerySet) -> Optional[BookInstance]:
+    '''Returns the first copy of the queryset, locked until the end of the transaction'''
+    rows = _timed(operation, queryset[:1])
+    return rows[0] if rows else None
+
+
+def _lock_copy(operation: str, copy_id: UUID) -> BookInstance:
+    copy = _lock(operation, BookInstance.objects.select_for_update().filter(pk=copy_id).order_by())
+    if copy is None:
+        raise LoanError('This copy does not exist.', 404)
+    return copy
+
+
+def _update_copy(copy: BookInstance, **values) -> bool:
+    '''
+    Writes the values to the copy only if its row still has the status and borrower it was read with. The check is
+    part of the UPDATE, so two requests can not both change the same copy even where SELECT ... FOR UPDATE does not
+    lock anything (SQLite). Returns whether the copy was changed
+    '''
+    previous_status = copy.status
+    changed = BookInstance.objects.filter(pk=copy.pk, status=copy.status, borrower_id=copy.borrower_id).update(**values)
+    if not changed:
+        return False
+    for field, value in values.items():
+        setattr(copy, field, value)
+    #QuerySet.update() does not send the signals that keep the counters up to date
+    record_status_change(copy, previous_status)
+    return True
+
+
+def _fulfill_hold(copy: BookInstance) -> None:
+    Hold.objects.filter(copy=copy, status='r').update(status='f')
+
+
+def _lend(copy: BookInstance, borrower: User, due_back: datetime.date) -> bool:
+    reserved = copy.status == 'r'
+    if not _update_copy(copy, status='o', borrower=borrower, due_back=due_back):
+        return False
+    if reserved:
+        _fulfill_hold(copy)
+    return True
+
+
+def checkout(borrower: User, book_id: int = None, copy_id: UUID = None, due_back: datetime.date = None) -> BookInstance:
+    '''
+    Lends the copy, or a copy of the book, to the borrower until due_back (DEFAULT_LOAN_DAYS from today by default).
+    A copy reserved for a hold of the borrower is lent in priority, copies reserved for other patrons are not lent
+    '''
+    if due_back is None:
+        due_back = datetime.date.today() + datetime.timedelta(days=DEFAULT_LOAN_DAYS)
+    with transaction.atomic():
+        if copy_id is not None:
+            copy = _lock_copy('checkout', copy_id)
+            lendable = copy.status == 'a' or (copy.status == 'r' and copy.borrower_id == borrower.pk)
+            if not lendable or not _lend(copy, borrower, due_back):
+                raise LoanError('This copy is not available.')
+            return copy
+
+        tried = []
+        while True:
+            #Only the copy that is lent is locked, other desks lending the same book take the next one.
+            #A copy reserved for the borrower ('r') comes before the available ones ('a')
+            copy = _lock('checkout', BookInstance.objects.select_for_update(skip_locked=True).filter(
+                Q(status__exact='a') | Q(status__exact='r', borrower=borrower), book_id=book_id,
+            ).exclude(pk__in=tried).order_by('-status', 'pk'))
+            if copy is None:
+                if not Book.objects.filter(pk=book_id).exists():
+                    raise LoanError('This book does not exist.', 404)
+                raise LoanError('No copy of this book is available.')
+            if _lend(copy, borrower, due_back):
+                return copy
+            #Lent by another request since it was read, which only happens without row locks
+            tried.append(copy.pk)
+
+
+def _shelve(copies: List[BookInstance]) -> None:
+    '''Reserves each copy for the next waiting hold on its book, or makes it available when nobody is waiting'''
+    copies_by_book = defaultdict(list)
+    for copy in copies:
+        copies_by_book[copy.book_id].append(copy)
+
+    pickup_by = datetime.date.today() + datetime.timedelta(days=HOLD_PICKUP_DAYS)
+    ready_holds = []
+    for book_id, book_copies in copies_by_book.items():
+        holds = []
+        if book_id is not None:
+            #The oldest waiting holds, holds being cancelled by another request are left to the next copy
+            holds = _timed('hold_queue', Hold.objects.select_for_update(skip_locked=True).filter(
+                book_id=book_id, status='w',
+            ).order_by('created', 'id')[:len(book_copies)])
+        for index, copy in enumerate(book_copies):
+            if index < len(holds):
+                hold = holds[index]
+                hold.status = 'r'
+                hold.copy = copy
+                ready_holds.append(hold)
+                changed = _update_copy(copy, status='r', borrower_id=hold.patron_id, due_back=pickup_by)
+            else:
+                changed = _update_copy(copy, status='a', borrower=None, due_back=None)
+            if not changed:
+                raise LoanError('The copy was changed by another request, try again.')
+    Hold.objects.bulk_update(ready_holds, ['status', 'copy'])
+
+
+def serve_waiting_holds(book_ids: Iterable[int]) -> int:
+    '''
+    Reserves the available copies of the books for their waiting holds. Returned copies already go to the queue,
+    this is for the copies that become available some other way (added, edited in the admin, bulk uploaded),
+    so that they are not lent to whoever is at the desk ahead of the patrons waiting. Returns how many were reserved
+    '''
+    with transaction.atomic():
+        waiting_book_ids = list(
+            Hold.objects.filter(book_id__in=list(book_ids), status='w').order_by().values_list('book_id', flat=True).distinct()
+        )
+        if not waiting_book_ids:
+            return 0
+        copies = _timed('hold', BookInstance.objects.select_for_update(skip_locked=True).filter(
+            book_id__in=waiting_book_ids, status__exact='a',
+        ).order_by('pk'))
+        _shelve(copies)
+    return sum(copy.status == 'r' for copy in copies)
+
+
+def return_copy(copy_id: UUID) -> BookInstance:
+    '''Marks a copy on loan as returned, it is reserved for the next hold on the book or becomes available'''
+    return return_copies([copy_id])[0]
+
+
+def return_copies(copy_ids: Iterable[UUID]) -> List[BookInstance]:
+    '''Returns many copies in one transaction, e.g. the content of the return box. Either all of them are returned or none'''
+    copy_ids = list(dict.fromkeys(UUID(str(copy_id)) for copy_id in copy_ids))
+    with transaction.atomic():
+        #The rows are locked in the order of their primary key, so that two bulk returns can not deadlock
+        copies = _timed('return', BookInstance.objects.select_for_update().filter(pk__in=copy_ids).order_by('pk'))
+        if len(copies) != len(copy_ids):
+            raise LoanError('This copy does not exist.' if len(copy_ids) == 1 else 'Some of the copies do not exist.', 404)
+        if any(copy.status != 'o' for copy in copies):
+            raise LoanError('This copy is not on loan.' if len(copy_ids) == 1 else 'Some of the copies are not on loan.')
+        _shelve(copies)
+    copies_by_id = {copy.pk: copy for copy in copies}
+    return [copies_by_id[copy_id] for copy_id in copy_ids]
+
+
+def renew(copy_id: UUID, due_back: datetime.date) -> BookInstance:
+    '''Moves the due date of a copy on loan'''
+    with transaction.atomic():
+        copy = _lock_copy('renew', copy_id)
+        if copy.status != 'o' or not _update_copy(copy, due_back=due_back):
+            raise LoanError('This copy is not on loan.')
+    return copy
+
+
+def place_hold(patron: User, book_id: int) -> Hold:
+    '''Adds the patron to the queue of the book. If a copy is available it is reserved for the queue right away'''
+    with transaction.atomic():
+        if not Book.objects.filter(pk=book_id).exists():
+            raise LoanError('This book does not exist.', 404)
+        if Hold.objects.filter(book_id=book_id, patron=patron, status__in=['w', 'r']).exists():
+            raise LoanError('There is already a hold on this book for this patron.')
+        try:
+            with transaction.atomic():
+                hold = Hold.objects.create(book_id=book_id, patron=patron)
+        except IntegrityError as error:
+            #Placed by another request since the check above, the unique constraint on the active holds keeps only one
+            raise LoanError('There is already a hold on this book for this patron.') from error
+        copy = _lock('hold', BookInstance.objects.select_for_update(skip_locked=True).filter(book_id=book_id, status__exact='a').order_by('pk'))
+        if copy is not None:
+            _shelve([copy])
+            hold.refresh_from_db()
+    return hold
+
+
+def cancel_hold(hold_id: int, patron: User = None) -> Hold:
+    '''Cancels a waiting or ready hold (of the patron, when given). The copy reserved for a ready hold goes to the next one'''
+    with transaction.atomic():
+        holds = Hold.objects.select_for_update().filter(pk=hold_id, status__in=['w', 'r'])
+        if patron is not None:
+            holds = holds.filter(patron=patron)
+        hold = holds.first()
+        if hold is None:
+            raise LoanError('This hold does not exist.', 404)
+        copy = None
+        if hold.status == 'r' and hold.copy_id is not None:
+            copy = _lock_copy('hold', hold.copy_id)
+        hold.status = 'c'
+        hold.save(update_fields=['status'])
+        if copy is not None and copy.status == 'r' and copy.borrower_id == hold.patron_id:
+            _shelve([copy])
+    return hold
+
+
+def expire_holds(today: Optional[datetime.date] = None) -> List[Hold]:
+    '''
+    Cancels the ready holds whose copy was not picked up by its pickup date (the due date of the reserved copy).
+    Each copy is reserved for the next hold on its book, or becomes available
+    '''
+    today = today or datetime.date.today()
+    with transaction.atomic():
+        #Holds being cancelled or fulfilled by another request are left to the next run
+        holds = _timed('hold', Hold.objects.select_for_update(skip_locked=True, of=('self',)).filter(
+            status='r', copy__due_back__lt=today,
+        ).order_by('pk'))
+        if not holds:
+            return []
+        copies = _timed('hold', BookInstance.objects.select_for_update().filter(pk__in=[hold.copy_id for hold in holds]).order_by('pk'))
+        Hold.objects.filter(pk__in=[hold.pk for hold in holds]).update(status='c')
+        patrons = {hold.copy_id: hold.patron_id for hold in holds}
+        _shelve([copy for copy in copies if copy.status == 'r' and copy.borrower_id == patrons[copy.pk]])
+    for hold in holds:
+        hold.status = 'c'
+    return holds
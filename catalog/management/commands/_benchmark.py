@@ -0,0 +1,13 @@
+'''Helpers shared by the benchmark commands. Django does not load modules starting with an underscore as commands'''
+import time
+
+
+def best_time(function, repeat: int) -> float:
+    '''Calls function repeat times and returns the fastest run in seconds'''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
@@ -0,0 +1,60 @@
+import datetime
+import io
+import uuid
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from catalog.management.commands._benchmark import best_time
+from catalog.models import Book, BookInstance
+from catalog.parsers import ORJSONParser
+from catalog.renderers import ORJSONRenderer, orjson
+from catalog.serializers import BookInstanceSerializer
+
+
+def _payloads(rows: int) -> dict:
+    '''Builds list responses shaped like the ones of the book and book instance endpoints, without touching the database'''
+    books = [
+        {
+            'id': book_id,
+            'title': f'Book title {book_id}',
+            'summary': 'A summary of the book that is a few dozen words long, ' * 3,
+            'isbn': f'{book_id:013d}',
+            'author': book_id % 100,
+            'language': 1,
+            'genre': [1, 2],
+        }
+        for book_id in range(rows)
+    ]
+    today = datetime.date.today()
+    bookinstances = BookInstanceSerializer([
+        BookInstance(id=uuid.uuid4(), book=Book(title=f'Book title {row}'), due_back=today + datetime.timedelta(days=row % 30))
+        for row in range(rows)
+    ], many=True).data
+    return {'books': {'results': books}, 'bookinstances': {'results': bookinstances}}
+
+
+class Command(BaseCommand):
+    help = 'Compares how fast the default and the orjson renderer and parser encode and decode large list responses'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help='Number of rows in every payload')
+        parser.add_argument('--repeat', type=int, default=5, help='Number of runs, the fastest one is reported')
+
+    def handle(self, *args, **options):
+        if orjson is None:
+            raise CommandError('orjson is not installed, the orjson renderer would fall back to the default one.')
+        rows = options['rows']
+        repeat = options['repeat']
+
+        for name, data in _payloads(rows).items():
+            content = JSONRenderer().render(data)
+            if ORJSONRenderer().render(data) != content:
+                raise CommandError(f'The renderers produced different output for the {name} payload.')
+            self.stdout.write(f'{name}: {rows} rows, {len(content)} bytes')
+
+            for label, renderer in (('JSONRenderer', JSONRenderer()), ('ORJSONRenderer', ORJSONRenderer())):
+                elapsed = best_time(lambda: renderer.render(data), repeat)
+                self.stdout.write(f'  render {label:<15} {elapsed * 1000:8.1f} ms {rows / elapsed:12.0f} rows/s')
+            for label, parser in (('JSONParser', JSONParser()), ('ORJSONParser', ORJSONParser())):
+                elapsed = best_time(lambda: parser.parse(io.BytesIO(content)), repeat)
+                self.stdout.write(f'  parse  {label:<15} {elapsed * 1000:8.1f} ms {rows / elapsed:12.0f} rows/s')
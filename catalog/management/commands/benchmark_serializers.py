@@ -0,0 +1,67 @@
+import datetime
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+from catalog.management.commands._benchmark import best_time
+from catalog.models import Author, Book, Genre, Language
+from catalog.serializers import AuthorSerializer, BookSerializer, GenreSerializer, LanguageSerializer, ValuesSerializer
+
+
+def _create_rows(rows: int) -> None:
+    '''Creates rows authors and books, the books with a language and two genres each'''
+    language = Language.objects.create(name='Benchmark language')
+    Genre.objects.bulk_create([Genre(name=f'Benchmark genre {genre_id}') for genre_id in range(20)])
+    genres = list(Genre.objects.filter(name__startswith='Benchmark genre'))
+    Author.objects.bulk_create([
+        Author(first_name=f'First {row}', last_name=f'Last {row}', date_of_birth=datetime.date(1900, 1, 1) + datetime.timedelta(days=row))
+        for row in range(rows)
+    ], batch_size=500)
+    authors = list(Author.objects.filter(first_name__startswith='First ').values_list('id', flat=True))
+    Book.objects.bulk_create([
+        Book(title=f'Benchmark book {row}', summary='A summary ' * 20, isbn=f'B{row:012d}', author_id=authors[row % len(authors)], language=language)
+        for row in range(rows)
+    ], batch_size=500)
+    through = Book.genre.through
+    through.objects.bulk_create([
+        through(book_id=book_id, genre_id=genres[(book_id + offset) % len(genres)].id)
+        for book_id in Book.objects.filter(isbn__startswith='B').values_list('id', flat=True)
+        for offset in range(2)
+    ], batch_size=500)
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares how fast the model serializers and the values() based serializers used by the list endpoints '
+        'serialize every row of a table. Test rows are created in a transaction that is rolled back'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help='Number of authors and books created for the benchmark')
+        parser.add_argument('--repeat', type=int, default=5, help='Number of runs, the fastest one is reported')
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        with transaction.atomic():
+            _create_rows(options['rows'])
+
+            for serializer_class in (BookSerializer, AuthorSerializer, GenreSerializer, LanguageSerializer):
+                model = serializer_class.Meta.model
+                queryset = model.objects.all()
+                if serializer_class is BookSerializer:
+                    queryset = queryset.prefetch_related('genre')
+                values_serializer = ValuesSerializer(serializer_class)
+
+                expected = JSONRenderer().render(serializer_class(queryset.all(), many=True).data)
+                if JSONRenderer().render(values_serializer.to_representation(list(values_serializer.values(queryset)))) != expected:
+                    raise CommandError(f'The serializers produced different output for {model.__name__}.')
+
+                model_time = best_time(lambda: serializer_class(queryset.all(), many=True).data, repeat)
+                values_time = best_time(lambda: values_serializer.to_representation(list(values_serializer.values(queryset))), repeat)
+                count = queryset.count()
+                self.stdout.write(
+                    f'{model.__name__:<10} {count:>7} rows  '
+                    f'ModelSerializer {model_time * 1000:8.1f} ms  ValuesSerializer {values_time * 1000:8.1f} ms  '
+                    f'x{model_time / values_time:.1f}'
+                )
+
+            transaction.set_rollback(True)
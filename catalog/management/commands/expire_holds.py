@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from catalog.loans import expire_holds
+
+
+class Command(BaseCommand):
+    help = (
+        'Cancels the ready holds whose copy was not picked up by its pickup date and reserves each copy for the next '
+        'hold on its book, or makes it available. Meant to be scheduled daily (e.g. with the Heroku Scheduler)'
+    )
+
+    def handle(self, *args, **options):
+        holds = expire_holds()
+        self.stdout.write(self.style.SUCCESS(f'Expired {len(holds)} holds.'))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from catalog.blacklist import purge_expired_tokens
+
+
+class Command(BaseCommand):
+    help = (
+        'Deletes the expired refresh tokens from the outstanding and blacklisted token tables, in batches. '
+        'Nothing else removes them, so this should be scheduled to run regularly (e.g. daily with the Heroku Scheduler)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of tokens deleted per transaction')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        outstanding, blacklisted = purge_expired_tokens(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Deleted {outstanding} expired outstanding tokens, {blacklisted} of which were blacklisted.'
+        ))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from catalog.models import CatalogStats
+
+
+class Command(BaseCommand):
+    help = (
+        'Recomputes the home page counts (CatalogStats) from the catalog tables, fixing the drift left by saves that '
+        'raced outside of a transaction, QuerySet.update() or raw SQL. Meant to be scheduled daily (e.g. with the Heroku Scheduler)'
+    )
+
+    def handle(self, *args, **options):
+        stats = CatalogStats.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt the catalog stats: {stats}.'))
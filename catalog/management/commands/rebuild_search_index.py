@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from catalog.search import rebuild_search_index, search_backend
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the full-text search index of every book, e.g. after books were changed with raw SQL'
+
+    def handle(self, *args, **options):
+        backend = search_backend()
+        if backend is None:
+            self.stdout.write('This database has no full-text index, nothing to rebuild.')
+            return
+        with transaction.atomic():
+            rebuild_search_index()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt the {backend} search index.'))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from catalog.caching import bump_version
+from catalog.models import Book
+
+
+class Command(BaseCommand):
+    help = (
+        'Recomputes the total_copies and available_copies counters of every book from its copies, '
+        'e.g. after copies were changed with QuerySet.update() or raw SQL. Only the books whose counters are wrong are written'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of books checked per transaction')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1.')
+
+        fixed = checked = 0
+        last_id = 0
+        while True:
+            book_ids = list(Book.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not book_ids:
+                break
+            with transaction.atomic():
+                fixed += Book.update_copy_counters(book_ids)
+            checked += len(book_ids)
+            last_id = book_ids[-1]
+
+        if fixed:
+            bump_version('book')
+        self.stdout.write(self.style.SUCCESS(f'Checked {checked} books, fixed the copy counters of {fixed}.'))
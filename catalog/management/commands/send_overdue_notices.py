@@ -0,0 +1,120 @@
+import datetime
+import json
+import os
+from itertools import groupby
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.core.management.base import BaseCommand, CommandError
+from django.template.loader import get_template
+from catalog.models import BookInstance
+
+
+class Command(BaseCommand):
+    help = (
+        'Emails every borrower the list of their loans that are overdue or due back within --days-ahead days, '
+        'one message per borrower. The loans are read with a single query ordered by borrower and the messages are '
+        'sent in batches over one connection to the mail server (EMAIL_BACKEND). With --checkpoint, the last borrower '
+        'of every batch sent is written to a file, so a run that was interrupted resumes after it instead of emailing '
+        'the same borrowers twice. Meant to be scheduled daily (e.g. with the Heroku Scheduler)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days-ahead', type=int, default=3, help='Also remind the loans due back within this many days')
+        parser.add_argument('--batch-size', type=int, default=100, help='Number of messages sent at once')
+        parser.add_argument('--checkpoint', help='File recording the progress of the run of the day, to resume it')
+        parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and email every borrower again')
+
+    def handle(self, *args, **options):
+        days_ahead = options['days_ahead']
+        batch_size = options['batch_size']
+        if days_ahead < 0:
+            raise CommandError('--days-ahead can not be negative.')
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1.')
+
+        today = datetime.date.today()
+        self.checkpoint_path = options['checkpoint']
+        self.run = {'date': today.isoformat(), 'days_ahead': days_ahead}
+        checkpoint = {} if options['restart'] else self.read_checkpoint()
+        if checkpoint.get('done'):
+            self.stdout.write(f'The notices of {today} were already sent, use --restart to send them again.')
+            return
+        last_borrower = checkpoint.get('last_borrower', 0)
+        if last_borrower:
+            self.stdout.write(f'Resuming after borrower {last_borrower}.')
+
+        #The copies on loan due back by then, read in order from the bookinstance_borrower_loan_idx partial index
+        loans = (
+            BookInstance.objects.due_before(today + datetime.timedelta(days=days_ahead))
+            .filter(borrower_id__gt=last_borrower)
+            .annotate_overdue(today)
+            .select_related('book', 'borrower')
+            .only('id', 'due_back', 'book', 'borrower', 'borrower__username', 'borrower__first_name', 'borrower__email', 'book__title')
+            .order_by('borrower_id', 'due_back', 'id')
+        )
+        #The template is compiled once, and only rendered for every borrower
+        template = get_template('catalog/email/overdue_notice.txt')
+
+        sent = skipped = loan_count = 0
+        batch = []
+        connection = get_connection()
+        connection.open()
+        try:
+            for _, borrower_loans in groupby(loans.iterator(chunk_size=2000), key=lambda copy: copy.borrower_id):
+                borrower_loans = list(borrower_loans)
+                borrower = borrower_loans[0].borrower
+                if not borrower.email:
+                    skipped += 1
+                else:
+                    batch.append((borrower.pk, self.message(template, borrower, borrower_loans)))
+                    loan_count += len(borrower_loans)
+                if len(batch) >= batch_size:
+                    sent += self.send(connection, batch)
+                    batch = []
+            sent += self.send(connection, batch)
+        finally:
+            connection.close()
+        self.write_checkpoint(done=True)
+        self.stdout.write(self.style.SUCCESS(
+            f'Sent {sent} notices about {loan_count} loans, skipped {skipped} borrowers without an email address.'
+        ))
+
+    def message(self, template, borrower, loans) -> EmailMessage:
+        overdue = any(copy.is_overdue for copy in loans)
+        return EmailMessage(
+            subject='Overdue library books' if overdue else 'Library books due back soon',
+            body=template.render({'borrower': borrower, 'loans': loans, 'overdue': overdue}),
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            to=[borrower.email],
+        )
+
+    def send(self, connection, batch) -> int:
+        '''Sends a batch of (borrower id, message) and records the last borrower in the checkpoint'''
+        if not batch:
+            return 0
+        sent = connection.send_messages([message for _, message in batch]) or 0
+        #A batch that fails is sent again by the next run, the borrowers of the batches before it are not
+        self.write_checkpoint(last_borrower=batch[-1][0])
+        return sent
+
+    def read_checkpoint(self) -> dict:
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return {}
+        try:
+            with open(self.checkpoint_path) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+        except (OSError, ValueError) as error:
+            raise CommandError(f'Can not read the checkpoint {self.checkpoint_path}: {error}')
+        #The checkpoint of another day, or of other options, is a different run
+        if {key: checkpoint.get(key) for key in self.run} != self.run:
+            return {}
+        return checkpoint
+
+    def write_checkpoint(self, **progress) -> None:
+        if not self.checkpoint_path:
+            return
+        #Written to a temporary file first, so that a crash can not leave half a checkpoint behind
+        temporary_path = f'{self.checkpoint_path}.tmp'
+        with open(temporary_path, 'w') as checkpoint_file:
+            json.dump({**self.run, **progress}, checkpoint_file)
+        os.replace(temporary_path, self.checkpoint_path)
@@ -0,0 +1,46 @@
+# Generated by Django 3.2.4 on 2026-10-18 18:12
+
+from django.db import migrations, models
+
+
+def build_catalog_stats(apps, schema_editor):
+    '''Creates the snapshot row from the data that already exists'''
+    Author = apps.get_model('catalog', 'Author')
+    Book = apps.get_model('catalog', 'Book')
+    BookInstance = apps.get_model('catalog', 'BookInstance')
+    Genre = apps.get_model('catalog', 'Genre')
+    CatalogStats = apps.get_model('catalog', 'CatalogStats')
+    CatalogStats.objects.update_or_create(pk=1, defaults={
+        'num_books': Book.objects.count(),
+        'num_instances': BookInstance.objects.count(),
+        'num_instances_available': BookInstance.objects.filter(status__exact='a').count(),
+        'num_authors': Author.objects.count(),
+        'num_fantasy_genres': Genre.objects.filter(name__icontains='Fantasy').count(),
+        'num_lotr_books': Book.objects.filter(title__icontains='Lord of the rings').count(),
+    })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('num_books', models.IntegerField(default=0)),
+                ('num_instances', models.IntegerField(default=0)),
+                ('num_instances_available', models.IntegerField(default=0)),
+                ('num_authors', models.IntegerField(default=0)),
+                ('num_fantasy_genres', models.IntegerField(default=0)),
+                ('num_lotr_books', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'catalog stats',
+            },
+        ),
+        migrations.RunPython(build_catalog_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 3.2.4 on 2026-10-18 19:18
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+
+
+def count_copies(apps, schema_editor):
+    '''Sets the counters of the books that already have copies'''
+    Book = apps.get_model('catalog', 'Book')
+    BookInstance = apps.get_model('catalog', 'BookInstance')
+
+    def count(copies):
+        counts = copies.order_by().annotate(_all=Value(1)).values('_all').annotate(count=Count('pk')).values('count')
+        return Subquery(counts, output_field=models.IntegerField())
+
+    copies = BookInstance.objects.filter(book=OuterRef('pk'))
+    Book.objects.update(total_copies=count(copies), available_copies=count(copies.filter(status__exact='a')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0004_bookinstance_loan_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='available_copies',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='total_copies',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_copies, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['-available_copies', 'title', 'id'], name='book_availability_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(condition=models.Q(('available_copies__gt', 0)), fields=['title', 'id'], name='book_available_title_idx'),
+        ),
+    ]
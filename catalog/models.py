@@ -1,8 +1,14 @@
 from django.db import models
+from django.db.models import (
+    BooleanField, Case, Count, DateField, DurationField, ExpressionWrapper, F, IntegerField, OuterRef, Q, Subquery, Value, When,
+)
+from django.db.models.functions import Coalesce
 from django.urls import reverse # Used to generate URLs by reversing the URL patterns
 import uuid # Required for unique book instances
 from django.contrib.auth.models import User
+from django.utils import timezone
 from datetime import date
+from catalog.caching import bump_version
 
 
 # Create your models here.
@@ -15,6 +21,10 @@ class Genre(models.Model):
         """String for representing the Model object."""
         return self.name
 
+# Only written with F() updates, see Book.save()
+COPY_COUNTER_FIELDS = ('total_copies', 'available_copies')
+
+
 class Book(models.Model):
     """Model representing a book (but not a specific copy of a book)."""
     title = models.CharField(max_length=200)
@@ -31,9 +41,20 @@ class Book(models.Model):
     # Genre class has already been defined so we can specify the object above.
     genre = models.ManyToManyField(Genre, help_text='Select a genre for this book')
     language = models.ForeignKey('Language', on_delete=models.SET_NULL, null=True)
-    
+
+    # Number of copies of the book and how many of them are available, maintained by the signal handlers
+    # in catalog/signals.py so that availability can be filtered and sorted on without counting the copies
+    total_copies = models.IntegerField(default=0, editable=False)
+    available_copies = models.IntegerField(default=0, editable=False)
+
     class Meta:
         ordering = ['title']
+        indexes = [
+            # The books with the most available copies first
+            models.Index(fields=['-available_copies', 'title', 'id'], name='book_availability_idx'),
+            # Only the books that can be borrowed, ordered like the book list
+            models.Index(fields=['title', 'id'], condition=models.Q(available_copies__gt=0), name='book_available_title_idx'),
+        ]
 
     def __str__(self):
         """String for representing the Model object."""
@@ -49,6 +70,77 @@ class Book(models.Model):
 
     display_genre.short_description = 'Genre'
 
+    def save(self, *args, **kwargs):
+        """
+        Saves the book without its copy counters when it already exists: the instance may have been loaded
+        before a copy changed, and its counters would overwrite the ones written by add_copies() in the meantime
+        """
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in COPY_COUNTER_FIELDS and field.attname not in deferred
+            ]
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def update_copy_counters(cls, book_ids=None) -> int:
+        """
+        Recomputes the copy counters of the books (of every book when book_ids is None), e.g. after bulk operations
+        that bypass signals. Only the books whose counters are wrong are written. Returns how many there were
+        """
+        copies = BookInstance.objects.filter(book=models.OuterRef('pk'))
+        total = count_subquery(copies)
+        available = count_subquery(copies.filter(status__exact='a'))
+        books = cls.objects.all() if book_ids is None else cls.objects.filter(pk__in=list(book_ids))
+        wrong_ids = list(
+            books.annotate(actual_total=total, actual_available=available)
+            .exclude(total_copies=F('actual_total'), available_copies=F('actual_available'))
+            .values_list('pk', flat=True)
+        )
+        if wrong_ids:
+            cls.objects.filter(pk__in=wrong_ids).update(total_copies=total, available_copies=available)
+        return len(wrong_ids)
+
+    @classmethod
+    def add_copies(cls, book_id, total: int = 0, available: int = 0) -> None:
+        """Atomically adds to the copy counters of a book, e.g. add_copies(book.id, available=-1) when a copy is lent"""
+        if book_id is None or not (total or available):
+            return
+        cls.objects.filter(pk=book_id).update(
+            total_copies=F('total_copies') + total,
+            available_copies=F('available_copies') + available,
+        )
+
+
+class BookInstanceQuerySet(models.QuerySet):
+    """
+    Overdue loans found by the database instead of checking is_overdue on every copy in Python.
+    The copies on loan are filtered and ordered by the bookinstance_on_loan_idx partial index,
+    so the overdue ones are a range scan of that index (due_back < today).
+    """
+    def on_loan(self):
+        return self.filter(status__exact='o')
+
+    def overdue(self, today=None):
+        """The copies on loan that were due back before today, with how long ago (days_overdue, a timedelta computed by the database)"""
+        today = today or date.today()
+        return self.on_loan().filter(due_back__lt=today).annotate(
+            days_overdue=ExpressionWrapper(Value(today, output_field=DateField()) - F('due_back'), output_field=DurationField()),
+        )
+
+    def due_before(self, day):
+        """The copies on loan that are due back on or before the given day, including the overdue ones"""
+        return self.on_loan().filter(due_back__lte=day)
+
+    def annotate_overdue(self, today=None):
+        """Adds the overdue flag computed by the database, which is_overdue returns instead of comparing the dates itself"""
+        return self.annotate(overdue=Case(
+            When(due_back__lt=today or date.today(), then=Value(True)),
+            default=Value(False),
+            output_field=BooleanField(),
+        ))
+
 
 class BookInstance(models.Model):
     """Model representing a specific copy of a book (i.e. that can be borrowed from the library)."""
@@ -73,8 +165,13 @@ class BookInstance(models.Model):
         help_text='Book availability',
     )
 
+    objects = BookInstanceQuerySet.as_manager()
+
     @property
     def is_overdue(self : 'BookInstance') -> bool:
+        # Copies loaded with annotate_overdue() already have the answer of the database
+        if 'overdue' in self.__dict__:
+            return self.overdue
         if self.due_back and date.today() > self.due_back:
             return True
         return False
@@ -82,6 +179,16 @@ class BookInstance(models.Model):
     class Meta:
         ordering = ['due_back']
         permissions = (("can_mark_returned", "Set book as returned"),)
+        indexes = [
+            # Copies with a given status ordered by due date, e.g. the list of all borrowed books
+            models.Index(fields=['status', 'due_back', 'id'], name='bookinstance_status_due_idx'),
+            # The books borrowed by a user ordered by due date
+            models.Index(fields=['borrower', 'status', 'due_back'], name='bookinstance_borrower_idx'),
+            # Only the copies on loan, which is a small part of the table
+            models.Index(fields=['due_back', 'id'], condition=models.Q(status='o'), name='bookinstance_on_loan_idx'),
+            # The copies on loan grouped by borrower, e.g. the overdue notices (send_overdue_notices)
+            models.Index(fields=['borrower', 'due_back', 'id'], condition=models.Q(status='o'), name='bookinstance_borrower_loan_idx'),
+        ]
 
     def __str__(self):
         """String for representing the Model object."""
@@ -111,3 +218,172 @@ class Language(models.Model):
     
     def __str__(self):
         return self.name
+
+
+class HoldQuerySet(models.QuerySet):
+    def annotate_position(self):
+        """
+        Adds the position of the waiting holds in the queue of their book, which queue_position returns
+        instead of counting the holds ahead with a query per hold
+        """
+        ahead = Hold.objects.filter(book_id=OuterRef('book_id'), status='w').filter(
+            Q(created__lt=OuterRef('created')) | Q(created=OuterRef('created'), id__lt=OuterRef('id'))
+        ).order_by().values('book_id').annotate(count=Count('id')).values('count')
+        return self.annotate(position=Case(
+            When(status='w', then=Coalesce(Subquery(ahead), 0) + 1),
+            default=None,
+            output_field=IntegerField(),
+        ))
+
+
+class Hold(models.Model):
+    """
+    A patron waiting for a copy of a book (see catalog/loans.py). The waiting holds of a book are served
+    in the order they were placed: a returned copy is reserved for the oldest one and the hold becomes ready for pickup.
+    """
+    HOLD_STATUS = (
+        ('w', 'Waiting'),
+        ('r', 'Ready for pickup'),
+        ('f', 'Fulfilled'),
+        ('c', 'Cancelled'),
+    )
+
+    book = models.ForeignKey('Book', on_delete=models.CASCADE)
+    patron = models.ForeignKey(User, on_delete=models.CASCADE)
+    created = models.DateTimeField(default=timezone.now)
+    status = models.CharField(max_length=1, choices=HOLD_STATUS, default='w')
+    # The copy reserved for the patron once the hold is ready
+    copy = models.ForeignKey('BookInstance', on_delete=models.SET_NULL, null=True, blank=True)
+
+    objects = HoldQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['created', 'id']
+        indexes = [
+            # The queue of each book, only the waiting holds are in it
+            models.Index(fields=['book', 'created', 'id'], condition=models.Q(status='w'), name='hold_queue_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['book', 'patron'], condition=models.Q(status__in=['w', 'r']), name='hold_one_active_per_patron'),
+        ]
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'{self.patron} ({self.book})'
+
+    def queue_position(self):
+        """
+        Returns the position of a waiting hold in the queue of its book (1 is the next one served), or None.
+        Only the holds ahead of this one are counted, from the queue index
+        """
+        # Holds loaded with annotate_position() already have the answer of the database
+        if 'position' in self.__dict__:
+            return self.position
+        if self.status != 'w':
+            return None
+        ahead = Hold.objects.filter(book_id=self.book_id, status='w').filter(
+            Q(created__lt=self.created) | Q(created=self.created, id__lt=self.id)
+        )
+        return ahead.count() + 1
+
+
+#The home page shows how many genres mention fantasy and how many books are called "Lord of the rings"
+FANTASY_GENRE_KEYWORD = 'Fantasy'
+LOTR_TITLE_KEYWORD = 'Lord of the rings'
+
+
+def is_fantasy_genre(name: str) -> bool:
+    """Python equivalent of Genre.objects.filter(name__icontains=FANTASY_GENRE_KEYWORD)"""
+    return bool(name) and FANTASY_GENRE_KEYWORD.lower() in name.lower()
+
+
+def is_lotr_book(title: str) -> bool:
+    """Python equivalent of Book.objects.filter(title__icontains=LOTR_TITLE_KEYWORD)"""
+    return bool(title) and LOTR_TITLE_KEYWORD.lower() in title.lower()
+
+
+def count_subquery(queryset) -> Subquery:
+    """Subquery counting the rows of the queryset, which can refer to the outer query with OuterRef"""
+    # Grouping by a constant leaves out the GROUP BY clause, so the subquery counts the whole queryset
+    counts = queryset.order_by().annotate(_all=Value(1)).values('_all').annotate(count=Count('pk')).values('count')
+    return Subquery(counts, output_field=models.IntegerField())
+
+
+class TableCount(Subquery):
+    """
+    COUNT of the rows of another queryset, for QuerySet.aggregate(), so that the counts of several tables
+    are computed in a single query. The subquery is not correlated to the outer query, so it is only evaluated once.
+    """
+    contains_aggregate = True
+
+    def __init__(self, queryset):
+        super().__init__(count_subquery(queryset).query, output_field=models.IntegerField())
+
+
+class CatalogStats(models.Model):
+    """
+    Model holding a materialized snapshot of the counts shown on the home page.
+    There is only ever a single row. It is kept up to date incrementally by the signal
+    handlers in catalog/signals.py so the home page can be served with one primary key lookup.
+    """
+    SINGLETON_ID = 1
+
+    num_books = models.IntegerField(default=0)
+    num_instances = models.IntegerField(default=0)
+    num_instances_available = models.IntegerField(default=0)
+    num_authors = models.IntegerField(default=0)
+    num_fantasy_genres = models.IntegerField(default=0)
+    num_lotr_books = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'catalog stats'
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'{self.num_books} books, {self.num_instances} copies, {self.num_authors} authors'
+
+    @classmethod
+    def compute(cls) -> dict:
+        """
+        Counts everything from scratch, in a single query. This scans the catalog tables so it should only be used
+        to (re)build the snapshot
+        """
+        return Book.objects.aggregate(
+            num_books=Count('pk'),
+            num_lotr_books=Count('pk', filter=Q(title__icontains=LOTR_TITLE_KEYWORD)),
+            num_instances=TableCount(BookInstance.objects.all()),
+            num_instances_available=TableCount(BookInstance.objects.filter(status__exact='a')),
+            num_authors=TableCount(Author.objects.all()),
+            num_fantasy_genres=TableCount(Genre.objects.filter(name__icontains=FANTASY_GENRE_KEYWORD)),
+        )
+
+    @classmethod
+    def rebuild(cls) -> 'CatalogStats':
+        """Recomputes the snapshot, e.g. after bulk operations that bypass signals (QuerySet.update, bulk_create)"""
+        stats, _ = cls.objects.update_or_create(pk=cls.SINGLETON_ID, defaults=cls.compute())
+        bump_version('catalogstats')
+        return stats
+
+    @classmethod
+    def load(cls) -> 'CatalogStats':
+        """Returns the snapshot, building it first if it does not exist yet"""
+        try:
+            return cls.objects.get(pk=cls.SINGLETON_ID)
+        except cls.DoesNotExist:
+            return cls.rebuild()
+
+    @classmethod
+    def increment(cls, **deltas: int) -> None:
+        """Atomically adds the given deltas to the counters, e.g. increment(num_books=1, num_lotr_books=-1)"""
+        deltas = {field: delta for field, delta in deltas.items() if delta}
+        if not deltas:
+            return
+        updated = cls.objects.filter(pk=cls.SINGLETON_ID).update(
+            **{field: F(field) + delta for field, delta in deltas.items()}
+        )
+        if not updated:
+            # The snapshot does not exist yet, building it will already include this change
+            cls.rebuild()
+            return
+        # Invalidates the counts cached by catalog_summary() (catalog/summary.py)
+        bump_version('catalogstats')
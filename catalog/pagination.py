@@ -0,0 +1,171 @@
+'''
+Pagination for the API viewsets and the HTML list views.
+
+Cursor (keyset) pagination for the API viewsets:
+
+Each page is fetched with a WHERE on the ordering fields instead of an OFFSET, so deep pages cost the same as the
+first one. The cursor holds the value of every ordering field of the last row of the page, and the last field is
+unique, so the next page starts right after that row even when many rows share the first field (DRF alone only
+keys the cursor on the first field and skips the ties with an OFFSET). The ordering fields must never be null.
+Clients can ask for a different page size with ?page_size=, up to max_page_size.
+
+The HTML list views show "Page X of Y", so they use CachedCountPaginator which avoids running a COUNT(*) on every page.
+'''
+import json
+from collections import OrderedDict
+from typing import List, Sequence
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+from .caching import cached_count
+from .models import Author, Book
+from .summary import catalog_summary
+
+
+class CatalogCursorPagination(CursorPagination):
+    '''Default pagination for the API, the page size comes from the PAGE_SIZE setting'''
+    ordering = ('id',)
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        offset, reverse, current_position = self.cursor or (0, False, None)
+
+        ordering = [self._reverse(field) for field in self.ordering] if reverse else list(self.ordering)
+        queryset = queryset.order_by(*ordering)
+        if current_position is not None:
+            queryset = queryset.filter(self._after(ordering, self._decode_position(current_position)))
+
+        #The row after the page tells whether there is a next page. The offset is always 0 in the cursors built here
+        results = list(queryset[offset:offset + self.page_size + 1])
+        self.page = results[:self.page_size]
+        following_position = self._get_position_from_instance(results[-1], self.ordering) if len(results) > len(self.page) else None
+
+        if reverse:
+            self.page.reverse()
+            self.has_next = current_position is not None or offset > 0
+            self.has_previous = following_position is not None
+            self.next_position, self.previous_position = current_position, following_position
+        else:
+            self.has_next = following_position is not None
+            self.has_previous = current_position is not None or offset > 0
+            self.next_position, self.previous_position = following_position, current_position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    def _get_position_from_instance(self, instance, ordering) -> str:
+        values = [instance[field.lstrip('-')] if isinstance(instance, dict) else getattr(instance, field.lstrip('-')) for field in ordering]
+        return json.dumps([str(value) for value in values])
+
+    def _decode_position(self, position: str) -> List[str]:
+        try:
+            values = json.loads(position)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return values
+
+    @staticmethod
+    def _reverse(field: str) -> str:
+        return field[1:] if field.startswith('-') else f'-{field}'
+
+    @staticmethod
+    def _after(ordering: Sequence[str], values: Sequence[str]) -> Q:
+        '''
+        The rows after the position in the ordering: (a > x) OR (a = x AND b > y) OR ...
+        The range on the first field is repeated on its own so that the database reads it from the index
+        '''
+        after = Q()
+        ties = Q()
+        for field, value in zip(ordering, values):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            after |= ties & Q(**{f'{name}__{lookup}': value})
+            ties &= Q(**{name: value})
+        first = ordering[0]
+        return Q(**{f'{first.lstrip("-")}__{"lte" if first.startswith("-") else "gte"}': values[0]}) & after
+
+
+class BookCursorPagination(CatalogCursorPagination):
+    ordering = ('title', 'id')
+
+
+class AuthorCursorPagination(CatalogCursorPagination):
+    ordering = ('last_name', 'first_name', 'id')
+
+
+class NameCursorPagination(CatalogCursorPagination):
+    '''Used for models that are identified by their name, i.e genres and languages'''
+    ordering = ('name', 'id')
+
+
+class BookInstanceCursorPagination(CatalogCursorPagination):
+    '''Copies by due date, read in order from the index of the loans. The copies listed must all have a due date'''
+    ordering = ('due_back', 'id')
+
+
+class OverdueCursorPagination(CatalogCursorPagination):
+    '''
+    The overdue loans, longest overdue first. Every page also has the number of overdue loans and of borrowers
+    they are lent to, cached until a copy changes (the date of the day is part of the cached query)
+    '''
+    #Overdue loans always have a due date
+    ordering = ('due_back', 'id')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = cached_count(queryset)
+        self.borrowers = cached_count(queryset.order_by().values('borrower').distinct())
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        response.data = OrderedDict([('count', self.count), ('borrowers', self.borrowers), *response.data.items()])
+        return response
+
+
+class CachedCountPaginator(Paginator):
+    '''
+    Paginator that does not run a COUNT(*) on every page. The number of all the books or all the authors comes from
+    the home page counts (catalog/summary.py), other querysets are counted once and cached until the next write to
+    their model
+    '''
+    #The counters of CatalogStats holding the number of rows of a model
+    stats_counters = {
+        Book: 'num_books',
+        Author: 'num_authors',
+    }
+
+    @cached_property
+    def count(self) -> int:
+        queryset = self.object_list
+        counter = self.stats_counters.get(getattr(queryset, 'model', None))
+        if counter is not None and not queryset.query.where and not queryset.query.combinator:
+            return catalog_summary()[counter]
+        return cached_count(queryset)
+
+
+class BookAvailabilityPagination(PageNumberPagination):
+    '''
+    The books with the most available copies first, by page number. The number of available copies has many
+    duplicates and changes as copies are lent, so a cursor on it would fall back to an offset anyway.
+    The total number of books comes from the cache like on the HTML list views
+    '''
+    ordering = ('-available_copies', 'title', 'id')
+    django_paginator_class = CachedCountPaginator
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return super().paginate_queryset(queryset.order_by(*self.ordering), request, view)
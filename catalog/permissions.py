@@ -1,8 +1,21 @@
 from rest_framework import permissions
-from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework.request import Request
 from rest_framework.views import APIView
-JWT_authenticator = JWTAuthentication()
+from .authentication import get_principal
+from .roles import is_librarian
+
+
+def is_active_librarian(request: Request) -> bool:
+    '''
+    Checks the librarian claim of the token that was validated by the authentication step.
+    Since tokens are only active for 5 minutes,
+    It is possible that within the time the token was created the user is no longer a librarian.
+    So the group membership is checked as well, using the cached lookup from catalog/roles.py.
+    '''
+    principal = get_principal(request)
+    if principal is not None and principal.is_librarian_claim:
+        return is_librarian(principal.user)
+    return False
 
 
 #Creating our own custom permission to allow only users in the librarian group to perfrom CRUD operations
@@ -18,39 +31,8 @@ class IsLibrarian(permissions.BasePermission):
             basically, if the user is performing a GET, HEAD, or OPTION request then they have the permission to do so
             '''
             return True
-        else:
-            response = JWT_authenticator.authenticate(request)
-            if response is not None:
-                # unpacking, we only need the token
-                _ , token = response
-                #Checking if the token mentions that the user is librarian
-                librarian_status = token.payload['isLibrarian']
-                '''
-                Since tokens are only active for 5 minutes,
-                It is possible that within the time the token was created the user is no longer a librarian.
-                '''
-                if librarian_status == True:
-                    if request.user.groups.filter(name="Librarians"):
-                        return True      
-        return False
+        return is_active_librarian(request)
 
 class OnlyLibrarians(permissions.BasePermission):
     def has_permission(self,request,view):
-        response = JWT_authenticator.authenticate(request)
-        if response is not None:
-            # unpacking, we only need the token
-            _ , token = response
-            #Checking if the token mentions that the user is librarian
-            librarian_status = token.payload['isLibrarian']
-            '''
-            Since tokens are only active for 5 minutes,
-            It is possible that within the time the token was created the user is no longer a librarian.
-            '''
-            if librarian_status == True:
-                if request.user.groups.filter(name="Librarians"):
-                    return True
-        return False
-
-
-
-
+        return is_active_librarian(request)
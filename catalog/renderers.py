@@ -0,0 +1,40 @@
+'''
+JSON renderer based on orjson, which encodes the large list responses several times faster than the standard library.
+
+orjson is optional: when it is not installed, or the response needs something orjson does not support
+(indented output for the browsable API, ASCII only output, integers over 64 bits), the renderer falls back to
+DRF's JSONRenderer. Both produce the same bytes for the same data, except for NaN and infinite floats
+which orjson writes as null where JSONRenderer raises an error.
+'''
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class ORJSONRenderer(JSONRenderer):
+    '''Drop-in replacement of JSONRenderer (see the DEFAULT_RENDERER_CLASSES setting)'''
+
+    def render(self, data, accepted_media_type=None, renderer_context=None) -> bytes:
+        if data is None:
+            return b''
+        renderer_context = renderer_context or {}
+        if orjson is None or not self.compact or self.ensure_ascii or self.get_indent(accepted_media_type, renderer_context):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        #Dates and times are passed to DRF's encoder, which formats them differently from orjson (e.g. 'Z' for UTC)
+        try:
+            ret = orjson.dumps(
+                data,
+                default=self.encoder_class().default,
+                option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME,
+            )
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        #Like JSONRenderer, escape the line and paragraph separators, which are not valid in javascript strings
+        if b'\xe2\x80\xa8' in ret or b'\xe2\x80\xa9' in ret:
+            ret = ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+        return ret
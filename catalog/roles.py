@@ -0,0 +1,66 @@
+'''
+Cached checks for the "Librarians" group.
+
+Membership is checked on every librarian-only API request and on every login, so the result is
+cached per user id in the cache named by LIBRARIAN_CACHE_ALIAS (API_CACHE_ALIAS by default).
+That cache must be shared by all the worker processes, otherwise a worker would keep granting the role
+after it was revoked on another one; when neither setting is set the database is queried every time.
+Entries are invalidated by the signal handlers in catalog/signals.py whenever the membership changes,
+and expire after LIBRARIAN_CACHE_TIMEOUT seconds in case a change did not go through the signals.
+'''
+from typing import Iterable, Optional
+from django.conf import settings
+from django.core.cache import caches, BaseCache
+from django.contrib.auth.models import User
+from django.db import transaction
+
+LIBRARIANS_GROUP = 'Librarians'
+
+
+def _shared_cache() -> Optional[BaseCache]:
+    alias = getattr(settings, 'LIBRARIAN_CACHE_ALIAS', None) or getattr(settings, 'API_CACHE_ALIAS', None)
+    if alias is None:
+        return None
+    return caches[alias]
+
+
+def _timeout() -> float:
+    return getattr(settings, 'LIBRARIAN_CACHE_TIMEOUT', 300)
+
+
+def _cache_key(user_id: int) -> str:
+    return f'catalog:is_librarian:{user_id}'
+
+
+def is_librarian(user: User) -> bool:
+    '''Returns whether the user is in the Librarians group, hitting the database only on a cache miss'''
+    if user is None or not user.is_authenticated:
+        return False
+
+    shared_cache = _shared_cache()
+    if shared_cache is None:
+        return user.groups.filter(name=LIBRARIANS_GROUP).exists()
+    membership = shared_cache.get(_cache_key(user.pk))
+    if membership is None:
+        membership = user.groups.filter(name=LIBRARIANS_GROUP).exists()
+        shared_cache.set(_cache_key(user.pk), membership, timeout=_timeout())
+    return membership
+
+
+def _delete(cache_keys: list) -> None:
+    shared_cache = _shared_cache()
+    if shared_cache is not None:
+        shared_cache.delete_many(cache_keys)
+
+
+def invalidate_librarian_cache(user_ids: Iterable[int]) -> None:
+    '''
+    Forgets the cached membership of the given users. The entries are deleted right away, so later checks
+    in the same transaction see the change, and again once the transaction commits, so that a membership
+    cached by another request in between (still read from before the commit) is not kept
+    '''
+    cache_keys = [_cache_key(user_id) for user_id in user_ids]
+    if not cache_keys:
+        return
+    _delete(cache_keys)
+    transaction.on_commit(lambda: _delete(cache_keys))
@@ -0,0 +1,185 @@
+'''
+Full-text search over the title and summary of books and the name of their author.
+
+The index depends on the database:
+    PostgreSQL: a tsvector column (search_vector) on the book table with a GIN index
+    SQLite: an FTS5 virtual table whose rowid is the id of the book
+    Other databases have no index, the search falls back to icontains filtering
+The index is created by a migration, kept in sync by the signal handlers in catalog/signals.py
+and can be rebuilt from scratch with `python manage.py rebuild_search_index`.
+'''
+import re
+from typing import Iterable, List, Optional, Tuple
+from django.conf import settings
+from django.db import connection as default_connection
+from django.db.models import Q
+
+BOOK_TABLE = 'catalog_book'
+AUTHOR_TABLE = 'catalog_author'
+SQLITE_FTS_TABLE = 'catalog_book_fts'
+POSTGRES_VECTOR_COLUMN = 'search_vector'
+POSTGRES_VECTOR_INDEX = 'catalog_book_search_vector_gin'
+
+#Number of book ids sent in a single statement when (re)indexing books
+INDEX_BATCH_SIZE = 500
+
+
+def search_backend(connection=None) -> Optional[str]:
+    '''Returns the kind of index used by the database, or None if the database has no full-text index'''
+    vendor = (connection or default_connection).vendor
+    if vendor in ('postgresql', 'sqlite'):
+        return vendor
+    return None
+
+
+def _text_search_config() -> str:
+    return getattr(settings, 'SEARCH_TEXT_CONFIG', 'english')
+
+
+def _batches(values: list) -> Iterable[list]:
+    for start in range(0, len(values), INDEX_BATCH_SIZE):
+        yield values[start:start + INDEX_BATCH_SIZE]
+
+
+def create_search_index(connection=None) -> None:
+    '''Creates the index structures and fills them with the existing books'''
+    connection = connection or default_connection
+    backend = search_backend(connection)
+    with connection.cursor() as cursor:
+        if backend == 'postgresql':
+            cursor.execute(f'ALTER TABLE {BOOK_TABLE} ADD COLUMN IF NOT EXISTS {POSTGRES_VECTOR_COLUMN} tsvector')
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS {POSTGRES_VECTOR_INDEX} ON {BOOK_TABLE} USING gin ({POSTGRES_VECTOR_COLUMN})'
+            )
+        elif backend == 'sqlite':
+            #The porter tokenizer lets "ring" match "rings"
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {SQLITE_FTS_TABLE} "
+                f"USING fts5(title, summary, author, tokenize='porter unicode61')"
+            )
+    rebuild_search_index(connection)
+
+
+def drop_search_index(connection=None) -> None:
+    connection = connection or default_connection
+    backend = search_backend(connection)
+    with connection.cursor() as cursor:
+        if backend == 'postgresql':
+            cursor.execute(f'DROP INDEX IF EXISTS {POSTGRES_VECTOR_INDEX}')
+            cursor.execute(f'ALTER TABLE {BOOK_TABLE} DROP COLUMN IF EXISTS {POSTGRES_VECTOR_COLUMN}')
+        elif backend == 'sqlite':
+            cursor.execute(f'DROP TABLE IF EXISTS {SQLITE_FTS_TABLE}')
+
+
+def _index_sql(backend: str, where: str) -> str:
+    '''Returns the statement that (re)computes the index entries of the books matching the where clause'''
+    author_name = "COALESCE(a.first_name || ' ' || a.last_name, '')"
+    if backend == 'postgresql':
+        #Matches in the title rank higher than matches in the author name, which rank higher than the summary
+        return (
+            f"UPDATE {BOOK_TABLE} AS b SET {POSTGRES_VECTOR_COLUMN} = "
+            f"setweight(to_tsvector(%s::regconfig, b.title), 'A') || "
+            f"setweight(to_tsvector(%s::regconfig, {author_name}), 'B') || "
+            f"setweight(to_tsvector(%s::regconfig, b.summary), 'C') "
+            f"FROM {BOOK_TABLE} AS book LEFT JOIN {AUTHOR_TABLE} AS a ON a.id = book.author_id "
+            f"WHERE b.id = book.id AND {where}"
+        )
+    return (
+        f"INSERT INTO {SQLITE_FTS_TABLE} (rowid, title, summary, author) "
+        f"SELECT b.id, b.title, b.summary, {author_name} "
+        f"FROM {BOOK_TABLE} AS b LEFT JOIN {AUTHOR_TABLE} AS a ON a.id = b.author_id "
+        f"WHERE {where}"
+    )
+
+
+def rebuild_search_index(connection=None) -> None:
+    '''Recomputes the index entries of every book'''
+    connection = connection or default_connection
+    backend = search_backend(connection)
+    with connection.cursor() as cursor:
+        if backend == 'postgresql':
+            config = _text_search_config()
+            cursor.execute(_index_sql(backend, '1 = 1'), [config, config, config])
+        elif backend == 'sqlite':
+            cursor.execute(f'DELETE FROM {SQLITE_FTS_TABLE}')
+            cursor.execute(_index_sql(backend, '1 = 1'))
+
+
+def index_books(book_ids: Iterable[int]) -> None:
+    '''Recomputes the index entries of the given books, e.g. after they or their author changed'''
+    backend = search_backend()
+    if backend is None:
+        return
+    book_ids = list(book_ids)
+    with default_connection.cursor() as cursor:
+        for batch in _batches(book_ids):
+            placeholders = ', '.join(['%s'] * len(batch))
+            where = f'b.id IN ({placeholders})'
+            if backend == 'postgresql':
+                config = _text_search_config()
+                cursor.execute(_index_sql(backend, where), [config, config, config, *batch])
+            else:
+                cursor.execute(f'DELETE FROM {SQLITE_FTS_TABLE} WHERE rowid IN ({placeholders})', batch)
+                cursor.execute(_index_sql(backend, where), batch)
+
+
+def unindex_books(book_ids: Iterable[int]) -> None:
+    '''Removes deleted books from the index. On PostgreSQL the entry is deleted along with the row'''
+    if search_backend() != 'sqlite':
+        return
+    book_ids = list(book_ids)
+    with default_connection.cursor() as cursor:
+        for batch in _batches(book_ids):
+            placeholders = ', '.join(['%s'] * len(batch))
+            cursor.execute(f'DELETE FROM {SQLITE_FTS_TABLE} WHERE rowid IN ({placeholders})', batch)
+
+
+def search_terms(query: str) -> List[str]:
+    '''Splits the query into words, dropping the characters that have a meaning in the query syntax'''
+    return re.findall(r'\w+', query)
+
+
+def search_books(query: str, limit: int, available_only: bool = False) -> List[Tuple[int, float]]:
+    '''
+    Returns the ids of the books matching every word of the query and their rank, best matches first.
+    available_only leaves out the books without an available copy
+    '''
+    terms = search_terms(query)
+    if not terms:
+        return []
+
+    backend = search_backend()
+    if backend is None:
+        from .models import Book
+        queryset = Book.objects.filter(available_copies__gt=0) if available_only else Book.objects.all()
+        for term in terms:
+            queryset = queryset.filter(
+                Q(title__icontains=term) | Q(summary__icontains=term) |
+                Q(author__first_name__icontains=term) | Q(author__last_name__icontains=term)
+            )
+        return [(book_id, 0.0) for book_id in queryset.values_list('id', flat=True)[:limit]]
+
+    available_filter = ''
+    with default_connection.cursor() as cursor:
+        if backend == 'postgresql':
+            if available_only:
+                available_filter = ' AND available_copies > 0'
+            cursor.execute(
+                f"SELECT id, ts_rank({POSTGRES_VECTOR_COLUMN}, query) AS rank "
+                f"FROM {BOOK_TABLE}, plainto_tsquery(%s::regconfig, %s) AS query "
+                f"WHERE {POSTGRES_VECTOR_COLUMN} @@ query{available_filter} "
+                f"ORDER BY rank DESC, id LIMIT %s",
+                [_text_search_config(), ' '.join(terms), limit],
+            )
+        else:
+            #bm25 is lower for better matches, the weights rank title matches above author and summary matches
+            fts_query = ' '.join(f'"{term}"' for term in terms)
+            if available_only:
+                available_filter = f' AND rowid IN (SELECT id FROM {BOOK_TABLE} WHERE available_copies > 0)'
+            cursor.execute(
+                f"SELECT rowid, bm25({SQLITE_FTS_TABLE}, 10.0, 1.0, 5.0) AS rank "
+                f"FROM {SQLITE_FTS_TABLE} WHERE {SQLITE_FTS_TABLE} MATCH %s{available_filter} "
+                f"ORDER BY rank, rowid LIMIT %s",
+                [fts_query, limit],
+            )
+        return [(book_id, float(rank)) for book_id, rank in cursor.fetchall()]
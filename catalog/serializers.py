@@ -1,6 +1,10 @@
+import datetime
+from typing import List
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
 from rest_framework import serializers
-from rest_framework.relations import StringRelatedField
-from catalog.models import Author, BookInstance, Book, Genre, Language
+from rest_framework.relations import ManyRelatedField, PrimaryKeyRelatedField, StringRelatedField
+from catalog.models import Author, BookInstance, Book, Genre, Hold, Language
 from django.contrib.auth.models import User, Group
 
 
@@ -31,6 +35,28 @@ class LanguageSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class ExpandableBookSerializer(BookSerializer):
+    '''
+    Book representation limited to the given fields (None for every field), where the related objects named in expand
+    are nested instead of being returned as primary keys. Used by the GET requests of the books api with ?fields=/?expand=
+    '''
+    EXPANDABLE_FIELDS = ('author', 'language', 'genre')
+
+    def __init__(self, *args, fields: List[str] = None, expand: List[str] = (), **kwargs):
+        super().__init__(*args, **kwargs)
+        nested = {
+            'author': lambda: AuthorSerializer(read_only=True),
+            'language': lambda: LanguageSerializer(read_only=True),
+            'genre': lambda: GenreSerializer(many=True, read_only=True),
+        }
+        for name in expand:
+            self.fields[name] = nested[name]()
+        if fields is not None:
+            for name in list(self.fields):
+                if name not in fields:
+                    self.fields.pop(name)
+
+
 # Register serializer
 class RegisterSerializer(serializers.ModelSerializer):
     '''Serializer for the Register view'''
@@ -77,4 +103,159 @@ class BookInstanceSerializer(serializers.ModelSerializer):
     class Meta:
         model = BookInstance
         fields = ['id','book','due_back','borrower']
-    
+
+
+class OverdueLoanSerializer(BookInstanceSerializer):
+    #Annotated by BookInstance.objects.overdue()
+    days_overdue = serializers.IntegerField(source='days_overdue.days', read_only=True)
+
+    class Meta:
+        model = BookInstance
+        fields = ['id','book','due_back','borrower','days_overdue']
+
+
+def validate_due_back(value: datetime.date) -> datetime.date:
+    '''The same rules as the renewal form (catalog/forms.py): not in the past and at most 4 weeks ahead'''
+    if value < datetime.date.today():
+        raise serializers.ValidationError('Invalid date - renewal in past')
+    if value > datetime.date.today() + datetime.timedelta(weeks=4):
+        raise serializers.ValidationError('Invalid date - renewal more than 4 weeks ahead')
+    return value
+
+
+class CheckoutSerializer(serializers.Serializer):
+    '''Request of the checkout api, either a book (any available copy of it is lent) or a specific copy'''
+    book = serializers.IntegerField(required=False)
+    copy = serializers.UUIDField(required=False)
+    borrower = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
+    due_back = serializers.DateField(required=False, validators=[validate_due_back])
+
+    def validate(self, attrs: dict) -> dict:
+        if ('book' in attrs) == ('copy' in attrs):
+            raise serializers.ValidationError('Either a book or a copy is required.')
+        return attrs
+
+
+class RenewSerializer(serializers.Serializer):
+    due_back = serializers.DateField(validators=[validate_due_back])
+
+
+class ReturnSerializer(serializers.Serializer):
+    '''Request of the api returning many copies at once'''
+    copies = serializers.ListField(child=serializers.UUIDField(), allow_empty=False, max_length=1000)
+
+
+class HoldSerializer(serializers.ModelSerializer):
+    book = serializers.PrimaryKeyRelatedField(queryset=Book.objects.all())
+    title = serializers.CharField(source='book.title', read_only=True)
+    status = serializers.CharField(read_only=True)
+    #Only set for waiting holds, 1 is the next one served
+    position = serializers.SerializerMethodField()
+    #The date until which the copy of a ready hold is kept for the patron
+    pickup_by = serializers.DateField(source='copy.due_back', read_only=True, default=None)
+
+    class Meta:
+        model = Hold
+        fields = ['id', 'book', 'title', 'status', 'created', 'position', 'pickup_by']
+        read_only_fields = ['created']
+
+    def get_position(self, hold: Hold):
+        return hold.queue_position()
+
+
+class BulkBookInstanceSerializer(serializers.Serializer):
+    '''A copy of a book in a bulk upload. Copies with the id of an existing copy are updated, the others are created'''
+    id = serializers.UUIDField(required=False)
+    imprint = serializers.CharField(max_length=200)
+    status = serializers.ChoiceField(choices=BookInstance.LOAN_STATUS, allow_blank=True, required=False)
+    due_back = serializers.DateField(allow_null=True, required=False)
+
+
+class BulkBookSerializer(serializers.Serializer):
+    '''
+    A book in a bulk upload, matched to existing books by ISBN.
+    Only the shape of the row is validated here, the foreign keys and uniqueness are checked
+    for all the rows at once by catalog/bulk.py so that validation does not cost a query per row.
+    '''
+    title = serializers.CharField(max_length=200)
+    summary = serializers.CharField(max_length=1000)
+    isbn = serializers.CharField(max_length=13)
+    author = serializers.IntegerField(allow_null=True, required=False)
+    language = serializers.IntegerField(allow_null=True, required=False)
+    genre = serializers.ListField(child=serializers.IntegerField(), required=False)
+    copies = BulkBookInstanceSerializer(many=True, required=False)
+
+
+class ValuesSerializer:
+    '''
+    Fast read-only version of a ModelSerializer for list responses.
+    The representation is built from QuerySet.values() rows instead of model instances, and the fields of the
+    ModelSerializer are only used to decide how every column is converted, once, instead of for every row.
+    The output is the same as the one of serializer_class(queryset, many=True).data
+    Supports the columns, foreign keys (as primary keys) and many to many fields (as lists of primary keys) of the model.
+    '''
+
+    #Serializer fields whose representation of a value read from the database is the value itself
+    IDENTITY_FIELDS = (serializers.IntegerField, serializers.CharField, PrimaryKeyRelatedField)
+
+    def __init__(self, serializer_class: type, fields: List[str] = None):
+        self.serializer_class = serializer_class
+        #Names of the fields to return, None for all the fields of the serializer
+        self.field_names = fields
+
+    @cached_property
+    def _fields(self) -> list:
+        '''(field name, source, converter) in the order of the serializer, the converter is None when there is nothing to convert'''
+        fields = []
+        for field in self.serializer_class()._readable_fields:
+            if self.field_names is not None and field.field_name not in self.field_names:
+                continue
+            if isinstance(field, ManyRelatedField):
+                converter = ManyRelatedField
+            elif type(field) in self.IDENTITY_FIELDS:
+                converter = None
+            else:
+                converter = field.to_representation
+            fields.append((field.field_name, field.source, converter))
+        return fields
+
+    @cached_property
+    def _columns(self) -> list:
+        return [(name, source, converter) for name, source, converter in self._fields if converter is not ManyRelatedField]
+
+    @cached_property
+    def _many_to_many(self) -> list:
+        '''(field name, model field) for every many to many field'''
+        model = self.serializer_class.Meta.model
+        return [
+            (name, model._meta.get_field(source))
+            for name, source, converter in self._fields if converter is ManyRelatedField
+        ]
+
+    def values(self, queryset: QuerySet, extra: List[str] = ()) -> QuerySet:
+        '''Returns a queryset of the rows needed by to_representation, with the extra columns (e.g. for pagination)'''
+        return queryset.prefetch_related(None).values(*dict.fromkeys(['pk', *(source for _, source, _ in self._columns), *extra]))
+
+    def to_representation(self, rows: list) -> List[dict]:
+        data = []
+        for row in rows:
+            item = {}
+            for name, source, converter in self._fields:
+                if converter is ManyRelatedField:
+                    #Filled in below, the key is added now to keep the order of the fields
+                    item[name] = None
+                    continue
+                value = row[source]
+                item[name] = value if converter is None or value is None else converter(value)
+            data.append(item)
+
+        #One query per many to many field for all the rows, like prefetch_related
+        for name, model_field in self._many_to_many:
+            related = {row['pk']: [] for row in rows}
+            related_query_name = model_field.related_query_name()
+            pairs = model_field.related_model.objects.filter(**{f'{related_query_name}__in': list(related)}).values_list(related_query_name, 'pk')
+            for pk, related_pk in pairs:
+                related[pk].append(related_pk)
+            for item, row in zip(data, rows):
+                item[name] = related[row['pk']]
+        return data
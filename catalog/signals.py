@@ -0,0 +1,306 @@
+'''
+Signal handlers used to keep denormalized data in sync with the catalog models.
+
+Note that QuerySet.update(), bulk_create() and raw SQL do not send these signals,
+so code that uses them must rebuild the affected data itself (e.g. CatalogStats.rebuild()).
+
+The CatalogStats deltas are computed from the row as it was before the save. Inside a transaction that row is read
+with SELECT ... FOR UPDATE, so concurrent saves of the same row are applied one after the other. Saves outside of a
+transaction can still race, the rebuild_catalog_stats command fixes the counters they leave behind.
+'''
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.contrib.auth.models import User, Group
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+from .models import (
+    Author,
+    Book,
+    BookInstance,
+    Genre,
+    Language,
+    CatalogStats,
+    is_fantasy_genre,
+    is_lotr_book,
+)
+from .roles import invalidate_librarian_cache
+from .search import index_books, unindex_books
+from .caching import bump_version
+from .blacklist import BLACKLIST_VERSION
+
+
+#The single field of each model that CatalogStats depends on (other than the row existing at all)
+STATS_TRACKED_FIELDS = {
+    Book: 'title',
+    BookInstance: 'status',
+    Genre: 'name',
+}
+
+
+def _stats_counters(instance) -> dict:
+    '''Returns how much a single row contributes to each CatalogStats counter'''
+    if isinstance(instance, Book):
+        return {'num_books': 1, 'num_lotr_books': int(is_lotr_book(instance.title))}
+    if isinstance(instance, BookInstance):
+        return {'num_instances': 1, 'num_instances_available': int(instance.status == 'a')}
+    if isinstance(instance, Genre):
+        return {'num_fantasy_genres': int(is_fantasy_genre(instance.name))}
+    if isinstance(instance, Author):
+        return {'num_authors': 1}
+    return {}
+
+
+@receiver(pre_save, sender=Book)
+@receiver(pre_save, sender=BookInstance)
+@receiver(pre_save, sender=Genre)
+def remember_stats_fields(sender, instance, update_fields=None, using=None, **kwargs):
+    '''Stores the value of the tracked fields as they are in the database, before they get overwritten'''
+    fields = [STATS_TRACKED_FIELDS[sender]]
+    if sender is BookInstance:
+        #The copy counters of Book also depend on the book of the copy
+        fields.append('book')
+    instance._stats_previous = None
+    instance._copy_previous = None
+    if instance._state.adding:
+        return
+    if update_fields is not None and not set(fields).intersection(update_fields):
+        return
+    queryset = sender.objects.using(using).filter(pk=instance.pk)
+    if transaction.get_connection(using).in_atomic_block:
+        #The row stays locked until the save is committed, so no other save can change it in between
+        queryset = queryset.select_for_update()
+    previous = queryset.values_list(*fields).first()
+    if previous is None:
+        return
+    instance._stats_previous = previous[0]
+    if sender is BookInstance:
+        instance._copy_previous = previous
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_save, sender=BookInstance)
+@receiver(post_save, sender=Genre)
+@receiver(post_save, sender=Author)
+def update_stats_on_save(sender, instance, created, update_fields=None, **kwargs):
+    if created:
+        CatalogStats.increment(**_stats_counters(instance))
+        return
+
+    field = STATS_TRACKED_FIELDS.get(sender)
+    if field is None or (update_fields is not None and field not in update_fields):
+        return
+    previous = getattr(instance, '_stats_previous', None)
+    if previous is None:
+        # We do not know what the row looked like before so we cannot compute a delta
+        CatalogStats.rebuild()
+        return
+
+    current = getattr(instance, field)
+    if previous == current:
+        return
+    old_instance = sender(**{field: previous})
+    old_counters = _stats_counters(old_instance)
+    new_counters = _stats_counters(instance)
+    CatalogStats.increment(**{
+        counter: new_counters[counter] - old_counters[counter] for counter in new_counters
+    })
+
+
+@receiver(post_delete, sender=Book)
+@receiver(post_delete, sender=BookInstance)
+@receiver(post_delete, sender=Genre)
+@receiver(post_delete, sender=Author)
+def update_stats_on_delete(sender, instance, **kwargs):
+    CatalogStats.increment(**{
+        counter: -value for counter, value in _stats_counters(instance).items()
+    })
+
+
+def _copy_counters(book_id, status) -> dict:
+    '''Returns how much a copy contributes to the counters of its book'''
+    return {'total': 1, 'available': int(status == 'a')} if book_id is not None else {'total': 0, 'available': 0}
+
+
+def _add_copy_counters(book_id, counters: dict, sign: int = 1) -> None:
+    if book_id is None or not any(counters.values()):
+        return
+    Book.add_copies(book_id, total=sign * counters['total'], available=sign * counters['available'])
+    #The counters are part of the representation of the book
+    bump_version('book')
+
+
+@receiver(post_save, sender=BookInstance)
+def update_copy_counters_on_save(sender, instance, created, update_fields=None, **kwargs):
+    '''Keeps Book.total_copies and Book.available_copies up to date with F() expressions, without counting the copies'''
+    if created:
+        _add_copy_counters(instance.book_id, _copy_counters(instance.book_id, instance.status))
+        return
+    if update_fields is not None and not {'book', 'status'}.intersection(update_fields):
+        return
+    previous = getattr(instance, '_copy_previous', None)
+    if previous is None:
+        #The row did not exist before (e.g. it was saved with an explicit primary key)
+        Book.update_copy_counters([instance.book_id])
+        bump_version('book')
+        return
+
+    previous_status, previous_book_id = previous
+    old_counters = _copy_counters(previous_book_id, previous_status)
+    new_counters = _copy_counters(instance.book_id, instance.status)
+    if previous_book_id == instance.book_id:
+        _add_copy_counters(instance.book_id, {counter: new_counters[counter] - old_counters[counter] for counter in new_counters})
+        return
+    _add_copy_counters(previous_book_id, old_counters, sign=-1)
+    _add_copy_counters(instance.book_id, new_counters)
+
+
+def record_status_change(copy: BookInstance, previous_status: str) -> None:
+    '''
+    Does what the handlers of post_save do for a copy whose status was changed with QuerySet.update(),
+    e.g. by the conditional updates of catalog/loans.py
+    '''
+    if previous_status != copy.status:
+        old_counters = _stats_counters(BookInstance(status=previous_status))
+        new_counters = _stats_counters(copy)
+        CatalogStats.increment(**{counter: new_counters[counter] - old_counters[counter] for counter in new_counters})
+        old_counters = _copy_counters(copy.book_id, previous_status)
+        new_counters = _copy_counters(copy.book_id, copy.status)
+        _add_copy_counters(copy.book_id, {counter: new_counters[counter] - old_counters[counter] for counter in new_counters})
+    bump_version('bookinstance')
+
+
+@receiver(post_delete, sender=BookInstance)
+def update_copy_counters_on_delete(sender, instance, **kwargs):
+    _add_copy_counters(instance.book_id, _copy_counters(instance.book_id, instance.status), sign=-1)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_librarian_cache_on_membership_change(sender, instance, action, reverse, pk_set, **kwargs):
+    '''Keeps the cache in catalog/roles.py correct when users are added to or removed from groups'''
+    if not reverse:
+        # user.groups.add(...), user.groups.remove(...), user.groups.clear()
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            invalidate_librarian_cache([instance.pk])
+    elif action == 'pre_clear':
+        # group.user_set.clear() does not tell us which users were removed, so remember them first
+        instance._librarian_cache_members = list(instance.user_set.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        invalidate_librarian_cache(getattr(instance, '_librarian_cache_members', []))
+    elif action in ('post_add', 'post_remove'):
+        # group.user_set.add(...), group.user_set.remove(...)
+        invalidate_librarian_cache(pk_set)
+
+
+@receiver(post_save, sender=Group)
+def invalidate_librarian_cache_on_group_save(sender, instance, created, **kwargs):
+    '''A group that was renamed to or from "Librarians" changes the role of all of its members'''
+    if not created:
+        invalidate_librarian_cache(instance.user_set.values_list('pk', flat=True))
+
+
+@receiver(pre_delete, sender=Group)
+def remember_group_members(sender, instance, **kwargs):
+    instance._librarian_cache_members = list(instance.user_set.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Group)
+def invalidate_librarian_cache_on_group_delete(sender, instance, **kwargs):
+    invalidate_librarian_cache(getattr(instance, '_librarian_cache_members', []))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_librarian_cache_on_user_change(sender, instance, **kwargs):
+    '''User ids can be reused (e.g. after a rollback) so new and deleted users must not keep an old entry'''
+    invalidate_librarian_cache([instance.pk])
+
+
+#The fields of a book that are part of its full-text search entry
+SEARCH_INDEXED_FIELDS = {'title', 'summary', 'author'}
+
+
+@receiver(post_save, sender=Book)
+def update_search_index_on_book_save(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not SEARCH_INDEXED_FIELDS.intersection(update_fields):
+        return
+    index_books([instance.pk])
+
+
+@receiver(post_delete, sender=Book)
+def update_search_index_on_book_delete(sender, instance, **kwargs):
+    unindex_books([instance.pk])
+
+
+@receiver(post_save, sender=Author)
+def update_search_index_on_author_save(sender, instance, created, **kwargs):
+    '''The name of the author is part of the search entry of each of their books'''
+    if not created:
+        index_books(instance.book_set.values_list('pk', flat=True))
+
+
+@receiver(pre_delete, sender=Author)
+def remember_author_books(sender, instance, **kwargs):
+    instance._search_book_ids = list(instance.book_set.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Author)
+def update_search_index_on_author_delete(sender, instance, **kwargs):
+    # The books of a deleted author are kept without an author
+    index_books(getattr(instance, '_search_book_ids', []))
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+@receiver(post_save, sender=Author)
+@receiver(post_delete, sender=Author)
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+@receiver(post_save, sender=Language)
+@receiver(post_delete, sender=Language)
+@receiver(post_save, sender=BookInstance)
+@receiver(post_delete, sender=BookInstance)
+def invalidate_cached_representations(sender, instance, **kwargs):
+    '''Invalidates the cached API responses and counts of the model (see catalog/caching.py)'''
+    bump_version(sender._meta.model_name)
+
+
+@receiver(post_delete, sender=User)
+def invalidate_cached_loans(sender, instance, **kwargs):
+    '''Deleting a user removes them as the borrower of their books without sending signals for the copies'''
+    bump_version('bookinstance')
+
+
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Genre)
+@receiver(post_delete, sender=Language)
+def invalidate_cached_books(sender, instance, **kwargs):
+    '''Deleting an author, genre or language changes the books that refer to it without sending signals for them'''
+    bump_version('book')
+
+
+@receiver(m2m_changed, sender=Book.genre.through)
+def invalidate_cached_books_on_genre_change(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_version('book')
+
+
+@receiver(post_save, sender=BlacklistedToken)
+def invalidate_cached_blacklist(sender, instance, created, **kwargs):
+    '''Makes every worker reload the blacklisted refresh tokens it keeps in memory (see catalog/blacklist.py)'''
+    if created:
+        bump_version(BLACKLIST_VERSION)
+
+
+#Registered after the handlers that count the copies, which the reservation of the copy then updates
+@receiver(post_save, sender=BookInstance)
+def serve_waiting_holds_on_save(sender, instance, created, update_fields=None, **kwargs):
+    '''A copy that becomes available (e.g. added or edited in the admin) goes to the patrons waiting for its book'''
+    if instance.status != 'a' or instance.book_id is None:
+        return
+    if update_fields is not None and not {'book', 'status'}.intersection(update_fields):
+        return
+    if not created and getattr(instance, '_copy_previous', None) == ('a', instance.book_id):
+        return
+    #catalog/loans.py imports this module
+    from .loans import serve_waiting_holds
+    serve_waiting_holds([instance.book_id])
@@ -0,0 +1,55 @@
+'''
+The counts shown on the home page, used by both index() and HomePageApiView.
+
+The counts come from the materialized snapshot (CatalogStats), which takes one query, and are cached for
+CATALOG_SUMMARY_CACHE_TIMEOUT seconds in the cache CATALOG_SUMMARY_CACHE_ALIAS (the API cache by default), so most
+home page requests do not touch the database. The cache key contains the version of the snapshot, bumped whenever
+its counters change, so the cached counts are replaced as soon as the catalog changes; the timeout only bounds how
+long a change can take to show up. The version lives in the API cache, so nothing is cached unless API_CACHE_ALIAS
+names a cache shared by the worker processes (see catalog/caching.py).
+Set CATALOG_SUMMARY_CACHE_TIMEOUT to 0 to read the snapshot on every request.
+'''
+from django.conf import settings
+from django.core.cache import caches, BaseCache
+from catalog.caching import caching_enabled, get_version
+from catalog.models import CatalogStats
+
+SUMMARY_FIELDS = (
+    'num_books',
+    'num_instances',
+    'num_instances_available',
+    'num_authors',
+    'num_fantasy_genres',
+    'num_lotr_books',
+)
+
+
+def _cache() -> BaseCache:
+    alias = getattr(settings, 'CATALOG_SUMMARY_CACHE_ALIAS', None) or settings.API_CACHE_ALIAS
+    return caches[alias]
+
+
+def _cache_timeout() -> float:
+    return getattr(settings, 'CATALOG_SUMMARY_CACHE_TIMEOUT', 5)
+
+
+def _load_summary() -> dict:
+    #When the snapshot does not exist yet it is built with a single aggregate query (CatalogStats.compute)
+    stats = CatalogStats.load()
+    return {field: getattr(stats, field) for field in SUMMARY_FIELDS}
+
+
+def catalog_summary() -> dict:
+    '''Returns the counts of books, copies, available copies, authors, fantasy genres and Lord of the Rings books'''
+    timeout = _cache_timeout()
+    if not timeout or not caching_enabled():
+        return _load_summary()
+
+    version, _ = get_version('catalogstats')
+    cache = _cache()
+    cache_key = f'catalog:summary:{version}'
+    summary = cache.get(cache_key)
+    if summary is None:
+        summary = _load_summary()
+        cache.set(cache_key, summary, timeout=timeout)
+    return summary
@@ -1,18 +1,55 @@
 from unittest.case import expectedFailure
 from django.http import response
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from rest_framework.test import APIClient, APITestCase
 from catalog.models import (
     Author, 
     Book, 
     BookInstance, 
     Genre, 
+    Hold,
     Language,
 )
 import datetime
 from django.contrib.auth.models import User, Group
 from http import HTTPStatus
 from rest_framework.reverse import reverse
+from unittest import mock
+from django.core.management import call_command
+from catalog.authentication import PrincipalJWTAuthentication
+from catalog.blacklist import is_blacklisted
+from catalog import loans
+from catalog.loans import LoanError, reset_lock_stats
+from catalog.renderers import ORJSONRenderer
+from catalog.parsers import ORJSONParser
+from catalog.serializers import AuthorSerializer, BookSerializer, GenreSerializer, LanguageSerializer, ValuesSerializer
+from rest_framework.renderers import JSONRenderer
+from rest_framework.exceptions import ParseError
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.utils import aware_utcnow
+import csv
+import decimal
+import io
+import json
+import uuid
+from django.db import OperationalError, connection
+from django.db.models import QuerySet
+from django.test.utils import CaptureQueriesContext
+from django.core.cache import cache
+
+
+class TokenLoginMixin:
+    '''Obtains JWT tokens for the test client, the way the frontend does'''
+    def obtain_tokens(self, username, password) -> dict:
+        response = self.client.post(reverse('token_obtain_pair'), {'username': username, 'password': password}, format='json')
+        return response.json()
+
+    def login(self, username, password) -> dict:
+        '''Sends the access token of the user with the following requests'''
+        tokens = self.obtain_tokens(username, password)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens["access"]}')
+        return tokens
+
 
 class AuthorAPIViewTest(APITestCase):
     '''This class tests the author CRUD api'''
@@ -69,7 +106,8 @@ class AuthorAPIViewTest(APITestCase):
             }
         ]
 
-        self.assertEqual(response_body,expected_response)
+        #The list is paginated, the authors are in the results of the first page
+        self.assertEqual(response_body['results'],expected_response)
 
     def test_read_author_id_api_response(self):
         '''Tests to see if the get request to author id 1 returns 200 or not'''
@@ -872,6 +910,52 @@ class HomePageApiTest(APITestCase):
 
         self.assertEqual(response_body,expected_response)
 
+    def test_homepage_uses_single_query(self):
+        '''The counts come from the materialized CatalogStats row, so the page costs one primary key lookup'''
+        with self.assertNumQueries(1):
+            response = self.client.get('http://127.0.0.1:8000/catalog/api/home')
+        self.assertEqual(response.status_code,200)
+
+    #The cache is only used when it is shared by the worker processes
+    @override_settings(API_CACHE_ALIAS='default')
+    def test_homepage_counts_are_cached(self):
+        '''The counts are cached until the catalog changes (see catalog/summary.py)'''
+        self.client.get('http://127.0.0.1:8000/catalog/api/home')
+        with self.assertNumQueries(0):
+            response = self.client.get('http://127.0.0.1:8000/catalog/api/home')
+        self.assertEqual(response.json()['num_books'],8)
+
+        Book.objects.get(title='Lord of the rings').delete()
+        response = self.client.get('http://127.0.0.1:8000/catalog/api/home')
+        self.assertEqual(response.json()['num_books'],7)
+        self.assertEqual(response.json()['num_lotr_books'],0)
+
+    def test_homepage_counts_without_cache(self):
+        self.client.get('http://127.0.0.1:8000/catalog/api/home')
+        with self.settings(CATALOG_SUMMARY_CACHE_TIMEOUT=0), self.assertNumQueries(1):
+            response = self.client.get('http://127.0.0.1:8000/catalog/api/home')
+        self.assertEqual(response.json()['num_instances'],14)
+
+    def test_homepage_response_body_after_changes(self):
+        '''Testing whether the counts follow updates and deletes'''
+        lotr_book = Book.objects.get(title='Lord of the rings')
+        lotr_book.title = 'The Hobbit'
+        lotr_book.save()
+
+        available_instance = BookInstance.objects.filter(status__exact='a').first()
+        available_instance.status = 'o'
+        available_instance.save()
+
+        Genre.objects.filter(name__icontains='Fantasy').first().delete()
+
+        response = self.client.get('http://127.0.0.1:8000/catalog/api/home')
+        response_body = response.json()
+
+        self.assertEqual(response_body['num_lotr_books'],0)
+        self.assertEqual(response_body['num_instances_available'],8)
+        self.assertEqual(response_body['num_fantasy_genres'],1)
+        self.assertEqual(response_body['num_books'],8)
+
     def test_homepage_response_with_librarian_authorization(self):
         '''Testing the response when the user is authorized as a librarian and makes a GET request'''
         user_credentials = {
@@ -1615,6 +1699,8 @@ class BookAPIViewTest(TestCase):
                 "title":'Book Title',
                 "summary":'My book summary',
                 "isbn":"1234567891234",
+                "total_copies":0,
+                "available_copies":0,
                 "author":None,
                 "language":None,
                 "genre":[
@@ -1626,6 +1712,8 @@ class BookAPIViewTest(TestCase):
                 "title":'Book Title 2',
                 "summary":'My book summary',
                 "isbn":"1234567891235",
+                "total_copies":0,
+                "available_copies":0,
                 "author":None,
                 "language":None,
                 "genre":[
@@ -1634,7 +1722,8 @@ class BookAPIViewTest(TestCase):
             }
         ]
 
-        self.assertEqual(response_body, expected_response)
+        #The list is paginated, the books are in the results of the first page
+        self.assertEqual(response_body['results'], expected_response)
 
     def test_create_book_status_without_authorization(self):
         client = APIClient()
@@ -1754,6 +1843,8 @@ class BookAPIViewTest(TestCase):
                 "title":'book_title_3',
                 "summary":'summary2',
                 "isbn":"1234567891248",
+                "total_copies":0,
+                "available_copies":0,
                 "author":None,
                 "language":None,
                 "genre":[
@@ -1785,6 +1876,8 @@ class BookAPIViewTest(TestCase):
             "title":'Book Title',
             "summary":'My book summary',
             "isbn":"1234567891234",
+            "total_copies":0,
+            "available_copies":0,
             "author":None,
             "language":None,
             "genre":[
@@ -2433,15 +2526,16 @@ class AllBorrowedBooksAPIViewTest(APITestCase):
                 "due_back": return_date_2,
                 "borrower": "testuser1"
             },
+            #Instances due on the same day are ordered by their id
             {
-                "id": book2_uuids+'1',
-                "book": "Book Title 2",
+                "id": book3_uuids+'0',
+                "book": "Book Title 3",
                 "due_back": return_date_3,
                 "borrower": "testuser2"
             },
             {
-                "id": book3_uuids+'0',
-                "book": "Book Title 3",
+                "id": book2_uuids+'1',
+                "book": "Book Title 2",
                 "due_back": return_date_3,
                 "borrower": "testuser2"
             },
@@ -2459,6 +2553,1364 @@ class AllBorrowedBooksAPIViewTest(APITestCase):
             }
         ]
 
-        self.assertEqual(response_body,expected_response)
+        #The list is paginated, the book instances are in the results of the first page
+        self.assertEqual(response_body['results'],expected_response)
+
+
+
+
+class PrincipalAuthenticationTest(TokenLoginMixin, APITestCase):
+    '''Tests that the token is decoded and the user fetched only once per request'''
+    def setUp(self):
+        test_user1 = User.objects.create_user(username='testuser1', password='1X<ISRUkw+tuK')
+        test_user2 = User.objects.create_user(username='testuser2', password='2HJ1vRV0Z&3iD')
+        librarian_group = Group.objects.create(name="Librarians")
+        librarian_group.user_set.add(test_user1)
+        Author.objects.create(first_name='John', last_name='Smith')
+
+    def count_authentication_calls(self):
+        '''Wraps the token decoding and user lookup of the authentication class with call counters'''
+        decode = mock.patch.object(
+            PrincipalJWTAuthentication,
+            'get_validated_token',
+            autospec=True,
+            side_effect=PrincipalJWTAuthentication.get_validated_token,
+        )
+        lookup = mock.patch.object(
+            PrincipalJWTAuthentication,
+            'get_user',
+            autospec=True,
+            side_effect=PrincipalJWTAuthentication.get_user,
+        )
+        return decode, lookup
+
+    def test_librarian_write_decodes_token_once(self):
+        self.login('testuser1', '1X<ISRUkw+tuK')
+        decode, lookup = self.count_authentication_calls()
+        with decode as decode_mock, lookup as lookup_mock:
+            response = self.client.post(
+                reverse('author-api-list'),
+                {'first_name': 'Jane', 'last_name': 'Doe'},
+                format='json'
+            )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(decode_mock.call_count, 1)
+        self.assertEqual(lookup_mock.call_count, 1)
+
+    def test_only_librarians_decodes_token_once(self):
+        self.login('testuser1', '1X<ISRUkw+tuK')
+        decode, lookup = self.count_authentication_calls()
+        with decode as decode_mock, lookup as lookup_mock:
+            response = self.client.get(reverse('borrowed-books-api-list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(decode_mock.call_count, 1)
+        self.assertEqual(lookup_mock.call_count, 1)
+
+    def test_user_borrowed_books_decodes_token_once(self):
+        self.login('testuser2', '2HJ1vRV0Z&3iD')
+        user_id = User.objects.get(username='testuser2').id
+        decode, lookup = self.count_authentication_calls()
+        with decode as decode_mock, lookup as lookup_mock:
+            response = self.client.get(reverse('mybooks-api', args=[user_id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(decode_mock.call_count, 1)
+        self.assertEqual(lookup_mock.call_count, 1)
+
+    def test_user_borrowed_books_of_other_user(self):
+        self.login('testuser2', '2HJ1vRV0Z&3iD')
+        user_id = User.objects.get(username='testuser1').id
+        response = self.client.get(reverse('mybooks-api', args=[user_id]))
+        self.assertEqual(response.status_code, 401)
+
+    def test_normal_user_write_is_forbidden(self):
+        self.login('testuser2', '2HJ1vRV0Z&3iD')
+        response = self.client.post(
+            reverse('author-api-list'),
+            {'first_name': 'Jane', 'last_name': 'Doe'},
+            format='json'
+        )
+        self.assertEqual(response.status_code, 403)
+
+
+class CursorPaginationTest(APITestCase):
+    '''Tests the cursor pagination used by the list endpoints of the API'''
+    def setUp(self):
+        number_of_books = 7
+        for book_id in range(number_of_books):
+            Book.objects.create(
+                title=f'Book Title {book_id % 3}',
+                summary='My book summary',
+                isbn=f'ABCDEF {book_id}',
+            )
+
+    def get_all_pages(self, url):
+        titles = []
+        pages = 0
+        while url is not None:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            response_body = response.json()
+            titles += [(book['title'], book['id']) for book in response_body['results']]
+            url = response_body['next']
+            pages += 1
+        return titles, pages
+
+    def test_page_size_parameter(self):
+        response = self.client.get(reverse('book-api-list') + '?page_size=2')
+        response_body = response.json()
+        self.assertEqual(len(response_body['results']), 2)
+        self.assertIsNotNone(response_body['next'])
+        self.assertIsNone(response_body['previous'])
+
+    def test_pages_cover_all_books_in_order(self):
+        '''Books with the same title are ordered by id and none are skipped or repeated between pages'''
+        books, pages = self.get_all_pages(reverse('book-api-list') + '?page_size=2')
+        expected_books = list(Book.objects.order_by('title', 'id').values_list('title', 'id'))
+        self.assertEqual(books, expected_books)
+        self.assertEqual(pages, 4)
+
+    def test_next_page_does_not_use_offset(self):
+        '''When the first ordering field is unique the next page is found with a WHERE instead of an OFFSET'''
+        for genre_id in range(5):
+            Genre.objects.create(name=f'Genre {genre_id}')
+        response = self.client.get(reverse('genre-api-list') + '?page_size=2')
+        next_url = response.json()['next']
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(next_url)
+        self.assertTrue(all('OFFSET' not in query['sql'] for query in context.captured_queries))
+
+
+    def test_copies_without_due_date(self):
+        '''The copies on loan without a due date are left out of the list by due date and listed on their own'''
+        Group.objects.create(name='Librarians')
+        librarian = User.objects.create_user(username='librarian', password='1X<ISRUkw+tuK')
+        Group.objects.get(name='Librarians').user_set.add(librarian)
+        book = Book.objects.first()
+        dated = BookInstance.objects.create(book=book, imprint='Imprint', status='o', borrower=librarian, due_back=datetime.date.today())
+        undated = [
+            BookInstance.objects.create(book=book, imprint='Imprint', status='o', borrower=librarian, due_back=None)
+            for _ in range(2)
+        ]
+        response = self.client.post(reverse('token_obtain_pair'), {'username': 'librarian', 'password': '1X<ISRUkw+tuK'}, format='json')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {response.json()["access"]}')
+        response = self.client.get(reverse('borrowed-books-api-list'))
+        self.assertEqual([copy['id'] for copy in response.json()['results']], [str(dated.id)])
+        response = self.client.get(reverse('borrowed-books-api-without-due-date'))
+        self.assertEqual([copy['id'] for copy in response.json()['results']], sorted(str(copy.id) for copy in undated))
+
+    def test_ties_on_the_first_field_do_not_use_offset(self):
+        '''The cursor holds every ordering field, so copies due back the same day do not make the next page skip them with an OFFSET'''
+        Group.objects.create(name='Librarians')
+        librarian = User.objects.create_user(username='librarian', password='1X<ISRUkw+tuK')
+        Group.objects.get(name='Librarians').user_set.add(librarian)
+        book = Book.objects.first()
+        copies = [
+            BookInstance.objects.create(book=book, imprint='Imprint', status='o', borrower=librarian, due_back=datetime.date.today() + datetime.timedelta(days=day // 3))
+            for day in range(7)
+        ]
+        response = self.client.post(reverse('token_obtain_pair'), {'username': 'librarian', 'password': '1X<ISRUkw+tuK'}, format='json')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {response.json()["access"]}')
+        copy_ids = []
+        url = reverse('borrowed-books-api-list') + '?page_size=2'
+        with CaptureQueriesContext(connection) as context:
+            while url is not None:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, HTTPStatus.OK)
+                copy_ids += [copy['id'] for copy in response.json()['results']]
+                url = response.json()['next']
+        expected = sorted(copies, key=lambda copy: (copy.due_back, str(copy.id)))
+        self.assertEqual(copy_ids, [str(copy.id) for copy in expected])
+        self.assertTrue(all('OFFSET' not in query['sql'] for query in context.captured_queries))
+
+        #Back to the first page
+        response = self.client.get(response.json()['previous'])
+        while response.json()['previous'] is not None:
+            response = self.client.get(response.json()['previous'])
+        self.assertEqual([copy['id'] for copy in response.json()['results']], [str(copy.id) for copy in expected[:2]])
+
+
+class ListQueryCountTest(APITestCase):
+    '''
+    Tests that the number of queries used by the list endpoints does not grow with the number of rows.
+    Every endpoint is requested once with a few rows and once with more rows, and both must use the same number of queries.
+    '''
+    def setUp(self):
+        self.librarian = User.objects.create_user(username='testuser1', password='1X<ISRUkw+tuK')
+        librarian_group = Group.objects.create(name="Librarians")
+        librarian_group.user_set.add(self.librarian)
+        self.genres = [Genre.objects.create(name=f'Genre {genre_id}') for genre_id in range(3)]
+        self.language = Language.objects.create(name='English')
+        self.rows_created = 0
+
+        response = self.client.post(
+            reverse('token_obtain_pair'),
+            {"username": "testuser1", "password": "1X<ISRUkw+tuK"},
+            format="json"
+        )
+        access_token = response.json()['access']
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access_token}')
+
+    def create_rows(self, number_of_rows):
+        '''Creates authors with a book each, and a borrowed copy of every book'''
+        for _ in range(number_of_rows):
+            row_id = self.rows_created
+            self.rows_created += 1
+            author = Author.objects.create(first_name=f'First {row_id}', last_name=f'Last {row_id}')
+            book = Book.objects.create(
+                title=f'Book Title {row_id}',
+                summary='My book summary',
+                isbn=f'ISBN {row_id}',
+                author=author,
+                language=self.language,
+            )
+            book.genre.set(self.genres)
+            BookInstance.objects.create(
+                book=book,
+                imprint='Some imprint',
+                status='o',
+                borrower=self.librarian,
+                due_back=datetime.date.today() + datetime.timedelta(days=row_id),
+            )
+
+    def count_queries(self, url):
+        #Measuring the queries of building the response, not of serving it from the response cache
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def assertConstantQueries(self, url):
+        self.create_rows(2)
+        #The first request fills the per-process caches (e.g. the librarian group membership)
+        self.count_queries(url)
+        queries_with_few_rows = self.count_queries(url)
+        self.create_rows(8)
+        queries_with_more_rows = self.count_queries(url)
+        self.assertEqual(queries_with_few_rows, queries_with_more_rows)
+
+    def test_book_list(self):
+        self.assertConstantQueries(reverse('book-api-list'))
+
+    def test_author_list(self):
+        self.assertConstantQueries(reverse('author-api-list'))
+
+    def test_genre_list(self):
+        self.assertConstantQueries(reverse('genre-api-list'))
+
+    def test_language_list(self):
+        self.assertConstantQueries(reverse('language-api-list'))
+
+    def test_all_borrowed_books_list(self):
+        self.assertConstantQueries(reverse('borrowed-books-api-list'))
+
+    def test_user_borrowed_books_list(self):
+        self.assertConstantQueries(reverse('mybooks-api', args=[self.librarian.id]))
+
+
+class CatalogExportApiTest(TokenLoginMixin, APITestCase):
+    '''Tests the streaming export of the catalog'''
+    def setUp(self):
+        test_user1 = User.objects.create_user(username='testuser1', password='1X<ISRUkw+tuK')
+        User.objects.create_user(username='testuser2', password='2HJ1vRV0Z&3iD')
+        librarian_group = Group.objects.create(name="Librarians")
+        librarian_group.user_set.add(test_user1)
+
+        test_author = Author.objects.create(first_name='John', last_name='Smith')
+        test_language = Language.objects.create(name='English')
+        fantasy = Genre.objects.create(name='Fantasy')
+        horror = Genre.objects.create(name='Horror')
+
+        self.books = []
+        for book_id in range(5):
+            book = Book.objects.create(
+                title=f'Book Title {book_id}',
+                summary='My book summary',
+                isbn=f'ABCDEF {book_id}',
+                author=test_author if book_id else None,
+                language=test_language,
+            )
+            book.genre.set([fantasy, horror] if book_id else [])
+            self.books.append(book)
+
+        BookInstance.objects.create(
+            id='e06f04a7-0ab7-4a43-b3b9-d288196393e0',
+            book=self.books[1],
+            imprint='Some Imprint',
+            status='o',
+            borrower=test_user1,
+            due_back=datetime.date(2021, 7, 1),
+        )
+
+    def read_ndjson(self, response):
+        content = b''.join(response.streaming_content).decode()
+        return [json.loads(line) for line in content.splitlines()]
+
+    def test_export_books_ndjson(self):
+        response = self.client.get(reverse('book-export-api'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = self.read_ndjson(response)
+        self.assertEqual([row['id'] for row in rows], [book.id for book in self.books])
+        self.assertEqual(rows[0]['author'], None)
+        self.assertEqual(rows[0]['genre'], [])
+        self.assertEqual(rows[1], {
+            'id': self.books[1].id,
+            'title': 'Book Title 1',
+            'summary': 'My book summary',
+            'isbn': 'ABCDEF 1',
+            'author_id': self.books[1].author_id,
+            'author': 'Smith, John',
+            'language_id': self.books[1].language_id,
+            'language': 'English',
+            'genre': ['Fantasy', 'Horror'],
+        })
+
+    def test_export_books_csv(self):
+        response = self.client.get(reverse('book-export-api') + '?output=csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        content = b''.join(response.streaming_content).decode()
+        rows = list(csv.reader(content.splitlines()))
+        self.assertEqual(rows[0], ['id', 'title', 'summary', 'isbn', 'author_id', 'author', 'language_id', 'language', 'genre'])
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[2][1], 'Book Title 1')
+        self.assertEqual(rows[2][8], 'Fantasy, Horror')
+
+    def test_export_books_in_chunks(self):
+        '''Every chunk is a separate query and no row is lost between chunks'''
+        with override_settings(EXPORT_CHUNK_SIZE=2):
+            response = self.client.get(reverse('book-export-api'))
+            rows = self.read_ndjson(response)
+        self.assertEqual([row['id'] for row in rows], [book.id for book in self.books])
+
+    def test_export_books_resume(self):
+        response = self.client.get(reverse('book-export-api') + f'?after={self.books[2].id}')
+        rows = self.read_ndjson(response)
+        self.assertEqual([row['id'] for row in rows], [book.id for book in self.books[3:]])
+
+    def test_export_invalid_parameters(self):
+        response = self.client.get(reverse('book-export-api') + '?output=xml')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse('book-export-api') + '?after=abc')
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_bookinstances_without_authorization(self):
+        response = self.client.get(reverse('bookinstance-export-api'))
+        self.assertEqual(response.status_code, 401)
+
+    def test_export_bookinstances_with_normal_user_authorization(self):
+        self.login('testuser2', '2HJ1vRV0Z&3iD')
+        response = self.client.get(reverse('bookinstance-export-api'))
+        self.assertEqual(response.status_code, 403)
+
+    def test_export_bookinstances_with_librarian_authorization(self):
+        self.login('testuser1', '1X<ISRUkw+tuK')
+        response = self.client.get(reverse('bookinstance-export-api'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.read_ndjson(response), [{
+            'id': 'e06f04a7-0ab7-4a43-b3b9-d288196393e0',
+            'book_id': self.books[1].id,
+            'book': 'Book Title 1',
+            'imprint': 'Some Imprint',
+            'status': 'o',
+            'due_back': '2021-07-01',
+            'borrower_id': User.objects.get(username='testuser1').id,
+            'borrower': 'testuser1',
+        }])
+
+
+class BulkBookApiTest(TokenLoginMixin, APITestCase):
+    '''Tests the bulk creation and update of books'''
+    def setUp(self):
+        test_user1 = User.objects.create_user(username='testuser1', password='1X<ISRUkw+tuK')
+        User.objects.create_user(username='testuser2', password='2HJ1vRV0Z&3iD')
+        librarian_group = Group.objects.create(name="Librarians")
+        librarian_group.user_set.add(test_user1)
+
+        self.author = Author.objects.create(first_name='John', last_name='Smith')
+        self.language = Language.objects.create(name='English')
+        self.fantasy = Genre.objects.create(name='Fantasy')
+        self.horror = Genre.objects.create(name='Horror')
+        self.existing_book = Book.objects.create(
+            title='Old Title',
+            summary='Old summary',
+            isbn='1234567891234',
+            author=self.author,
+            language=self.language,
+        )
+        self.existing_book.genre.set([self.horror])
+        self.url = reverse('book-api-bulk')
+
+    def book_rows(self, number_of_books):
+        return [
+            {
+                'title': f'Book Title {book_id}',
+                'summary': 'My book summary',
+                'isbn': f'ISBN {book_id}',
+                'author': self.author.id,
+                'language': self.language.id,
+                'genre': [self.fantasy.id],
+                'copies': [{'imprint': 'Some imprint', 'status': 'a'}],
+            }
+            for book_id in range(number_of_books)
+        ]
+
+    def test_bulk_without_authorization(self):
+        response = self.client.post(self.url, self.book_rows(1), format='json')
+        self.assertEqual(response.status_code, 401)
+
+    def test_bulk_with_normal_user_authorization(self):
+        self.login('testuser2', '2HJ1vRV0Z&3iD')
+        response = self.client.post(self.url, self.book_rows(1), format='json')
+        self.assertEqual(response.status_code, 403)
+
+    def test_bulk_create(self):
+        self.login('testuser1', '1X<ISRUkw+tuK')
+        response = self.client.post(self.url, self.book_rows(3), format='json')
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([result['status'] for result in results], ['created'] * 3)
+        for result in results:
+            book = Book.objects.get(id=result['id'])
+            self.assertEqual(book.isbn, result['isbn'])
+            self.assertEqual(list(book.genre.all()), [self.fantasy])
+            self.assertEqual(
+                [str(copy_id) for copy_id in book.bookinstance_set.values_list('id', flat=True)],
+                result['copies'],
+            )
+        self.assertEqual(BookInstance.objects.filter(status='a').count(), 3)
+
+    def test_bulk_update_by_isbn(self):
+        self.login('testuser1', '1X<ISRUkw+tuK')
+        rows = [{
+            'title': 'New Title',
+            'summary': 'New summary',
+            'isbn': '1234567891234',
+            'genre': [self.fantasy.id, self.horror.id],
+        }]
+        response = self.client.post(self.url, rows, format='json')
+        self.assertEqual(response.status_code, 200)
+        result = response.json()['results'][0]
+        self.assertEqual(result['status'], 'updated')
+        self.assertEqual(result['id'], self.existing_book.id)
+        book = Book.objects.get(id=self.existing_book.id)
+        self.assertEqual(book.title, 'New Title')
+        #Fields that are not in the row are left as they were
+        self.assertEqual(book.author, self.author)
+        self.assertEqual(set(book.genre.all()), {self.fantasy, self.horror})
+
+    def test_bulk_update_copy(self):
+        copy = BookInstance.objects.create(book=self.existing_book, imprint='Old imprint')
+        self.login('testuser1', '1X<ISRUkw+tuK')
+        rows = [{
+            'title': 'Old Title',
+            'summary': 'Old summary',
+            'isbn': '1234567891234',
+            'copies': [{'id': str(copy.id), 'imprint': 'New imprint', 'status': 'a'}],
+        }]
+        response = self.client.post(self.url, rows, format='json')
+        self.assertEqual(response.status_code, 200)
+        copy.refresh_from_db()
+        self.assertEqual(copy.imprint, 'New imprint')
+        self.assertEqual(copy.status, 'a')
+        self.assertEqual(BookInstance.objects.count(), 1)
+
+    def test_bulk_move_copy_to_another_book(self):
+        copy = BookInstance.objects.create(book=self.existing_book, imprint='Imprint', status='a')
+        self.login('testuser1', '1X<ISRUkw+tuK')
+        rows = self.book_rows(1)
+        rows[0]['copies'] = [{'id': str(copy.id), 'imprint': 'Imprint'}]
+        response = self.client.post(self.url, rows, format='json')
+        self.assertEqual(response.status_code, 200)
+        #The book the copy was moved from is counted again too
+        self.existing_book.refresh_from_db()
+        self.assertEqual((self.existing_book.total_copies, self.existing_book.available_copies), (0, 0))
+        new_book = Book.objects.get(pk=response.json()['results'][0]['id'])
+        self.assertEqual((new_book.total_copies, new_book.available_copies), (1, 1))
+
+    def test_bulk_ndjson(self):
+        self.login('testuser1', '1X<ISRUkw+tuK')
+        body = '\n'.join(json.dumps(row) for row in self.book_rows(2))
+        response = self.client.post(self.url, body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Book.objects.count(), 3)
+
+    def test_bulk_invalid_rows_write_nothing(self):
+        self.login('testuser1', '1X<ISRUkw+tuK')
+        rows = self.book_rows(3)
+        rows[1]['author'] = 1000
+        rows[2]['isbn'] = rows[1]['isbn']
+        del rows[0]['title']
+        response = self.client.post(self.url, rows, format='json')
+        self.assertEqual(response.status_code, 400)
+        results = response.json()['results']
+        self.assertIn('title', results[0]['errors'])
+        self.assertIn('author', results[1]['errors'])
+        self.assertIn('isbn', results[2]['errors'])
+        self.assertEqual(Book.objects.count(), 1)
+
+    def test_bulk_not_a_list(self):
+        self.login('testuser1', '1X<ISRUkw+tuK')
+        response = self.client.post(self.url, self.book_rows(1)[0], format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_query_count_does_not_grow(self):
+        '''The number of queries depends on the number of batches, not on the number of books'''
+        self.login('testuser1', '1X<ISRUkw+tuK')
+        self.client.post(self.url, [], format='json')
+        with CaptureQueriesContext(connection) as few_books:
+            self.client.post(self.url, self.book_rows(2), format='json')
+        rows = self.book_rows(40)
+        for row in rows:
+            row['isbn'] += ' B'
+        with CaptureQueriesContext(connection) as more_books:
+            self.client.post(self.url, rows, format='json')
+        self.assertEqual(len(few_books.captured_queries), len(more_books.captured_queries))
+
+    def test_bulk_updates_home_page_counts(self):
+        self.login('testuser1', '1X<ISRUkw+tuK')
+        self.client.post(self.url, self.book_rows(3), format='json')
+        response = self.client.get(reverse('home-page'))
+        self.assertEqual(response.json()['num_books'], 4)
+        self.assertEqual(response.json()['num_instances_available'], 3)
+
+
+class BookSearchApiTest(APITestCase):
+    '''Tests the full-text search over books'''
+    def setUp(self):
+        self.tolkien = Author.objects.create(first_name='John', last_name='Tolkien')
+        self.smith = Author.objects.create(first_name='John', last_name='Smith')
+        self.lotr = Book.objects.create(
+            title='The Lord of the Rings',
+            summary='A hobbit carries a ring to a volcano',
+            isbn='ABCDEF 1',
+            author=self.tolkien,
+        )
+        self.hobbit = Book.objects.create(
+            title='The Hobbit',
+            summary='A journey there and back again, in which a ring is found',
+            isbn='ABCDEF 2',
+            author=self.tolkien,
+        )
+        self.cookbook = Book.objects.create(
+            title='Cooking for Dragons',
+            summary='Recipes',
+            isbn='ABCDEF 3',
+            author=self.smith,
+        )
+
+    def search(self, query):
+        response = self.client.get(reverse('book-search-api'), {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return [book['title'] for book in response.json()['results']]
+
+    def test_search_title(self):
+        self.assertEqual(self.search('hobbit'), ['The Hobbit', 'The Lord of the Rings'])
+
+    def test_search_ranks_title_matches_first(self):
+        self.assertEqual(self.search('ring'), ['The Lord of the Rings', 'The Hobbit'])
+
+    def test_search_author_name(self):
+        self.assertEqual(self.search('smith'), ['Cooking for Dragons'])
+
+    def test_search_requires_every_word(self):
+        self.assertEqual(self.search('tolkien volcano'), ['The Lord of the Rings'])
+
+    def test_search_available_books(self):
+        BookInstance.objects.create(book=self.hobbit, imprint='Imprint', status='a')
+        BookInstance.objects.create(book=self.lotr, imprint='Imprint', status='o')
+        response = self.client.get(reverse('book-search-api'), {'q': 'ring', 'available': 'true'})
+        self.assertEqual([book['title'] for book in response.json()['results']], ['The Hobbit'])
+        self.assertEqual(response.json()['results'][0]['available_copies'], 1)
+
+    def test_search_ignores_query_syntax(self):
+        self.assertEqual(self.search('"dragons" (cooking*'), ['Cooking for Dragons'])
+        self.assertEqual(self.search('!!!'), [])
+
+    def test_search_follows_book_changes(self):
+        self.cookbook.title = 'Baking for Dragons'
+        self.cookbook.save()
+        self.assertEqual(self.search('baking'), ['Baking for Dragons'])
+        self.assertEqual(self.search('cooking'), [])
+        self.cookbook.delete()
+        self.assertEqual(self.search('dragons'), [])
+
+    def test_search_follows_author_changes(self):
+        self.smith.last_name = 'Baker'
+        self.smith.save()
+        self.assertEqual(self.search('baker'), ['Cooking for Dragons'])
+        self.smith.delete()
+        self.assertEqual(self.search('baker'), [])
+        self.assertEqual(self.search('dragons'), ['Cooking for Dragons'])
+
+    def test_search_limit(self):
+        response = self.client.get(reverse('book-search-api'), {'q': 'ring', 'limit': 1})
+        self.assertEqual(len(response.json()['results']), 1)
+        response = self.client.get(reverse('book-search-api'), {'q': 'ring', 'limit': 'all'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_rebuild_search_index_command(self):
+        #QuerySet.update() does not send signals so the index is out of date until it is rebuilt
+        Book.objects.filter(id=self.cookbook.id).update(title='Baking for Dragons')
+        self.assertEqual(self.search('baking'), [])
+        call_command('rebuild_search_index', stdout=io.StringIO())
+        self.assertEqual(self.search('baking'), ['Baking for Dragons'])
+
+
+@override_settings(API_CACHE_ALIAS='default')
+class ConditionalCacheTest(APITestCase):
+    '''Tests the ETag, Last-Modified and server-side caching of the read-only catalog endpoints'''
+    def setUp(self):
+        cache.clear()
+        self.author = Author.objects.create(first_name='John', last_name='Smith')
+        self.genre = Genre.objects.create(name='Fantasy')
+        self.book = Book.objects.create(
+            title='Book Title',
+            summary='My book summary',
+            isbn='1234567891234',
+            author=self.author,
+        )
+
+    def test_response_has_validators(self):
+        response = self.client.get(reverse('book-api-list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('ETag', response)
+        self.assertIn('Last-Modified', response)
+
+    @override_settings(API_CACHE_ALIAS=None)
+    def test_nothing_is_cached_without_a_shared_cache(self):
+        response = self.client.get(reverse('book-api-list'))
+        self.assertNotIn('ETag', response)
+        #A change made by another worker process, which the versions of this process would not see
+        Book.objects.filter(pk=self.book.pk).update(title='New Title')
+        response = self.client.get(reverse('book-api-list'))
+        self.assertEqual(response.json()['results'][0]['title'], 'New Title')
+
+    def test_not_modified_without_queries(self):
+        response = self.client.get(reverse('book-api-list'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('book-api-list'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_not_modified_since(self):
+        response = self.client.get(reverse('author-api-detail', args=[self.author.id]))
+        response = self.client.get(
+            reverse('author-api-detail', args=[self.author.id]),
+            HTTP_IF_MODIFIED_SINCE=response['Last-Modified'],
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_cached_response_without_queries(self):
+        first_response = self.client.get(reverse('book-api-detail', args=[self.book.id]))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('book-api-detail', args=[self.book.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), first_response.json())
+
+    def test_etag_depends_on_path(self):
+        list_response = self.client.get(reverse('book-api-list'))
+        detail_response = self.client.get(reverse('book-api-detail', args=[self.book.id]))
+        self.assertNotEqual(list_response['ETag'], detail_response['ETag'])
+
+    @override_settings(ALLOWED_HOSTS=['testserver', 'example.com'])
+    def test_etag_depends_on_host(self):
+        Book.objects.create(title='Other Title', summary='My book summary', isbn='1234567891235', author=self.author)
+        response = self.client.get(reverse('book-api-list'), {'page_size': 1})
+        other_response = self.client.get(reverse('book-api-list'), {'page_size': 1}, HTTP_HOST='example.com')
+        self.assertNotEqual(response['ETag'], other_response['ETag'])
+        self.assertTrue(other_response.json()['next'].startswith('http://example.com/'))
+
+    #The browsable api links to static files, which are only in the manifest after collectstatic
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_etag_depends_on_media_type(self):
+        response = self.client.get(reverse('book-api-list'), HTTP_ACCEPT='application/json')
+        html_response = self.client.get(reverse('book-api-list'), HTTP_ACCEPT='text/html')
+        self.assertNotEqual(response['ETag'], html_response['ETag'])
+        self.assertIn('Accept', response['Vary'])
+        response = self.client.get(reverse('book-api-list'), HTTP_ACCEPT='text/html', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_write_invalidates(self):
+        response = self.client.get(reverse('book-api-detail', args=[self.book.id]))
+        self.book.title = 'New Title'
+        self.book.save()
+        response = self.client.get(
+            reverse('book-api-detail', args=[self.book.id]),
+            HTTP_IF_NONE_MATCH=response['ETag'],
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['title'], 'New Title')
+
+    def test_genre_change_invalidates_books(self):
+        self.client.get(reverse('book-api-detail', args=[self.book.id]))
+        self.book.genre.add(self.genre)
+        response = self.client.get(reverse('book-api-detail', args=[self.book.id]))
+        self.assertEqual(response.json()['genre'], [self.genre.id])
+
+    def test_author_delete_invalidates_books(self):
+        self.client.get(reverse('book-api-detail', args=[self.book.id]))
+        self.author.delete()
+        response = self.client.get(reverse('book-api-detail', args=[self.book.id]))
+        self.assertEqual(response.json()['author'], None)
+
+    def test_missing_object_is_not_cached(self):
+        response = self.client.get(reverse('book-api-detail', args=[1000]))
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn('ETag', response)
+
+
+class ORJSONRendererTest(APITestCase):
+    '''Tests that the orjson renderer and parser behave exactly like the default ones'''
+    data = {
+        'results': [
+            {
+                'id': uuid.UUID('1b4e28ba-2fa1-11d2-883f-0016d3cca427'),
+                'due_back': datetime.date(2021, 6, 1),
+                'returned': datetime.datetime(2021, 6, 1, 12, 30, 15, 123456, tzinfo=datetime.timezone.utc),
+                'price': decimal.Decimal('12.50'),
+                'title': 'Les Misérables \u2028 \u2029',
+                'genre': [1, 2],
+                'borrower': None,
+            },
+        ],
+        1: 'integer key',
+    }
+
+    def test_renders_the_same_bytes_as_the_default_renderer(self):
+        self.assertEqual(ORJSONRenderer().render(self.data), JSONRenderer().render(self.data))
+
+    def test_falls_back_to_the_default_renderer_without_orjson(self):
+        with mock.patch('catalog.renderers.orjson', None):
+            self.assertEqual(ORJSONRenderer().render(self.data), JSONRenderer().render(self.data))
+
+    def test_falls_back_to_the_default_renderer_for_large_integers(self):
+        self.assertEqual(ORJSONRenderer().render({'big': 2 ** 70}), b'{"big":1180591620717411303424}')
+
+    def test_indented_output_for_the_browsable_api(self):
+        content = ORJSONRenderer().render({'id': 1}, 'application/json; indent=4')
+        self.assertEqual(content, b'{\n    "id": 1\n}')
+
+    def test_parses_json(self):
+        content = '{"title": "Les Misérables", "genre": [1, 2]}'.encode()
+        self.assertEqual(ORJSONParser().parse(io.BytesIO(content)), {'title': 'Les Misérables', 'genre': [1, 2]})
+        with mock.patch('catalog.parsers.orjson', None):
+            self.assertEqual(ORJSONParser().parse(io.BytesIO(content)), {'title': 'Les Misérables', 'genre': [1, 2]})
+
+    def test_invalid_json_is_a_parse_error(self):
+        with self.assertRaises(ParseError):
+            ORJSONParser().parse(io.BytesIO(b'{"title": '))
+
+    def test_api_uses_the_orjson_renderer_and_parser(self):
+        Group.objects.create(name='Librarians')
+        librarian = User.objects.create_user(username='librarian', password='1X<ISRUkw+tuK')
+        Group.objects.get(name='Librarians').user_set.add(librarian)
+        response = self.client.post(reverse('token_obtain_pair'), {'username': 'librarian', 'password': '1X<ISRUkw+tuK'}, format='json')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {response.json()["access"]}')
+
+        response = self.client.post(reverse('genre-api-list'), data='{"name": "Science Fiction"}', content_type='application/json')
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        self.assertIsInstance(response.accepted_renderer, ORJSONRenderer)
+        response = self.client.get(reverse('genre-api-list'))
+        self.assertEqual(response.json()['results'][0]['name'], 'Science Fiction')
+
+
+class ValuesSerializerTest(APITestCase):
+    '''Tests that the list responses built from values() rows are the same as the ones of the model serializers'''
+    def setUp(self):
+        english = Language.objects.create(name='English')
+        genres = [Genre.objects.create(name=f'Genre {genre_id}') for genre_id in range(3)]
+        authors = [
+            Author.objects.create(first_name='Jane', last_name='Austen', date_of_birth=datetime.date(1775, 12, 16), date_of_death=datetime.date(1817, 7, 18)),
+            Author.objects.create(first_name='Living', last_name='Author'),
+        ]
+        for book_id in range(6):
+            book = Book.objects.create(
+                title=f'Book {book_id}',
+                summary='Summary',
+                isbn=f'ISBN{book_id}',
+                author=authors[book_id % 2] if book_id != 5 else None,
+                language=english if book_id % 3 else None,
+            )
+            book.genre.set(genres[:book_id % 4])
+
+    def test_same_output_as_the_model_serializers(self):
+        for serializer_class in (AuthorSerializer, BookSerializer, GenreSerializer, LanguageSerializer):
+            queryset = serializer_class.Meta.model.objects.all()
+            values_serializer = ValuesSerializer(serializer_class)
+            self.assertEqual(
+                JSONRenderer().render(values_serializer.to_representation(list(values_serializer.values(queryset)))),
+                JSONRenderer().render(serializer_class(queryset, many=True).data),
+            )
+
+    def test_list_responses_are_unchanged(self):
+        response = self.client.get(reverse('book-api-list') + '?page_size=4')
+        expected = BookSerializer(Book.objects.order_by('title', 'id')[:4], many=True).data
+        self.assertEqual(response.json()['results'], json.loads(JSONRenderer().render(expected)))
+        #The cursor of the next page is taken from the rows
+        response = self.client.get(response.json()['next'])
+        self.assertEqual([book['title'] for book in response.json()['results']], ['Book 4', 'Book 5'])
+
+
+class BookFieldsetsApiTest(APITestCase):
+    '''Tests the ?fields= and ?expand= parameters of the books api'''
+    def setUp(self):
+        self.english = Language.objects.create(name='English')
+        self.author = Author.objects.create(first_name='Jane', last_name='Austen', date_of_birth=datetime.date(1775, 12, 16))
+        genres = [Genre.objects.create(name=f'Genre {genre_id}') for genre_id in range(2)]
+        for book_id in range(5):
+            book = Book.objects.create(
+                title=f'Book {book_id}',
+                summary='Summary',
+                isbn=f'ISBN{book_id}',
+                author=self.author if book_id % 2 else None,
+                language=self.english,
+            )
+            book.genre.set(genres[:book_id % 3])
+
+    def get(self, url):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return response.json(), [query['sql'] for query in queries.captured_queries]
+
+    def test_sparse_list(self):
+        body, queries = self.get(reverse('book-api-list') + '?fields=id,title')
+        self.assertEqual(body['results'][0], {'id': Book.objects.get(title='Book 0').id, 'title': 'Book 0'})
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('summary', queries[0])
+        self.assertNotIn('genre', queries[0])
+
+    def test_sparse_list_with_next_page(self):
+        body, _ = self.get(reverse('book-api-list') + '?fields=isbn&page_size=3')
+        self.assertEqual(body['results'], [{'isbn': 'ISBN0'}, {'isbn': 'ISBN1'}, {'isbn': 'ISBN2'}])
+        body, _ = self.get(body['next'])
+        self.assertEqual(body['results'], [{'isbn': 'ISBN3'}, {'isbn': 'ISBN4'}])
+
+    def test_expanded_list(self):
+        body, queries = self.get(reverse('book-api-list') + '?fields=title,author,language,genre&expand=author,language,genre')
+        book = body['results'][1]
+        self.assertEqual(book['title'], 'Book 1')
+        self.assertEqual(book['author'], {
+            'id': self.author.id, 'first_name': 'Jane', 'last_name': 'Austen', 'date_of_birth': '1775-12-16', 'date_of_death': None,
+        })
+        self.assertEqual(book['language'], {'id': self.english.id, 'name': 'English'})
+        self.assertEqual([genre['name'] for genre in book['genre']], ['Genre 0'])
+        self.assertIsNone(body['results'][0]['author'])
+        #One query for the books with their author and language, one for the genres
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn('summary', queries[0])
+
+    def test_expand_without_fields_returns_every_field(self):
+        body, _ = self.get(reverse('book-api-list') + '?expand=language')
+        self.assertEqual(list(body['results'][0]), ['id', 'title', 'summary', 'isbn', 'total_copies', 'available_copies', 'author', 'language', 'genre'])
+        self.assertEqual(body['results'][0]['language']['name'], 'English')
+        self.assertEqual(body['results'][0]['author'], None)
+
+    def test_fields_that_are_not_returned_are_not_expanded(self):
+        body, queries = self.get(reverse('book-api-list') + '?fields=title&expand=author')
+        self.assertEqual(body['results'][0], {'title': 'Book 0'})
+        self.assertNotIn('catalog_author', queries[0])
+
+    def test_sparse_retrieve(self):
+        book = Book.objects.get(title='Book 1')
+        body, _ = self.get(reverse('book-api-detail', kwargs={'pk': book.id}) + '?fields=title,author&expand=author')
+        self.assertEqual(body, {'title': 'Book 1', 'author': {
+            'id': self.author.id, 'first_name': 'Jane', 'last_name': 'Austen', 'date_of_birth': '1775-12-16', 'date_of_death': None,
+        }})
+
+    def test_invalid_fields(self):
+        response = self.client.get(reverse('book-api-list') + '?fields=title,price')
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertIn('Error_message', response.json())
+        response = self.client.get(reverse('book-api-list') + '?expand=summary')
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    #The cache is only used when it is shared by the worker processes
+    @override_settings(API_CACHE_ALIAS='default')
+    def test_expanded_response_is_updated_after_the_author_changes(self):
+        url = reverse('book-api-list') + '?fields=author&expand=author'
+        response = self.client.get(url)
+        self.assertEqual(response.json()['results'][1]['author']['first_name'], 'Jane')
+        self.author.first_name = 'J.'
+        self.author.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response.json()['results'][1]['author']['first_name'], 'J.')
+
+
+class TokenBlacklistTest(TokenLoginMixin, APITestCase):
+    def setUp(self):
+        User.objects.create_user(username='testuser1', password='1X<ISRUkw+tuK')
+
+    @override_settings(API_CACHE_ALIAS='default')
+    def test_blacklist_is_checked_from_memory_with_a_shared_cache(self):
+        self.assertFalse(is_blacklisted('unknown'))
+        with self.assertNumQueries(0):
+            self.assertFalse(is_blacklisted('unknown'))
+
+    def test_blacklist_is_checked_in_the_database_without_a_shared_cache(self):
+        token = OutstandingToken.objects.create(jti='other-worker', token='token', expires_at=aware_utcnow() + datetime.timedelta(hours=1))
+        self.assertFalse(is_blacklisted('other-worker'))
+        #Blacklisted without the signal, as another worker process would do it
+        BlacklistedToken.objects.bulk_create([BlacklistedToken(token=token)])
+        with self.assertNumQueries(1):
+            self.assertTrue(is_blacklisted('other-worker'))
+
+    @override_settings(API_CACHE_ALIAS='default')
+    def test_refresh_does_not_query_the_blacklist_with_a_shared_cache(self):
+        cache.clear()
+        tokens = self.obtain_tokens('testuser1', '1X<ISRUkw+tuK')
+        self.client.post(reverse('token_refresh'), {'refresh': tokens['refresh']}, format='json')
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(reverse('token_refresh'), {'refresh': tokens['refresh']}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertIn('access', response.json())
+        self.assertFalse([query for query in context.captured_queries if 'token_blacklist' in query['sql']])
+
+        #A logout changes the version of the blacklist, so the next refresh sees it
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens["access"]}')
+        self.client.post('/catalog/api/logout', {'refresh': tokens['refresh']}, format='json')
+        self.client.credentials()
+        response = self.client.post(reverse('token_refresh'), {'refresh': tokens['refresh']}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+
+    def test_blacklisted_token_can_not_be_refreshed(self):
+        tokens = self.obtain_tokens('testuser1', '1X<ISRUkw+tuK')
+        self.client.post(reverse('token_refresh'), {'refresh': tokens['refresh']}, format='json')
+
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens["access"]}')
+        #The name 'logout' is taken by the logout page of django.contrib.auth
+        response = self.client.post('/catalog/api/logout', {'refresh': tokens['refresh']}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+
+        self.client.credentials()
+        response = self.client.post(reverse('token_refresh'), {'refresh': tokens['refresh']}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+        #Other tokens are still accepted
+        response = self.client.post(reverse('token_refresh'), {'refresh': self.obtain_tokens('testuser1', '1X<ISRUkw+tuK')['refresh']}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+
+    def test_purge_expired_tokens(self):
+        now = aware_utcnow()
+        for token_id in range(5):
+            token = OutstandingToken.objects.create(jti=f'expired-{token_id}', token='token', expires_at=now - datetime.timedelta(hours=1))
+            if token_id % 2:
+                BlacklistedToken.objects.create(token=token)
+        valid = OutstandingToken.objects.create(jti='valid', token='token', expires_at=now + datetime.timedelta(hours=1))
+        BlacklistedToken.objects.create(token=valid)
+
+        stdout = io.StringIO()
+        call_command('purge_expired_tokens', batch_size=2, stdout=stdout)
+        self.assertIn('Deleted 5 expired outstanding tokens, 2 of which were blacklisted.', stdout.getvalue())
+        self.assertEqual(list(OutstandingToken.objects.values_list('jti', flat=True)), ['valid'])
+        self.assertEqual(BlacklistedToken.objects.get().token, valid)
+
 
+class LoanApiTest(TokenLoginMixin, APITestCase):
+    def setUp(self):
+        Group.objects.create(name='Librarians')
+        librarian = User.objects.create_user(username='librarian', password='1X<ISRUkw+tuK')
+        Group.objects.get(name='Librarians').user_set.add(librarian)
+        self.reader = User.objects.create_user(username='reader', password='2HJ1vRV0Z&3iD')
+        self.book = Book.objects.create(title='Emma', summary='Summary', isbn='ISBN1')
+        self.first_copy = BookInstance.objects.create(book=self.book, imprint='Imprint', status='a')
+        self.second_copy = BookInstance.objects.create(book=self.book, imprint='Imprint', status='m')
+        self.login('librarian', '1X<ISRUkw+tuK')
+
+    def test_checkout_of_a_book_lends_an_available_copy(self):
+        response = self.client.post(reverse('loan-api-checkout'), {'book': self.book.id, 'borrower': self.reader.id}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        self.assertEqual(response.json()['id'], str(self.first_copy.id))
+        self.assertEqual(response.json()['borrower'], 'reader')
+        self.first_copy.refresh_from_db()
+        self.assertEqual(self.first_copy.status, 'o')
+        self.assertEqual(self.first_copy.due_back, datetime.date.today() + datetime.timedelta(days=21))
+
+        #The other copy is in maintenance
+        response = self.client.post(reverse('loan-api-checkout'), {'book': self.book.id, 'borrower': self.reader.id}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.CONFLICT)
+        self.assertEqual(response.json(), {'Error_message': 'No copy of this book is available.'})
+
+    def test_checkout_of_a_copy(self):
+        due_back = datetime.date.today() + datetime.timedelta(weeks=1)
+        response = self.client.post(reverse('loan-api-checkout'), {'copy': str(self.second_copy.id), 'borrower': self.reader.id}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.CONFLICT)
+        response = self.client.post(reverse('loan-api-checkout'), {'copy': str(self.first_copy.id), 'borrower': self.reader.id, 'due_back': due_back}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        self.assertEqual(response.json()['due_back'], due_back.isoformat())
+
+    def test_checkout_needs_a_book_or_a_copy(self):
+        response = self.client.post(reverse('loan-api-checkout'), {'borrower': self.reader.id}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        response = self.client.post(reverse('loan-api-checkout'), {'book': self.book.id, 'borrower': 0}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_return_and_renew(self):
+        self.client.post(reverse('loan-api-checkout'), {'book': self.book.id, 'borrower': self.reader.id}, format='json')
+
+        due_back = datetime.date.today() + datetime.timedelta(weeks=4)
+        response = self.client.post(reverse('loan-api-renew', args=[self.first_copy.id]), {'due_back': due_back}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response.json()['due_back'], due_back.isoformat())
+        response = self.client.post(reverse('loan-api-renew', args=[self.first_copy.id]), {'due_back': datetime.date.today() + datetime.timedelta(weeks=5)}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+        response = self.client.post(reverse('loan-api-return', args=[self.first_copy.id]))
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.first_copy.refresh_from_db()
+        self.assertEqual((self.first_copy.status, self.first_copy.borrower, self.first_copy.due_back), ('a', None, None))
+        #Returning it twice
+        response = self.client.post(reverse('loan-api-return', args=[self.first_copy.id]))
+        self.assertEqual(response.status_code, HTTPStatus.CONFLICT)
+        response = self.client.post(reverse('loan-api-renew', args=[self.first_copy.id]), {'due_back': due_back}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.CONFLICT)
+
+    def test_unknown_copy(self):
+        response = self.client.post(reverse('loan-api-return', args=[uuid.uuid4()]))
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+    def test_unknown_book(self):
+        response = self.client.post(reverse('loan-api-checkout'), {'book': 0, 'borrower': self.reader.id}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+        self.assertEqual(response.json(), {'Error_message': 'This book does not exist.'})
+
+    def lend_elsewhere_once_read(self, lent):
+        '''Makes another request lend the first copy read, as can happen where rows are not locked'''
+        lock = loans._lock
+        other_reader = User.objects.create_user(username='other', password='3HJ1vRV0Z&3iD')
+
+        def read_then_lend(operation, queryset):
+            row = lock(operation, queryset)
+            if row is not None and not lent:
+                BookInstance.objects.filter(pk=row.pk).update(status='o', borrower=other_reader)
+                lent.append(row.pk)
+            return row
+        return mock.patch('catalog.loans._lock', side_effect=read_then_lend)
+
+    def test_checkout_of_a_book_takes_the_next_copy_when_one_was_lent_meanwhile(self):
+        self.second_copy.status = 'a'
+        self.second_copy.save()
+        lent = []
+        with self.lend_elsewhere_once_read(lent):
+            response = self.client.post(reverse('loan-api-checkout'), {'book': self.book.id, 'borrower': self.reader.id}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        self.assertNotEqual(response.json()['id'], str(lent[0]))
+        self.assertEqual(BookInstance.objects.get(pk=lent[0]).borrower.username, 'other')
+
+    def test_checkout_of_a_copy_lent_meanwhile(self):
+        with self.lend_elsewhere_once_read([]):
+            response = self.client.post(reverse('loan-api-checkout'), {'copy': str(self.first_copy.id), 'borrower': self.reader.id}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.CONFLICT)
+        self.assertEqual(response.json(), {'Error_message': 'This copy is not available.'})
+
+    def test_only_lock_timeouts_are_conflicts(self):
+        def failing(message):
+            raise OperationalError(message)
+            yield
+
+        with self.assertRaises(LoanError) as raised:
+            loans._timed('checkout', failing('database is locked'))
+        self.assertEqual(raised.exception.status_code, HTTPStatus.CONFLICT)
+        with self.assertRaises(OperationalError):
+            loans._timed('checkout', failing('no such table: catalog_bookinstance'))
+
+    def test_lock_statistics(self):
+        reset_lock_stats()
+        self.client.post(reverse('loan-api-checkout'), {'book': self.book.id, 'borrower': self.reader.id}, format='json')
+        self.client.post(reverse('loan-api-checkout'), {'book': self.book.id, 'borrower': self.reader.id}, format='json')
+        self.client.post(reverse('loan-api-return', args=[self.first_copy.id]))
+        response = self.client.get(reverse('loan-api-stats'))
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        locks = response.json()['locks']
+        self.assertEqual(locks['checkout']['count'], 2)
+        self.assertEqual(locks['checkout']['not_found'], 1)
+        self.assertEqual(locks['return']['count'], 1)
+        self.assertIn('max_wait_ms', locks['return'])
+
+    def test_only_librarians_can_lend(self):
+        self.login('reader', '2HJ1vRV0Z&3iD')
+        response = self.client.post(reverse('loan-api-checkout'), {'book': self.book.id, 'borrower': self.reader.id}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+        self.first_copy.refresh_from_db()
+        self.assertEqual(self.first_copy.status, 'a')
+
+
+class HoldApiTest(TokenLoginMixin, APITestCase):
+    def setUp(self):
+        Group.objects.create(name='Librarians')
+        librarian = User.objects.create_user(username='librarian', password='1X<ISRUkw+tuK')
+        Group.objects.get(name='Librarians').user_set.add(librarian)
+        self.first_reader = User.objects.create_user(username='first', password='2HJ1vRV0Z&3iD')
+        self.second_reader = User.objects.create_user(username='second', password='3HJ1vRV0Z&3iD')
+        self.borrower = User.objects.create_user(username='borrower', password='4HJ1vRV0Z&3iD')
+        self.book = Book.objects.create(title='Emma', summary='Summary', isbn='ISBN1')
+        self.other_book = Book.objects.create(title='Persuasion', summary='Summary', isbn='ISBN2')
+        self.copy = BookInstance.objects.create(book=self.book, imprint='Imprint', status='o', borrower=self.borrower, due_back=datetime.date.today())
+        self.other_copy = BookInstance.objects.create(book=self.other_book, imprint='Imprint', status='o', borrower=self.borrower, due_back=datetime.date.today())
+
+    def place_holds(self):
+        self.login('first', '2HJ1vRV0Z&3iD')
+        first = self.client.post(reverse('hold-api-list'), {'book': self.book.id}, format='json')
+        self.login('second', '3HJ1vRV0Z&3iD')
+        second = self.client.post(reverse('hold-api-list'), {'book': self.book.id}, format='json')
+        return first.json(), second.json()
+
+    def test_holds_are_queued_in_order(self):
+        first, second = self.place_holds()
+        self.assertEqual((first['status'], first['position']), ('w', 1))
+        self.assertEqual((second['status'], second['position']), ('w', 2))
+        self.assertEqual(second['title'], 'Emma')
+
+        #A second hold on the same book
+        response = self.client.post(reverse('hold-api-list'), {'book': self.book.id}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.CONFLICT)
+        #Every patron only sees their own holds
+        response = self.client.get(reverse('hold-api-list'))
+        self.assertEqual([hold['id'] for hold in response.json()], [second['id']])
+        response = self.client.get(reverse('hold-api-detail', args=[first['id']]))
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+        #The queue moves up when the first hold is cancelled
+        self.login('first', '2HJ1vRV0Z&3iD')
+        response = self.client.delete(reverse('hold-api-detail', args=[first['id']]))
+        self.assertEqual(response.status_code, HTTPStatus.NO_CONTENT)
+        self.login('second', '3HJ1vRV0Z&3iD')
+        response = self.client.get(reverse('hold-api-detail', args=[second['id']]))
+        self.assertEqual(response.json()['position'], 1)
 
+    def test_hold_ids_are_numbers(self):
+        self.login('first', '2HJ1vRV0Z&3iD')
+        response = self.client.delete('/catalog/api/holds/abc/')
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+    def test_holds_need_authentication(self):
+        response = self.client.post(reverse('hold-api-list'), {'book': self.book.id}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+
+    def test_returned_copy_is_reserved_for_the_first_hold(self):
+        first, second = self.place_holds()
+        self.login('librarian', '1X<ISRUkw+tuK')
+        response = self.client.post(reverse('loan-api-return', args=[self.copy.id]))
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response.json()['borrower'], 'first')
+        self.copy.refresh_from_db()
+        self.assertEqual((self.copy.status, self.copy.borrower), ('r', self.first_reader))
+        self.assertEqual(self.copy.due_back, datetime.date.today() + datetime.timedelta(days=7))
+        hold = Hold.objects.get(pk=first['id'])
+        self.assertEqual((hold.status, hold.copy), ('r', self.copy))
+        self.assertEqual(Hold.objects.get(pk=second['id']).queue_position(), 1)
+
+        #The reserved copy is only lent to the patron of the hold
+        response = self.client.post(reverse('loan-api-checkout'), {'book': self.book.id, 'borrower': self.second_reader.id}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.CONFLICT)
+        response = self.client.post(reverse('loan-api-checkout'), {'copy': str(self.copy.id), 'borrower': self.second_reader.id}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.CONFLICT)
+        response = self.client.post(reverse('loan-api-checkout'), {'book': self.book.id, 'borrower': self.first_reader.id}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        self.assertEqual(Hold.objects.get(pk=first['id']).status, 'f')
+
+    def test_cancelled_ready_hold_passes_the_copy_on(self):
+        first, second = self.place_holds()
+        self.login('librarian', '1X<ISRUkw+tuK')
+        self.client.post(reverse('loan-api-return', args=[self.copy.id]))
+
+        self.login('first', '2HJ1vRV0Z&3iD')
+        response = self.client.delete(reverse('hold-api-detail', args=[first['id']]))
+        self.assertEqual(response.status_code, HTTPStatus.NO_CONTENT)
+        self.copy.refresh_from_db()
+        self.assertEqual((self.copy.status, self.copy.borrower), ('r', self.second_reader))
+        self.assertEqual(Hold.objects.get(pk=second['id']).status, 'r')
+
+        #Nobody is waiting anymore
+        self.login('second', '3HJ1vRV0Z&3iD')
+        self.client.delete(reverse('hold-api-detail', args=[second['id']]))
+        self.copy.refresh_from_db()
+        self.assertEqual((self.copy.status, self.copy.borrower, self.copy.due_back), ('a', None, None))
+
+    def test_expired_ready_hold_passes_the_copy_on(self):
+        first, second = self.place_holds()
+        self.login('librarian', '1X<ISRUkw+tuK')
+        self.client.post(reverse('loan-api-return', args=[self.copy.id]))
+        #Still kept for the first patron on the day of the pickup deadline
+        call_command('expire_holds', stdout=io.StringIO())
+        self.assertEqual(Hold.objects.get(pk=first['id']).status, 'r')
+
+        BookInstance.objects.filter(pk=self.copy.pk).update(due_back=datetime.date.today() - datetime.timedelta(days=1))
+        stdout = io.StringIO()
+        call_command('expire_holds', stdout=stdout)
+        self.assertIn('Expired 1 holds.', stdout.getvalue())
+        self.assertEqual(Hold.objects.get(pk=first['id']).status, 'c')
+        self.assertEqual(Hold.objects.get(pk=second['id']).status, 'r')
+        self.copy.refresh_from_db()
+        self.assertEqual((self.copy.status, self.copy.borrower), ('r', self.second_reader))
+        self.assertEqual(self.copy.due_back, datetime.date.today() + datetime.timedelta(days=7))
+
+    def test_hold_placed_by_another_request_meanwhile(self):
+        self.place_holds()
+        self.login('first', '2HJ1vRV0Z&3iD')
+        #The check for an existing hold runs before the other request inserts its hold
+        with mock.patch.object(QuerySet, 'exists', autospec=True, side_effect=lambda queryset: queryset.model is Book):
+            response = self.client.post(reverse('hold-api-list'), {'book': self.book.id}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.CONFLICT)
+        self.assertEqual(response.json(), {'Error_message': 'There is already a hold on this book for this patron.'})
+        self.assertEqual(Hold.objects.filter(patron=self.first_reader).count(), 1)
+
+    def test_positions_are_read_with_the_holds(self):
+        self.place_holds()
+        self.login('second', '3HJ1vRV0Z&3iD')
+        with CaptureQueriesContext(connection) as one_hold:
+            response = self.client.get(reverse('hold-api-list'))
+        self.assertEqual([hold['position'] for hold in response.json()], [2])
+
+        for number in range(3):
+            book = Book.objects.create(title=f'Book {number}', summary='Summary', isbn=f'ISBN{number + 3}')
+            BookInstance.objects.create(book=book, imprint='Imprint', status='o', borrower=self.borrower, due_back=datetime.date.today())
+            self.client.post(reverse('hold-api-list'), {'book': book.id}, format='json')
+        with CaptureQueriesContext(connection) as many_holds:
+            response = self.client.get(reverse('hold-api-list'))
+        self.assertEqual([hold['position'] for hold in response.json()], [2, 1, 1, 1])
+        self.assertEqual(len(many_holds), len(one_hold))
+
+    def test_copies_made_available_go_to_the_queue(self):
+        first, second = self.place_holds()
+        #Added in the admin while patrons are waiting
+        added = BookInstance.objects.create(book=self.book, imprint='Imprint', status='a')
+        added.refresh_from_db()
+        self.assertEqual((added.status, added.borrower), ('r', self.first_reader))
+        self.assertEqual(Hold.objects.get(pk=first['id']).copy, added)
+        self.assertEqual(Book.objects.get(pk=self.book.pk).available_copies, 0)
+
+        #Nobody at the desk gets it ahead of the queue
+        self.login('librarian', '1X<ISRUkw+tuK')
+        response = self.client.post(reverse('loan-api-checkout'), {'book': self.book.id, 'borrower': self.borrower.id}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.CONFLICT)
+
+        #Uploaded in bulk
+        response = self.client.post(reverse('book-api-bulk'), [{
+            'title': 'Emma', 'summary': 'Summary', 'isbn': 'ISBN1', 'copies': [{'imprint': 'Imprint', 'status': 'a'}],
+        }], format='json')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        uploaded = BookInstance.objects.get(pk=response.json()['results'][0]['copies'][0])
+        self.assertEqual((uploaded.status, uploaded.borrower), ('r', self.second_reader))
+        self.assertEqual(Hold.objects.get(pk=second['id']).status, 'r')
+
+    def test_hold_on_an_available_book_is_ready(self):
+        self.copy.status = 'a'
+        self.copy.save()
+        self.login('first', '2HJ1vRV0Z&3iD')
+        response = self.client.post(reverse('hold-api-list'), {'book': self.book.id}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        self.assertEqual((response.json()['status'], response.json()['position']), ('r', None))
+        self.assertEqual(response.json()['pickup_by'], (datetime.date.today() + datetime.timedelta(days=7)).isoformat())
+
+    def test_return_of_many_copies(self):
+        first, _ = self.place_holds()
+        self.login('librarian', '1X<ISRUkw+tuK')
+        response = self.client.post(reverse('loan-api-return-many'), {'copies': [str(self.other_copy.id), str(self.copy.id)]}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual([(copy['id'], copy['borrower']) for copy in response.json()], [(str(self.other_copy.id), None), (str(self.copy.id), 'first')])
+        self.assertEqual(Hold.objects.get(pk=first['id']).copy, self.copy)
+
+        #Nothing is returned when one of the copies can not be
+        self.other_copy.status = 'o'
+        self.other_copy.save()
+        response = self.client.post(reverse('loan-api-return-many'), {'copies': [str(self.other_copy.id), str(self.copy.id)]}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.CONFLICT)
+        self.other_copy.refresh_from_db()
+        self.assertEqual(self.other_copy.status, 'o')
+        response = self.client.post(reverse('loan-api-return-many'), {'copies': [str(uuid.uuid4())]}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+
+class OverdueLoansApiTest(APITestCase):
+    def setUp(self):
+        Group.objects.create(name='Librarians')
+        librarian = User.objects.create_user(username='librarian', password='1X<ISRUkw+tuK')
+        Group.objects.get(name='Librarians').user_set.add(librarian)
+        self.first_reader = User.objects.create_user(username='first', password='2HJ1vRV0Z&3iD')
+        self.second_reader = User.objects.create_user(username='second', password='3HJ1vRV0Z&3iD')
+        book = Book.objects.create(title='Emma', summary='Summary', isbn='ISBN1')
+        today = datetime.date.today()
+        self.overdue = [
+            BookInstance.objects.create(book=book, imprint='Imprint', status='o', borrower=self.first_reader, due_back=today - datetime.timedelta(days=10)),
+            BookInstance.objects.create(book=book, imprint='Imprint', status='o', borrower=self.second_reader, due_back=today - datetime.timedelta(days=3)),
+            BookInstance.objects.create(book=book, imprint='Imprint', status='o', borrower=self.first_reader, due_back=today - datetime.timedelta(days=1)),
+        ]
+        #Due today, on loan but not overdue, and returned late
+        BookInstance.objects.create(book=book, imprint='Imprint', status='o', borrower=self.second_reader, due_back=today)
+        BookInstance.objects.create(book=book, imprint='Imprint', status='o', borrower=self.second_reader, due_back=today + datetime.timedelta(days=5))
+        BookInstance.objects.create(book=book, imprint='Imprint', status='a', due_back=today - datetime.timedelta(days=5))
+        response = self.client.post(reverse('token_obtain_pair'), {'username': 'librarian', 'password': '1X<ISRUkw+tuK'}, format='json')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {response.json()["access"]}')
+
+    def test_overdue_loans_are_paginated_with_their_counts(self):
+        response = self.client.get(reverse('borrowed-books-api-overdue'), {'page_size': 2})
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual((response.json()['count'], response.json()['borrowers']), (3, 2))
+        self.assertEqual([copy['id'] for copy in response.json()['results']], [str(copy.id) for copy in self.overdue[:2]])
+        self.assertEqual([copy['days_overdue'] for copy in response.json()['results']], [10, 3])
+
+        response = self.client.get(response.json()['next'])
+        self.assertEqual(response.json()['count'], 3)
+        self.assertEqual([copy['id'] for copy in response.json()['results']], [str(self.overdue[2].id)])
+        self.assertEqual(response.json()['results'][0]['borrower'], 'first')
+        self.assertIsNone(response.json()['next'])
+
+    #The cache is only used when it is shared by the worker processes
+    @override_settings(API_CACHE_ALIAS='default')
+    def test_overdue_loans_query_count(self):
+        #The user, the librarian check, the two counts and the page
+        with self.assertNumQueries(5):
+            self.client.get(reverse('borrowed-books-api-overdue'))
+        #The librarian check and the counts are cached
+        with self.assertNumQueries(2):
+            self.client.get(reverse('borrowed-books-api-overdue'))
+
+    def test_only_librarians_see_overdue_loans(self):
+        response = self.client.post(reverse('token_obtain_pair'), {'username': 'first', 'password': '2HJ1vRV0Z&3iD'}, format='json')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {response.json()["access"]}')
+        response = self.client.get(reverse('borrowed-books-api-overdue'))
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+
+
+class BookAvailabilityApiTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.books = [Book.objects.create(title=f'Book {book_id}', summary='Summary', isbn=f'ISBN{book_id}') for book_id in range(4)]
+        #Book 1 has two available copies, book 3 one, book 0 only one on loan and book 2 none
+        for book, status in ((1, 'a'), (1, 'a'), (3, 'a'), (0, 'o'), (3, 'm')):
+            BookInstance.objects.create(book=self.books[book], imprint='Imprint', status=status)
+
+    def titles(self, response):
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return [book['title'] for book in response.json()['results']]
+
+    def test_available_books(self):
+        response = self.client.get(reverse('book-api-list'), {'available': 'true'})
+        self.assertEqual(self.titles(response), ['Book 1', 'Book 3'])
+        self.assertEqual(
+            [(book['total_copies'], book['available_copies']) for book in response.json()['results']],
+            [(2, 2), (2, 1)],
+        )
+
+    def test_ordering_by_availability(self):
+        response = self.client.get(reverse('book-api-list'), {'ordering': 'availability', 'page_size': 2})
+        self.assertEqual(self.titles(response), ['Book 1', 'Book 3'])
+        self.assertEqual(response.json()['count'], 4)
+        #Books with the same number of available copies are ordered by title
+        response = self.client.get(response.json()['next'])
+        self.assertEqual(self.titles(response), ['Book 0', 'Book 2'])
+        self.assertIsNone(response.json()['next'])
+
+    def test_unknown_ordering(self):
+        response = self.client.get(reverse('book-api-list'), {'ordering': 'isbn'})
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_list_follows_loans(self):
+        self.assertEqual(self.titles(self.client.get(reverse('book-api-list'), {'available': 'true'})), ['Book 1', 'Book 3'])
+        copy = BookInstance.objects.get(book=self.books[3], status='a')
+        copy.status = 'o'
+        copy.save()
+        self.assertEqual(self.titles(self.client.get(reverse('book-api-list'), {'available': 'true'})), ['Book 1'])
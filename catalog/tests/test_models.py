@@ -1,7 +1,21 @@
 from django.test import TestCase
-from catalog.models import Author, Genre, Language, Book, BookInstance
+from catalog.models import Author, Genre, Language, Book, BookInstance, CatalogStats
 from django.contrib.auth.models import User
 import datetime
+import io
+import os
+import shutil
+import tempfile
+from unittest import mock
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.contrib.auth.models import Group
+from django.test.utils import CaptureQueriesContext
+from rest_framework.reverse import reverse
+from rest_framework.test import APIClient
 
 
 class AuthorModelTest(TestCase):
@@ -295,6 +309,24 @@ class BookInstanceModelTest(TestCase):
         bookinstance.save()
         self.assertEqual(bookinstance.is_overdue,False)
 
+    def test_is_overdue_is_computed_by_the_query(self):
+        bookinstance = BookInstance.objects.get(id='33d9b5fa-4db1-485b-b69c-7e15f9acea69')
+        bookinstance.status = 'o'
+        bookinstance.due_back = datetime.date.today() - datetime.timedelta(days=1)
+        bookinstance.save()
+        self.assertEqual(list(BookInstance.objects.overdue()), [bookinstance])
+        self.assertEqual(list(BookInstance.objects.overdue(today=bookinstance.due_back)), [])
+        self.assertEqual(BookInstance.objects.overdue().get().days_overdue, datetime.timedelta(days=1))
+        later = datetime.date.today() + datetime.timedelta(days=30)
+        self.assertEqual(BookInstance.objects.overdue(today=later).get().days_overdue, datetime.timedelta(days=31))
+        self.assertEqual(list(BookInstance.objects.due_before(datetime.date.today())), [bookinstance])
+        annotated = BookInstance.objects.annotate_overdue().get(pk=bookinstance.pk)
+        self.assertIs(annotated.overdue, True)
+        with self.assertNumQueries(0):
+            self.assertIs(annotated.is_overdue, True)
+        annotated = BookInstance.objects.annotate_overdue(today=bookinstance.due_back).get(pk=bookinstance.pk)
+        self.assertIs(annotated.is_overdue, False)
+
     def test_name_is_id_and_title(self):
         bookinstance = BookInstance.objects.get(id='33d9b5fa-4db1-485b-b69c-7e15f9acea69')
         bookid = str(bookinstance.id)
@@ -304,3 +336,338 @@ class BookInstanceModelTest(TestCase):
 
 
 
+
+
+class CatalogStatsModelTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        test_language = Language.objects.create(name = 'TestLanguage')
+        test_author = Author.objects.create(first_name='TestFirstName', last_name='TestLastName')
+        Genre.objects.create(name = 'High Fantasy')
+        Genre.objects.create(name = 'Horror')
+
+        test_book = Book.objects.create(
+            title ='The Lord of the Rings',
+            author = test_author,
+            language = test_language,
+            isbn = '1234567891011',
+            summary= 'TestSummary',
+        )
+        BookInstance.objects.create(
+            id = '33d9b5fa-4db1-485b-b69c-7e15f9acea69',
+            book = test_book,
+            imprint = 'test_imprint',
+            status = 'a',
+        )
+        BookInstance.objects.create(
+            id = '33d9b5fa-4db1-485b-b69c-7e15f9acea70',
+            book = test_book,
+            imprint = 'test_imprint',
+        )
+
+    def assertStatsMatchCatalog(self):
+        stats = CatalogStats.load()
+        for field, value in CatalogStats.compute().items():
+            self.assertEqual(getattr(stats, field), value, field)
+
+    def test_counts_after_create(self):
+        stats = CatalogStats.load()
+        self.assertEqual(stats.num_books, 1)
+        self.assertEqual(stats.num_instances, 2)
+        self.assertEqual(stats.num_instances_available, 1)
+        self.assertEqual(stats.num_authors, 1)
+        self.assertEqual(stats.num_fantasy_genres, 1)
+        self.assertEqual(stats.num_lotr_books, 1)
+
+    def test_counts_after_status_change(self):
+        bookinstance = BookInstance.objects.get(id='33d9b5fa-4db1-485b-b69c-7e15f9acea70')
+        bookinstance.status = 'a'
+        bookinstance.save()
+        self.assertEqual(CatalogStats.load().num_instances_available, 2)
+        bookinstance.status = 'o'
+        bookinstance.save()
+        self.assertEqual(CatalogStats.load().num_instances_available, 1)
+        self.assertStatsMatchCatalog()
+
+    def test_counts_after_rename(self):
+        book = Book.objects.get(id=1)
+        book.title = 'The Hobbit'
+        book.save()
+        genre = Genre.objects.get(name='Horror')
+        genre.name = 'Dark Fantasy'
+        genre.save()
+        stats = CatalogStats.load()
+        self.assertEqual(stats.num_lotr_books, 0)
+        self.assertEqual(stats.num_fantasy_genres, 2)
+        self.assertStatsMatchCatalog()
+
+    def test_update_fields_without_tracked_field(self):
+        bookinstance = BookInstance.objects.get(id='33d9b5fa-4db1-485b-b69c-7e15f9acea69')
+        bookinstance.due_back = datetime.date.today()
+        with self.assertNumQueries(1):
+            bookinstance.save(update_fields=['due_back'])
+        self.assertStatsMatchCatalog()
+
+    def test_counts_after_delete(self):
+        BookInstance.objects.get(id='33d9b5fa-4db1-485b-b69c-7e15f9acea69').delete()
+        Author.objects.get(id=1).delete()
+        Genre.objects.get(name='High Fantasy').delete()
+        stats = CatalogStats.load()
+        self.assertEqual(stats.num_instances, 1)
+        self.assertEqual(stats.num_instances_available, 0)
+        self.assertEqual(stats.num_authors, 0)
+        self.assertEqual(stats.num_fantasy_genres, 0)
+        self.assertStatsMatchCatalog()
+
+    def test_compute_is_a_single_query(self):
+        with self.assertNumQueries(1):
+            counts = CatalogStats.compute()
+        self.assertEqual(counts, {
+            'num_books': 1,
+            'num_instances': 2,
+            'num_instances_available': 1,
+            'num_authors': 1,
+            'num_fantasy_genres': 1,
+            'num_lotr_books': 1,
+        })
+
+    def test_compute_empty_catalog(self):
+        BookInstance.objects.all().delete()
+        Book.objects.all().delete()
+        with self.assertNumQueries(1):
+            counts = CatalogStats.compute()
+        self.assertEqual(counts['num_books'], 0)
+        self.assertEqual(counts['num_instances'], 0)
+        self.assertEqual(counts['num_authors'], 1)
+
+    def test_load_rebuilds_missing_snapshot(self):
+        CatalogStats.objects.all().delete()
+        self.assertStatsMatchCatalog()
+
+    def test_rebuild_after_bulk_update(self):
+        #QuerySet.update() does not send signals so the snapshot has to be rebuilt by hand
+        BookInstance.objects.update(status='a')
+        CatalogStats.rebuild()
+        self.assertEqual(CatalogStats.load().num_instances_available, 2)
+
+    def test_rebuild_catalog_stats_command(self):
+        CatalogStats.objects.update(num_books=5, num_instances_available=0)
+        stdout = io.StringIO()
+        call_command('rebuild_catalog_stats', stdout=stdout)
+        self.assertIn('Rebuilt the catalog stats: 1 books, 2 copies, 1 authors.', stdout.getvalue())
+        self.assertStatsMatchCatalog()
+
+
+class BookCopyCountersTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title='Emma', summary='Summary', isbn='1234567891011')
+        cls.other_book = Book.objects.create(title='Persuasion', summary='Summary', isbn='1234567891012')
+        cls.copy = BookInstance.objects.create(book=cls.book, imprint='test_imprint', status='a')
+        BookInstance.objects.create(book=cls.book, imprint='test_imprint', status='o')
+
+    def assertCounters(self, book, total, available):
+        book.refresh_from_db()
+        self.assertEqual((book.total_copies, book.available_copies), (total, available))
+
+    def test_counters_after_create(self):
+        self.assertCounters(self.book, 2, 1)
+        self.assertCounters(self.other_book, 0, 0)
+
+    def test_counters_after_status_change(self):
+        self.copy.status = 'o'
+        self.copy.save()
+        self.assertCounters(self.book, 2, 0)
+        self.copy.status = 'a'
+        self.copy.save(update_fields=['status'])
+        self.assertCounters(self.book, 2, 1)
+
+    def test_saving_a_book_keeps_the_counters(self):
+        #Loaded before the copy was added, e.g. by an edit form or a PUT of the api
+        stale_book = Book.objects.get(pk=self.other_book.pk)
+        BookInstance.objects.create(book=self.other_book, imprint='test_imprint', status='a')
+        stale_book.title = 'Persuasion (new edition)'
+        stale_book.save()
+        self.assertCounters(self.other_book, 1, 1)
+        self.assertEqual(self.other_book.title, 'Persuasion (new edition)')
+
+    def test_counters_after_moving_a_copy(self):
+        self.copy.book = self.other_book
+        self.copy.save()
+        self.assertCounters(self.book, 1, 0)
+        self.assertCounters(self.other_book, 1, 1)
+
+    def test_counters_after_delete(self):
+        self.copy.delete()
+        self.assertCounters(self.book, 1, 0)
+
+    def test_unrelated_change_does_not_touch_the_counters(self):
+        self.copy.due_back = datetime.date.today()
+        with self.assertNumQueries(1):
+            self.copy.save(update_fields=['due_back'])
+        self.assertCounters(self.book, 2, 1)
+
+    def test_reconcile_after_bulk_update(self):
+        #QuerySet.update() does not send signals so the counters have to be recomputed
+        BookInstance.objects.update(status='a')
+        self.assertCounters(self.book, 2, 1)
+        stdout = io.StringIO()
+        call_command('reconcile_copy_counters', batch_size=1, stdout=stdout)
+        self.assertIn('Checked 2 books, fixed the copy counters of 1.', stdout.getvalue())
+        self.assertCounters(self.book, 2, 2)
+        self.assertEqual(Book.update_copy_counters(), 0)
+
+
+class OverdueNoticeCommandTest(TestCase):
+    '''The test runner replaces EMAIL_BACKEND with the locmem backend, which keeps the messages in mail.outbox'''
+    @classmethod
+    def setUpTestData(cls):
+        today = datetime.date.today()
+        book = Book.objects.create(title='Pride & Prejudice', isbn='1234567891011', summary='TestSummary')
+        cls.borrowers = [
+            User.objects.create_user(username=f'reader{number}', email=f'reader{number}@example.com', password='1X<ISRUkw+tuK')
+            for number in range(3)
+        ]
+        no_email = User.objects.create_user(username='noemail', password='1X<ISRUkw+tuK')
+        for borrower, days in [(cls.borrowers[0], -2), (cls.borrowers[0], 1), (cls.borrowers[1], 3), (cls.borrowers[2], -1), (no_email, -1)]:
+            BookInstance.objects.create(book=book, imprint='Imprint', status='o', borrower=borrower, due_back=today + datetime.timedelta(days=days))
+        #Not due soon, and not on loan
+        BookInstance.objects.create(book=book, imprint='Imprint', status='o', borrower=cls.borrowers[1], due_back=today + datetime.timedelta(days=10))
+        BookInstance.objects.create(book=book, imprint='Imprint', status='a', due_back=today - datetime.timedelta(days=10))
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.checkpoint = os.path.join(self.directory, 'checkpoint.json')
+
+    def send(self, **options) -> str:
+        stdout = io.StringIO()
+        call_command('send_overdue_notices', stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def test_one_notice_per_borrower(self):
+        output = self.send(batch_size=2)
+        self.assertIn('Sent 3 notices about 4 loans, skipped 1 borrowers without an email address.', output)
+        self.assertEqual([message.to for message in mail.outbox], [[borrower.email] for borrower in self.borrowers])
+        self.assertEqual([message.subject for message in mail.outbox], ['Overdue library books', 'Library books due back soon', 'Overdue library books'])
+        self.assertEqual(mail.outbox[0].body.count('Pride & Prejudice'), 2)
+        self.assertEqual(mail.outbox[0].body.count('(overdue)'), 1)
+
+    def test_loans_are_read_in_one_query(self):
+        #The loans, whatever the number of borrowers
+        with self.assertNumQueries(1):
+            self.send(batch_size=1)
+
+    def test_interrupted_run_resumes_after_the_last_batch(self):
+        send_messages = EmailBackend.send_messages
+        calls = []
+        def fail_on_second_batch(backend, messages):
+            calls.append(messages)
+            if len(calls) == 2:
+                raise ConnectionError('The mail server went away')
+            return send_messages(backend, messages)
+
+        with mock.patch.object(EmailBackend, 'send_messages', fail_on_second_batch):
+            with self.assertRaises(ConnectionError):
+                self.send(batch_size=1, checkpoint=self.checkpoint)
+        self.assertEqual([message.to for message in mail.outbox], [[self.borrowers[0].email]])
+
+        output = self.send(batch_size=1, checkpoint=self.checkpoint)
+        self.assertIn(f'Resuming after borrower {self.borrowers[0].pk}.', output)
+        self.assertEqual([message.to for message in mail.outbox], [[borrower.email] for borrower in self.borrowers])
+
+        #The run of the day is done
+        output = self.send(checkpoint=self.checkpoint)
+        self.assertIn('were already sent', output)
+        self.assertEqual(len(mail.outbox), 3)
+        self.send(checkpoint=self.checkpoint, restart=True)
+        self.assertEqual(len(mail.outbox), 6)
+
+    def test_checkpoint_of_other_options_is_ignored(self):
+        self.send(checkpoint=self.checkpoint)
+        self.send(checkpoint=self.checkpoint, days_ahead=0)
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_invalid_options(self):
+        with self.assertRaises(CommandError):
+            self.send(batch_size=0)
+        with self.assertRaises(CommandError):
+            self.send(days_ahead=-1)
+
+
+class BookInstanceIndexTest(TestCase):
+    '''Checks with EXPLAIN that the loan queries are answered from an index instead of sorting the table'''
+    @classmethod
+    def setUpTestData(cls):
+        cls.borrower = User.objects.create_user(username='testuser1', password='1X<ISRUkw+tuK')
+        test_book = Book.objects.create(title='TestBook', isbn='1234567891011', summary='TestSummary')
+        for day in range(20):
+            BookInstance.objects.create(
+                book=test_book,
+                imprint='test_imprint',
+                status='o' if day % 2 else 'a',
+                borrower=cls.borrower if day % 2 else None,
+                due_back=datetime.date.today() + datetime.timedelta(days=day),
+            )
+
+    def explain(self, query) -> str:
+        '''Returns the plan of a queryset, or of the SQL of a query that was run'''
+        if connection.vendor == 'postgresql':
+            #The tables in the tests are tiny, so the planner would rather read the whole table
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        elif connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN output is only checked on SQLite and PostgreSQL')
+        if not isinstance(query, str):
+            return query.explain()
+        with connection.cursor() as cursor:
+            cursor.execute(('EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN ') + query)
+            return '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+
+    def endpoint_queries(self, url: str) -> list:
+        '''Returns the SQL of the queries on the copies run by a GET of the api, as a librarian'''
+        Group.objects.get_or_create(name='Librarians')[0].user_set.add(self.borrower)
+        client = APIClient()
+        response = client.post(reverse('token_obtain_pair'), {'username': 'testuser1', 'password': '1X<ISRUkw+tuK'}, format='json')
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {response.json()["access"]}')
+        with CaptureQueriesContext(connection) as context:
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.next_url = response.json()['next']
+        return [query['sql'] for query in context.captured_queries if 'FROM "catalog_bookinstance"' in query['sql']]
+
+    def assertUsesIndex(self, queryset, *index_names):
+        plan = self.explain(queryset)
+        self.assertTrue(any(index_name in plan for index_name in index_names), plan)
+        #The rows come out of the index already in due_back order
+        self.assertNotIn('TEMP B-TREE', plan.upper())
+        self.assertNotIn('SORT', plan.upper())
+
+    def test_all_borrowed_books_query(self):
+        #The queries run by the api, for the first page and the next one (whose cursor filters on the due date and id)
+        queries = self.endpoint_queries(reverse('borrowed-books-api-list') + '?page_size=3')
+        queries += self.endpoint_queries(self.next_url)
+        self.assertEqual(len(queries), 2)
+        for query in queries:
+            self.assertNotIn('OFFSET', query)
+            self.assertUsesIndex(query, 'bookinstance_on_loan_idx', 'bookinstance_status_due_idx')
+
+    def test_borrowed_books_by_user_query(self):
+        queryset = BookInstance.objects.filter(borrower=self.borrower).filter(status__exact='o').order_by('due_back')
+        self.assertUsesIndex(queryset, 'bookinstance_borrower_idx')
+
+    def test_overdue_query(self):
+        self.assertUsesIndex(BookInstance.objects.overdue().order_by('due_back', 'id'), 'bookinstance_on_loan_idx', 'bookinstance_status_due_idx')
+
+    def test_overdue_notices_query(self):
+        #The query of send_overdue_notices, resumed after a borrower
+        queryset = (
+            BookInstance.objects.due_before(datetime.date.today() + datetime.timedelta(days=3))
+            .filter(borrower_id__gt=0)
+            .select_related('book', 'borrower')
+            .order_by('borrower_id', 'due_back', 'id')
+        )
+        #Without statistics SQLite guesses that few copies have a given status and would rather sort them
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        self.assertUsesIndex(queryset, 'bookinstance_borrower_loan_idx')
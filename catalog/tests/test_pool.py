@@ -0,0 +1,226 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from unittest import mock, skipUnless
+from django.contrib.auth.models import User, Group
+from django.core.exceptions import ImproperlyConfigured
+from django.db.utils import load_backend
+from django.test import SimpleTestCase
+from http import HTTPStatus
+from rest_framework.reverse import reverse
+from rest_framework.test import APITestCase
+from locallibrary.db_pool import ConnectionPool, PoolTimeout, close_pools, pooled_engine
+
+
+class ConnectionPoolTest(SimpleTestCase):
+    '''Tests the pool with connections to a throwaway SQLite database'''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'pool.sqlite3')
+        self.opened = []
+
+    def tearDown(self):
+        for connection in self.opened:
+            connection.close()
+        shutil.rmtree(self.directory)
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.opened.append(connection)
+        return connection
+
+    def test_released_connections_are_reused(self):
+        pool = ConnectionPool(max_size=2)
+        connection = pool.acquire(self.connect)
+        pool.release(connection)
+        self.assertIs(pool.acquire(self.connect), connection)
+        self.assertEqual(pool.stats()['opened'], 1)
+        self.assertEqual(pool.stats()['checkouts'], 2)
+
+    def test_uncommitted_changes_are_rolled_back_on_release(self):
+        pool = ConnectionPool()
+        connection = pool.acquire(self.connect)
+        connection.execute('CREATE TABLE book (title TEXT)')
+        connection.commit()
+        connection.execute("INSERT INTO book VALUES ('Uncommitted')")
+        pool.release(connection)
+        connection = pool.acquire(self.connect)
+        self.assertEqual(connection.execute('SELECT COUNT(*) FROM book').fetchone(), (0,))
+
+    def test_session_is_reset_on_release(self):
+        pool = ConnectionPool()
+        connection = pool.acquire(self.connect)
+        reset = []
+        pool.release(connection, reset=reset.append)
+        self.assertEqual(reset, [connection])
+        self.assertIs(pool.acquire(self.connect), connection)
+
+    def test_connections_that_can_not_be_reset_are_closed(self):
+        pool = ConnectionPool()
+        connection = pool.acquire(self.connect)
+
+        def fail(connection):
+            raise sqlite3.OperationalError('reset failed')
+        pool.release(connection, reset=fail)
+        self.assertIsNot(pool.acquire(self.connect), connection)
+        self.assertEqual(pool.stats()['closed'], 1)
+
+    def test_full_pool_waits_for_a_connection(self):
+        pool = ConnectionPool(max_size=1, timeout=5)
+        connection = pool.acquire(self.connect)
+        threading.Timer(0.2, pool.release, [connection]).start()
+        self.assertIs(pool.acquire(self.connect), connection)
+        stats = pool.stats()
+        self.assertGreaterEqual(stats['max_wait_ms'], 150)
+        self.assertEqual(stats['size'], 1)
+
+    def test_full_pool_times_out(self):
+        pool = ConnectionPool(max_size=1, timeout=0.1)
+        pool.acquire(self.connect)
+        with self.assertRaises(PoolTimeout), self.assertLogs('locallibrary.db_pool', 'WARNING'):
+            pool.acquire(self.connect)
+        self.assertEqual(pool.stats()['timeouts'], 1)
+
+    def test_broken_connections_are_replaced(self):
+        pool = ConnectionPool(pre_ping=True)
+        connection = pool.acquire(self.connect)
+        pool.release(connection)
+        #e.g. the database server restarted while the connection was idle
+        connection.close()
+        new_connection = pool.acquire(self.connect)
+        self.assertIsNot(new_connection, connection)
+        self.assertEqual(new_connection.execute('SELECT 1').fetchone(), (1,))
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_connections_are_closed_after_their_lifetime(self):
+        pool = ConnectionPool(max_lifetime=60)
+        connection = pool.acquire(self.connect)
+        pool.release(connection)
+        with mock.patch('locallibrary.db_pool.time.monotonic', return_value=time.monotonic() + 61):
+            new_connection = pool.acquire(self.connect)
+        self.assertIsNot(new_connection, connection)
+        self.assertEqual(pool.stats()['closed'], 1)
+
+    def test_idle_connections_over_the_minimum_are_closed(self):
+        pool = ConnectionPool(min_size=1, max_size=3, max_idle=60)
+        connections = [pool.acquire(self.connect) for _ in range(3)]
+        for connection in connections[:2]:
+            pool.release(connection)
+        with mock.patch('locallibrary.db_pool.time.monotonic', return_value=time.monotonic() + 61):
+            pool.release(connections[2])
+        stats = pool.stats()
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['idle'], 1)
+
+    def test_failed_connect_frees_its_slot(self):
+        pool = ConnectionPool(max_size=1, timeout=0.1)
+        with self.assertRaises(sqlite3.OperationalError):
+            pool.acquire(lambda: sqlite3.connect(os.path.join(self.directory, 'missing', 'pool.sqlite3')))
+        self.assertIsNotNone(pool.acquire(self.connect))
+
+
+class PooledBackendTest(SimpleTestCase):
+    '''Tests the pooled database backends against a throwaway database'''
+    def wrapper(self, settings_dict):
+        backend = load_backend(settings_dict['ENGINE'])
+        return backend.DatabaseWrapper({
+            'ATOMIC_REQUESTS': False,
+            'AUTOCOMMIT': True,
+            'CONN_MAX_AGE': 0,
+            'OPTIONS': {},
+            'TIME_ZONE': None,
+            'USER': '',
+            'PASSWORD': '',
+            'HOST': '',
+            'PORT': '',
+            'TEST': {},
+            **settings_dict,
+        }, alias='pool-test')
+
+    def check_connections_are_reused(self, settings_dict):
+        first = self.wrapper(settings_dict)
+        with first.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        raw_connection = first.connection
+        first.close()
+
+        #Another thread, e.g. the next request
+        second = self.wrapper(settings_dict)
+        with second.cursor() as cursor:
+            cursor.execute('SELECT 1')
+            self.assertEqual(cursor.fetchone(), (1,))
+        self.assertIs(second.connection, raw_connection)
+        self.assertEqual(second._pool.stats()['opened'], 1)
+        second.close()
+        close_pools('pool-test')
+
+    def test_sqlite(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.check_connections_are_reused({
+            'ENGINE': 'locallibrary.db_pool.sqlite3',
+            'NAME': os.path.join(directory, 'pool.sqlite3'),
+            'POOL': {'MAX_SIZE': 2},
+        })
+
+    @skipUnless(os.environ.get('POOL_TEST_DATABASE_URL'), 'Set POOL_TEST_DATABASE_URL to a throwaway PostgreSQL database')
+    def test_postgresql(self):
+        import dj_database_url
+        settings_dict = dj_database_url.parse(os.environ['POOL_TEST_DATABASE_URL'])
+        self.check_connections_are_reused({**settings_dict, 'ENGINE': 'locallibrary.db_pool.postgresql', 'POOL': {'MAX_SIZE': 2}})
+
+    @skipUnless(os.environ.get('POOL_TEST_DATABASE_URL'), 'Set POOL_TEST_DATABASE_URL to a throwaway PostgreSQL database')
+    def test_postgresql_session_is_reset(self):
+        import dj_database_url
+        settings_dict = {
+            **dj_database_url.parse(os.environ['POOL_TEST_DATABASE_URL']),
+            'ENGINE': 'locallibrary.db_pool.postgresql',
+            'POOL': {'MAX_SIZE': 1},
+        }
+        first = self.wrapper(settings_dict)
+        with first.cursor() as cursor:
+            cursor.execute('SHOW statement_timeout')
+            default_timeout = cursor.fetchone()
+            cursor.execute("SET statement_timeout = '1s'")
+            cursor.execute("SET TIME ZONE 'Asia/Tokyo'")
+        first.close()
+
+        second = self.wrapper(settings_dict)
+        with second.cursor() as cursor:
+            cursor.execute('SHOW statement_timeout')
+            self.assertEqual(cursor.fetchone(), default_timeout)
+            cursor.execute('SHOW TIME ZONE')
+            self.assertEqual(cursor.fetchone(), ('UTC',))
+        second.close()
+        close_pools('pool-test')
+
+    def test_unsupported_engine(self):
+        self.assertEqual(pooled_engine('django.db.backends.sqlite3'), 'locallibrary.db_pool.sqlite3')
+        with self.assertRaises(ImproperlyConfigured):
+            pooled_engine('django.db.backends.mysql')
+
+
+class DatabasePoolApiTest(APITestCase):
+    def setUp(self):
+        Group.objects.create(name='Librarians')
+        librarian = User.objects.create_user(username='librarian', password='1X<ISRUkw+tuK')
+        Group.objects.get(name='Librarians').user_set.add(librarian)
+        User.objects.create_user(username='reader', password='2HJ1vRV0Z&3iD')
+
+    def login(self, username, password):
+        response = self.client.post(reverse('token_obtain_pair'), {'username': username, 'password': password}, format='json')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {response.json()["access"]}')
+
+    def test_only_librarians_can_read_the_statistics(self):
+        self.login('reader', '2HJ1vRV0Z&3iD')
+        response = self.client.get(reverse('db-pool-api'))
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+
+        self.login('librarian', '1X<ISRUkw+tuK')
+        response = self.client.get(reverse('db-pool-api'))
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response.json()['pid'], os.getpid())
+        self.assertIn('pools', response.json())
@@ -0,0 +1,90 @@
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User, Group
+from catalog.roles import is_librarian
+
+
+@override_settings(LIBRARIAN_CACHE_ALIAS='default')
+class LibrarianCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.librarian = User.objects.create_user(username='testuser1', password='1X<ISRUkw+tuK')
+        self.user = User.objects.create_user(username='testuser2', password='2HJ1vRV0Z&3iD')
+        self.librarian_group = Group.objects.create(name='Librarians')
+        self.librarian_group.user_set.add(self.librarian)
+
+    def test_membership(self):
+        self.assertTrue(is_librarian(self.librarian))
+        self.assertFalse(is_librarian(self.user))
+
+    def test_cached_lookup_does_not_query(self):
+        is_librarian(self.librarian)
+        with self.assertNumQueries(0):
+            self.assertTrue(is_librarian(self.librarian))
+
+    def test_removed_from_group_by_user(self):
+        self.assertTrue(is_librarian(self.librarian))
+        self.librarian.groups.remove(self.librarian_group)
+        self.assertFalse(is_librarian(self.librarian))
+
+    def test_removed_from_group_by_group(self):
+        self.assertTrue(is_librarian(self.librarian))
+        self.librarian_group.user_set.remove(self.librarian)
+        self.assertFalse(is_librarian(self.librarian))
+
+    def test_added_to_group(self):
+        self.assertFalse(is_librarian(self.user))
+        self.user.groups.add(self.librarian_group)
+        self.assertTrue(is_librarian(self.user))
+
+    def test_group_cleared(self):
+        self.assertTrue(is_librarian(self.librarian))
+        self.librarian_group.user_set.clear()
+        self.assertFalse(is_librarian(self.librarian))
+
+    def test_user_groups_cleared(self):
+        self.assertTrue(is_librarian(self.librarian))
+        self.librarian.groups.clear()
+        self.assertFalse(is_librarian(self.librarian))
+
+    def test_group_deleted(self):
+        self.assertTrue(is_librarian(self.librarian))
+        self.librarian_group.delete()
+        self.assertFalse(is_librarian(self.librarian))
+
+    def test_group_renamed(self):
+        self.assertTrue(is_librarian(self.librarian))
+        self.librarian_group.name = 'Former Librarians'
+        self.librarian_group.save()
+        self.assertFalse(is_librarian(self.librarian))
+
+    def test_invalidated_again_on_commit(self):
+        self.assertTrue(is_librarian(self.librarian))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.librarian.groups.remove(self.librarian_group)
+            #Another request caches the membership it read before the commit
+            cache.set(f'catalog:is_librarian:{self.librarian.pk}', True)
+        self.assertFalse(is_librarian(self.librarian))
+
+    @override_settings(LIBRARIAN_CACHE_ALIAS=None, API_CACHE_ALIAS=None)
+    def test_not_cached_without_a_shared_cache(self):
+        is_librarian(self.librarian)
+        with self.assertNumQueries(1):
+            self.assertTrue(is_librarian(self.librarian))
+
+    @override_settings(
+        LIBRARIAN_CACHE_ALIAS='librarians',
+        CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'librarians': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'librarians'},
+        },
+    )
+    def test_shared_cache(self):
+        is_librarian(self.librarian)
+        with self.assertNumQueries(0):
+            self.assertTrue(is_librarian(self.librarian))
+        self.librarian.groups.remove(self.librarian_group)
+        self.assertFalse(is_librarian(self.librarian))
+
+    def test_anonymous_user(self):
+        self.assertFalse(is_librarian(None))
@@ -1,8 +1,11 @@
 from django import test
 from django.contrib.auth.decorators import login_required
 from django.http import response
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.core.cache import cache
 from django.views.generic.edit import DeleteView
 from catalog.models import Author
 import datetime
@@ -52,6 +55,12 @@ class AuthorListViewTest(TestCase):
         self.assertTrue(response.context['is_paginated'] == True)
         self.assertEqual(len(response.context['author_list']), 3)
 
+    def test_number_of_authors_comes_from_the_catalog_stats(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('authors')+'?page=2')
+        self.assertEqual(response.context['paginator'].count, 13)
+        self.assertFalse([query['sql'] for query in queries if 'COUNT(' in query['sql']])
+
 class LoanedBookInstancesByUserListViewTest(TestCase):
     def setUp(self):
         # Create two users
@@ -167,6 +176,23 @@ class LoanedBookInstancesByUserListViewTest(TestCase):
                 self.assertTrue(last_date <= book.due_back)
                 last_date = book.due_back
 
+    def test_count_is_updated_after_a_book_is_returned(self):
+        cache.clear()
+        for book in BookInstance.objects.filter(borrower__username='testuser1'):
+            book.status='o'
+            book.save()
+
+        login = self.client.login(username='testuser1', password='1X<ISRUkw+tuK')
+        response = self.client.get(reverse('my-borrowed'))
+        self.assertEqual(response.context['paginator'].count, 15)
+
+        returned_book = BookInstance.objects.filter(borrower__username='testuser1').first()
+        returned_book.status = 'a'
+        returned_book.save()
+        response = self.client.get(reverse('my-borrowed'))
+        self.assertEqual(response.context['paginator'].count, 14)
+
+
 class RenewBookInstancesViewTest(TestCase):
     def setUp(self):
         # Create a user
@@ -510,6 +536,55 @@ class BookListViewTest(TestCase):
         self.assertTrue(response.context['is_paginated'] == True)
         self.assertEqual(len(response.context['book_list']), 3)
 
+    #The cache is only used when it is shared by the worker processes
+    @override_settings(API_CACHE_ALIAS='default')
+    def test_number_of_queries_does_not_depend_on_books(self):
+        cache.clear()
+        #The first request counts the books, the authors are fetched along with the books
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('books'))
+        self.assertContains(response, 'Surname 0, Christian 0')
+        #The count comes from the cache until a book is written
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('books')+'?page=2')
+        self.assertEqual(response.context['paginator'].count, 13)
+
+    def test_number_of_books_comes_from_the_catalog_stats(self):
+        self.client.get(reverse('books'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('books')+'?page=2')
+        self.assertEqual(response.context['paginator'].count, 13)
+        self.assertFalse([query['sql'] for query in queries if 'COUNT(' in query['sql']])
+
+    def test_count_is_updated_after_a_book_is_created(self):
+        cache.clear()
+        response = self.client.get(reverse('books'))
+        self.assertEqual(response.context['paginator'].num_pages, 2)
+        for book_id in range(8):
+            Book.objects.create(title = f'New book {book_id}', summary = 'Book Summary', isbn = f'HIJKLMN{book_id}')
+        response = self.client.get(reverse('books'))
+        self.assertEqual(response.context['paginator'].count, 21)
+        self.assertEqual(response.context['paginator'].num_pages, 3)
+
+    #The cache is only used when it is shared by the worker processes
+    @override_settings(API_CACHE_ALIAS='default')
+    def test_cached_page_does_not_query_the_database(self):
+        cache.clear()
+        self.client.get(reverse('books'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('books'))
+        self.assertContains(response, 'BookTitle 0')
+
+    def test_cached_page_is_updated_after_an_author_is_renamed(self):
+        cache.clear()
+        response = self.client.get(reverse('books'))
+        self.assertContains(response, 'Surname 0, Christian 0')
+        author = Author.objects.get(last_name='Surname 0')
+        author.first_name = 'Renamed'
+        author.save()
+        response = self.client.get(reverse('books'))
+        self.assertContains(response, 'Surname 0, Renamed')
+
 
 class AuthorDetailViewTest(TestCase):
     @classmethod
@@ -537,6 +612,41 @@ class AuthorDetailViewTest(TestCase):
         response = self.client.get(reverse('author-detail',kwargs={'pk': 2}))
         self.assertEqual(response.status_code, 404)
 
+    def test_number_of_queries_does_not_depend_on_books(self):
+        author = Author.objects.get(id=1)
+        for book_id in range(20):
+            book = Book.objects.create(
+                title = f'Book Name {book_id}',
+                summary = 'Some summary',
+                isbn = f'ABCDEFGHI{book_id}',
+                author = author,
+            )
+            for copy_id in range(book_id % 4):
+                BookInstance.objects.create(book = book, imprint = 'Unlikely Imprint, 2016')
+
+        #One query for the author and one for their books with the number of copies of each
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('author-detail',kwargs={'pk': 1}))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Book Name 7</a> (3)')
+        self.assertContains(response, 'Book Name 8</a> (0)')
+
+    #The cache is only used when it is shared by the worker processes
+    @override_settings(API_CACHE_ALIAS='default')
+    def test_cached_fragment_is_updated_after_a_book_is_renamed(self):
+        cache.clear()
+        book = Book.objects.create(title = 'Old Name', summary = 'Some summary', isbn = 'ABCDEFGHI', author = Author.objects.get(id=1))
+        self.client.get(reverse('author-detail',kwargs={'pk': 1}))
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('author-detail',kwargs={'pk': 1}))
+        self.assertContains(response, 'Old Name')
+
+        book.title = 'New Name'
+        book.save()
+        response = self.client.get(reverse('author-detail',kwargs={'pk': 1}))
+        self.assertContains(response, 'New Name')
+        self.assertNotContains(response, 'Old Name')
+
 class BookDetailViewTest(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -574,6 +684,48 @@ class BookDetailViewTest(TestCase):
         response = self.client.get(reverse('book-detail',kwargs={'pk': 2}))
         self.assertEqual(response.status_code, 404)
 
+    def test_number_of_queries_does_not_depend_on_copies(self):
+        book = Book.objects.get(id=1)
+        for genre_id in range(5):
+            book.genre.add(Genre.objects.create(name = f'Genre {genre_id}'))
+        for copy_id in range(30):
+            BookInstance.objects.create(
+                book = book,
+                imprint = f'Imprint {copy_id}',
+                status = 'a' if copy_id % 2 else 'o',
+                due_back = datetime.date.today(),
+            )
+
+        #One query for the book with its author and language, one for the genres and one for the copies
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('book-detail',kwargs={'pk': 1}))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Imprint 29')
+        self.assertContains(response, 'Genre 4')
+
+    #The cache is only used when it is shared by the worker processes
+    @override_settings(API_CACHE_ALIAS='default')
+    def test_cached_fragment_is_used_until_a_copy_is_added(self):
+        cache.clear()
+        self.client.get(reverse('book-detail',kwargs={'pk': 1}))
+        #Only the book is fetched, the rest of the page comes from the cache
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('book-detail',kwargs={'pk': 1}))
+        self.assertContains(response, 'Book Name')
+
+        BookInstance.objects.create(book = Book.objects.get(id=1), imprint = 'New Imprint', status = 'a')
+        response = self.client.get(reverse('book-detail',kwargs={'pk': 1}))
+        self.assertContains(response, 'New Imprint')
+
+    def test_sidebar_is_not_cached(self):
+        cache.clear()
+        self.client.get(reverse('book-detail',kwargs={'pk': 1}))
+        User.objects.create_user(username='testuser1', password='1X<ISRUkw+tuK')
+        self.client.login(username='testuser1', password='1X<ISRUkw+tuK')
+        response = self.client.get(reverse('book-detail',kwargs={'pk': 1}))
+        self.assertContains(response, 'User: testuser1')
+        self.assertContains(response, 'Book Name')
+
 
 class AuthorUpdateViewTest(TestCase):
     @classmethod
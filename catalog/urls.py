@@ -12,8 +12,13 @@ from .api  import (
     UserBorrowedBooksApiView,
     AllBorrowedBooksApiViewset,
     BookViewSet,
+    BookExportApiView,
+    BookInstanceExportApiView,
+    BookSearchApiView,
+    DatabasePoolApiView,
+    LoanViewSet,
+    HoldViewSet,
 )
-from rest_framework_simplejwt.views import TokenRefreshView
 from . import custom_tokens
 
 
@@ -23,16 +28,22 @@ router.register('api/borrowed',AllBorrowedBooksApiViewset, 'borrowed-books-api')
 router.register('api/books',BookViewSet,'book-api')
 router.register('api/genres', GenreViewSet, 'genre-api')
 router.register('api/languages', LanguageViewSet, 'language-api')
+router.register('api/loans', LoanViewSet, 'loan-api')
+router.register('api/holds', HoldViewSet, 'hold-api')
 
 
 urlpatterns = [
     path('api/token/', custom_tokens.AddIsLibrarianClaimView.as_view(), name='token_obtain_pair'),#Views needed to use the simplejwt package
-    path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),#View needed to create a new access token once the current one expires
+    path('api/token/refresh/', custom_tokens.CachedBlacklistTokenRefreshView.as_view(), name='token_refresh'),#View needed to create a new access token once the current one expires
     path('api/register',RegisterApiView.as_view(), name='user-register-api'),#View needed to create
     path('api/logout', BlacklistRefreshView.as_view(), name="logout"),#API used to blacklist refresh token
     path('api/register-librarian', RegisterLibrarianApiView.as_view(), name='librarian-register-api'),#API used to register librarians
     path('api/home', HomePageApiView.as_view(),name = 'home-page'),
     path('api/users/<int:pk>/books', UserBorrowedBooksApiView.as_view(), name='mybooks-api'),
+    path('api/search', BookSearchApiView.as_view(), name='book-search-api'),#Full-text search over books
+    path('api/export/books', BookExportApiView.as_view(), name='book-export-api'),#Streams the whole catalog as NDJSON or CSV
+    path('api/export/bookinstances', BookInstanceExportApiView.as_view(), name='bookinstance-export-api'),
+    path('api/db-pool', DatabasePoolApiView.as_view(), name='db-pool-api'),#Connection pool statistics of the worker
 ]
 
 urlpatterns += router.urls
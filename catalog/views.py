@@ -1,8 +1,9 @@
 from django.contrib.auth.models import Permission
 from django.db.models.query import QuerySet
+from django.db.models import Count
 from django.shortcuts import render
 from django.http import HttpRequest, HttpResponse
-from .models import Book, Author, BookInstance, Genre
+from .models import Book, Author, BookInstance
 from django.views import generic
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.mixins import PermissionRequiredMixin
@@ -12,6 +13,9 @@ from django.shortcuts import get_object_or_404
 from django.http import HttpResponseRedirect
 from django.urls import reverse
 from catalog.forms import RenewBookForm
+from catalog.pagination import CachedCountPaginator
+from catalog.caching import FragmentCacheMixin
+from catalog.summary import catalog_summary
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
 from django.urls import reverse_lazy
 from catalog.models import Author
@@ -20,30 +24,14 @@ from catalog.models import Author
 def index(request: HttpRequest) -> HttpResponse:
     '''This function takes an HttpRequest for the homepage and uses the index.html template to render it'''
 
-    # Generate counts of some of the main objects
-    num_books = Book.objects.all().count()
-    num_instances = BookInstance.objects.all().count()
-
-    # Available books (status = 'a')
-    num_instances_available = BookInstance.objects.filter(status__exact='a').count()
-
-    num_fantasy_genres = Genre.objects.filter(name__icontains='Fantasy').count()
-
-    num_lotr_books = Book.objects.filter(title__icontains='Lord of the rings').count()
-
-    # The 'all()' is implied by default.
-    num_authors = Author.objects.count()
+    # Counts of some of the main objects, shared with the home page api (see catalog/summary.py)
+    summary = catalog_summary()
 
     num_visits = request.session.get('num_visits', 0)
     request.session['num_visits'] = num_visits + 1
 
     context = {
-        'num_books': num_books,
-        'num_instances': num_instances,
-        'num_instances_available': num_instances_available,
-        'num_authors': num_authors,
-        'num_fantasy_genres' : num_fantasy_genres,
-        'num_lotr_books' : num_lotr_books,
+        **summary,
         'num_visits' : num_visits,
     }
 
@@ -51,29 +39,48 @@ def index(request: HttpRequest) -> HttpResponse:
     return render(request, 'index.html', context=context)
 
 
-class BookListView(generic.ListView):
+class BookListView(FragmentCacheMixin, generic.ListView):
     model = Book
     paginate_by = 10
+    paginator_class = CachedCountPaginator
+    #The author of every book is shown in the list
+    queryset = Book.objects.select_related('author')
+    fragment_models = ('book', 'author')
 
 
-class BookDetailView(generic.DetailView):
+class BookDetailView(FragmentCacheMixin, generic.DetailView):
     model = Book
+    #The genres and copies of the book are only loaded by the template when the cached fragment has expired
+    queryset = Book.objects.select_related('author', 'language')
+    fragment_models = ('book', 'author', 'language', 'genre', 'bookinstance')
 
-class AuthorListView(generic.ListView):
+class AuthorListView(FragmentCacheMixin, generic.ListView):
     model = Author
     paginate_by = 10
+    paginator_class = CachedCountPaginator
+    fragment_models = ('author',)
+
+class AuthorDetailView(FragmentCacheMixin, generic.DetailView):
+    model = Author
+    fragment_models = ('author', 'book', 'bookinstance')
 
-class AuthorDetailView(generic.DetailView):
-    model = Author        
+    def get_context_data(self: 'AuthorDetailView', **kwargs) -> dict:
+        context = super().get_context_data(**kwargs)
+        #The books of the author are loaded in one query along with the number of copies of each book,
+        #only when the cached fragment has expired
+        context['books'] = self.object.book_set.annotate(num_copies=Count('bookinstance'))
+        return context
 
 class LoanedBooksByUserListView(LoginRequiredMixin,generic.ListView):
     """Generic class-based view listing books on loan to current user."""
     model = BookInstance
     template_name ='catalog/bookinstance_list_borrowed_user.html'
     paginate_by = 10
+    paginator_class = CachedCountPaginator
 
     def get_queryset(self: 'LoanedBooksByUserListView') -> QuerySet:
-        return BookInstance.objects.filter(borrower=self.request.user).filter(status__exact='o').order_by('due_back')
+        #The overdue flag of every row is computed by the query instead of being compared in the template
+        return BookInstance.objects.select_related('book').filter(borrower=self.request.user).on_loan().annotate_overdue().order_by('due_back')
 
 class BorrowedBooksListView(PermissionRequiredMixin, generic.ListView):
     '''This function allows Librarians to view all the books borrowed by users'''
@@ -81,9 +88,10 @@ class BorrowedBooksListView(PermissionRequiredMixin, generic.ListView):
     model = BookInstance
     template_name = 'catalog/bookinstance_list_all_borrowed.html'
     paginate_by = 10
+    paginator_class = CachedCountPaginator
 
     def get_queryset(self: 'BorrowedBooksListView') -> QuerySet:
-        return BookInstance.objects.filter(status__exact = 'o').order_by('due_back')
+        return BookInstance.objects.select_related('book', 'borrower').on_loan().annotate_overdue().order_by('due_back')
 
 @login_required
 @permission_required('catalog.can_mark_returned', raise_exception=True)
@@ -13,6 +13,13 @@ export interface AuthorAttributes extends AuthorDetails {
     id: number;
 }
 
+//A page of a list endpoint of the api, next and previous are the urls of the neighbouring pages (null at the ends)
+export type Page<T> = {
+    next: string|null,
+    previous: string|null,
+    results: T[]
+}
+
 export type UserLoginData = {
     username:string,
     password:string
@@ -3,6 +3,7 @@ import { AuthorDetails } from './CustomTypes'
 import { HomeData } from './components/pages/Home'
 import { 
 	AuthorAttributes,
+	Page,
 	UserLoginData,
 	Tokens
 } from './CustomTypes'
@@ -50,13 +51,12 @@ export class APIClient{
 		})
 	}
 
-	//Used to get a list of all the authors
-	public GetAuthorsList():Promise<AuthorAttributes[]>{
-		let authorList:AuthorAttributes[]
-		return APIClient.axiosInstance.get("/authors")
+	//Used to get a page of the list of the authors, the first one or the one at the url of the next link of a page
+	public GetAuthorsList(pageUrl:string = "/authors"):Promise<Page<AuthorAttributes>>{
+		return APIClient.axiosInstance.get(pageUrl)
 		.then(response=>{
-			authorList = response.data
-			return authorList
+			const authorPage:Page<AuthorAttributes> = response.data
+			return authorPage
 		})
 	}
 
@@ -25,6 +25,8 @@ function Authors() {
      * The error handling for this component has not been implemented yet.
      */
     const [authorList, setAuthorList] = useState<AuthorAttributes[]>([])
+    //The url of the next page of authors, null once every page was loaded
+    const [nextPage, setNextPage] = useState<string|null>(null)
 
     //When the page first loads up, make an api call to recieve a list of author objects
     //and save it in the state.
@@ -34,11 +36,24 @@ function Authors() {
          * We do not need to use the full URL and instead a relative URL can be used to access the endpoint
          */
         client.GetAuthorsList()
-        .then(AuthorList=>{
-            setAuthorList(AuthorList)
+        .then(AuthorPage=>{
+            setAuthorList(AuthorPage.results)
+            setNextPage(AuthorPage.next)
         })
     },[])
 
+    //Appends the next page of authors to the list
+    function loadNextPage(){
+        if (nextPage == null){
+            return
+        }
+        client.GetAuthorsList(nextPage)
+        .then(AuthorPage=>{
+            setAuthorList(authorList.concat(AuthorPage.results))
+            setNextPage(AuthorPage.next)
+        })
+    }
+
     //This function returns the AuthorListItem components. It is called in the return statement
     function setAuthorListItemComponent(authorList: AuthorAttributes[]){
         /**
@@ -91,6 +106,7 @@ function Authors() {
             <ul>
                 {setAuthorListItemComponent(authorList)}
             </ul>
+            {nextPage != null ? <button onClick={loadNextPage}>More authors</button> : null}
             {isLibrarian?createAuthorLink():null}
         </div>
     )
@@ -2,6 +2,7 @@ import React, { useState, useEffect } from 'react'
 import axios from 'axios'
 import { useRouteMatch } from 'react-router'
 import { BookListPresentation } from './BookListPresentation'
+import { Page } from '../../CustomTypes'
 
 // The attributes of a single book
 export type BookAttributes = {
@@ -24,16 +25,26 @@ export const BookListContainer = () => {
     let { url }: { url: string } = useRouteMatch(); // The url of this page
     let [books, setBooks]: [BookAttributes[] | undefined,
         React.Dispatch<React.SetStateAction<BookAttributes[] | undefined>>] = useState();   // The list of books
+    let [nextPage, setNextPage] = useState<string | null>(null);   // The url of the next page of books, null after the last one
 
 
-    useEffect(() => {
-
-        //Fetching the list of books using api call
-        axios.get("/catalog/api/books/")
+    // Fetches a page of books and appends it to the ones already loaded
+    const loadPage = (pageUrl: string, loadedBooks: BookAttributes[]) => {
+        axios.get(pageUrl)
             .then(
-                (result) => { setBooks(result.data); },
+                (result) => {
+                    const page: Page<BookAttributes> = result.data;
+                    setBooks(loadedBooks.concat(page.results));
+                    setNextPage(page.next);
+                },
                 (error) => { console.log(`Error! Could not fetch list of books.`) }
             )
+    }
+
+    useEffect(() => {
+
+        //Fetching the first page of books using api call
+        loadPage("/catalog/api/books/", []);
 
     }, []);
 
@@ -42,7 +53,10 @@ export const BookListContainer = () => {
     }
     return (
         // Book list is presented once the list of books is properly initialized
-        <BookListPresentation books={books} url={url} />
+        <div>
+            <BookListPresentation books={books} url={url} />
+            {nextPage !== null && <button onClick={() => loadPage(nextPage as string, books as BookAttributes[])}>More books</button>}
+        </div>
     )
 
 
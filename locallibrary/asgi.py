@@ -3,6 +3,10 @@ ASGI config for locallibrary project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The catalog views are synchronous: Django 3.2 has no async ORM and DRF views
+can't be awaited, so under ASGI every request runs in a worker thread. Serve
+the project with WSGI (see wsgi.py) until the ORM can be awaited.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 """
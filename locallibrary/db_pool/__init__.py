@@ -0,0 +1,289 @@
+'''
+In-process database connection pool, one per worker process and database.
+
+The pooled backends (locallibrary.db_pool.postgresql and locallibrary.db_pool.sqlite3) take their connections
+from a ConnectionPool instead of opening them, and give them back instead of closing them, so a worker that
+closes its connection at the end of every request (CONN_MAX_AGE = 0) reuses the already open ones.
+The pool is configured by the POOL entry of the database settings (see DB_POOL in locallibrary/settings.py):
+    MIN_SIZE: connections kept open even when they are idle
+    MAX_SIZE: connections open at the same time, a checkout waits for one to be returned when they are all in use
+    TIMEOUT: seconds a checkout waits before failing with PoolTimeout
+    MAX_LIFETIME: seconds after which a connection is closed instead of being reused
+    MAX_IDLE: seconds after which an idle connection over MIN_SIZE is closed
+    PRE_PING: check that a connection still works before handing it out
+A returned connection is rolled back and its session is reset by the backend (e.g. RESET ALL on PostgreSQL),
+so the settings a request changed with SET do not leak into the next request that gets the connection.
+'''
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from django.core.exceptions import ImproperlyConfigured
+from django.db.utils import OperationalError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_OPTIONS = {
+    'MIN_SIZE': 1,
+    'MAX_SIZE': 10,
+    'TIMEOUT': 30,
+    'MAX_LIFETIME': 1800,
+    'MAX_IDLE': 600,
+    'PRE_PING': True,
+}
+
+
+#The pooled backend of every database backend that has one
+POOLED_ENGINES = {
+    'django.db.backends.postgresql': 'locallibrary.db_pool.postgresql',
+    'django.db.backends.postgresql_psycopg2': 'locallibrary.db_pool.postgresql',
+    'django.db.backends.sqlite3': 'locallibrary.db_pool.sqlite3',
+}
+
+
+def pooled_engine(engine: str) -> str:
+    '''Returns the pooled version of a database ENGINE'''
+    try:
+        return POOLED_ENGINES[engine]
+    except KeyError:
+        raise ImproperlyConfigured(
+            f'The connection pool (DB_POOL) does not support the {engine} database engine, '
+            f'only {", ".join(sorted(POOLED_ENGINES))}.'
+        ) from None
+
+
+class PoolTimeout(OperationalError):
+    '''Raised when no connection was returned to a full pool within its TIMEOUT'''
+
+
+class ConnectionPool:
+    def __init__(self, min_size: int = 1, max_size: int = 10, timeout: float = 30, max_lifetime: float = 1800,
+                 max_idle: float = 600, pre_ping: bool = True):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.pre_ping = pre_ping
+
+        self._condition = threading.Condition()
+        #(connection, time it was opened, time it was returned), the most recently returned last
+        self._idle: List[Tuple[object, float, float]] = []
+        #Time every checked out connection was opened, by id of the connection
+        self._in_use: Dict[int, float] = {}
+        #Number of open connections, idle, in use or being opened
+        self._size = 0
+
+        self._checkouts = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+        self._opened = 0
+        self._closed = 0
+
+    @classmethod
+    def from_options(cls, options: dict) -> 'ConnectionPool':
+        options = {**DEFAULT_POOL_OPTIONS, **options}
+        return cls(
+            min_size=int(options['MIN_SIZE']),
+            max_size=int(options['MAX_SIZE']),
+            timeout=float(options['TIMEOUT']),
+            max_lifetime=float(options['MAX_LIFETIME']),
+            max_idle=float(options['MAX_IDLE']),
+            pre_ping=bool(options['PRE_PING']),
+        )
+
+    def acquire(self, connect: Callable[[], object]) -> object:
+        '''Returns an idle connection, or a new one opened with connect, waiting for one to be released if the pool is full'''
+        start = time.monotonic()
+        deadline = start + self.timeout
+        while True:
+            with self._condition:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        logger.warning('No database connection was available within %s seconds', self.timeout)
+                        raise PoolTimeout(f'No database connection was available within {self.timeout} seconds')
+                    self._condition.wait(remaining)
+                entry = self._idle.pop() if self._idle else None
+                if entry is None:
+                    self._size += 1
+                waited = time.monotonic() - start
+
+            if entry is None:
+                try:
+                    connection = connect()
+                except BaseException:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+                opened_at = time.monotonic()
+                with self._condition:
+                    self._opened += 1
+            else:
+                connection, opened_at, _ = entry
+                if self._expired(opened_at) or (self.pre_ping and not self._ping(connection)):
+                    self._discard(connection)
+                    continue
+
+            with self._condition:
+                self._in_use[id(connection)] = opened_at
+                self._checkouts += 1
+                self._total_wait += waited
+                self._max_wait = max(self._max_wait, waited)
+            return connection
+
+    def release(self, connection: object, discard: bool = False, reset: Optional[Callable[[object], None]] = None) -> None:
+        '''
+        Returns a connection to the pool, rolling back what it left uncommitted and resetting its session with reset.
+        Broken connections, and the ones that can not be reset, are closed
+        '''
+        with self._condition:
+            opened_at = self._in_use.pop(id(connection), None)
+        if opened_at is None:
+            #Not from this pool (e.g. it was opened before the pool was reset)
+            self._close(connection)
+            return
+
+        if not discard:
+            try:
+                connection.rollback()
+                if reset is not None:
+                    reset(connection)
+            except Exception:
+                discard = True
+        if discard or self._expired(opened_at):
+            self._discard(connection)
+            return
+
+        now = time.monotonic()
+        with self._condition:
+            self._idle.append((connection, opened_at, now))
+            #Close the connections that have been idle for a long time, oldest first, keeping min_size open
+            stale = []
+            while self._size - len(stale) > self.min_size and self._idle and now - self._idle[0][2] > self.max_idle:
+                stale.append(self._idle.pop(0)[0])
+            self._size -= len(stale)
+            self._condition.notify()
+        for stale_connection in stale:
+            self._close(stale_connection)
+
+    def close_all(self) -> None:
+        '''Closes the idle connections, the ones in use are closed when they are released'''
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            #The connections in use are expired so that they are closed when they are released
+            for connection_id in self._in_use:
+                self._in_use[connection_id] = float('-inf')
+            self._condition.notify_all()
+        for connection, _, _ in idle:
+            self._close(connection)
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': len(self._in_use),
+                'max_size': self.max_size,
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'opened': self._opened,
+                'closed': self._closed,
+                'total_wait_ms': round(self._total_wait * 1000, 3),
+                'average_wait_ms': round(self._total_wait * 1000 / self._checkouts, 3) if self._checkouts else 0.0,
+                'max_wait_ms': round(self._max_wait * 1000, 3),
+            }
+
+    def _expired(self, opened_at: float) -> bool:
+        return time.monotonic() - opened_at > self.max_lifetime
+
+    def _ping(self, connection: object) -> bool:
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute('SELECT 1')
+            finally:
+                cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, connection: object) -> None:
+        self._close(connection)
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def _close(self, connection: object) -> None:
+        with self._condition:
+            self._closed += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+_pools: Dict[tuple, ConnectionPool] = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias: str, conn_params: dict, options: dict) -> ConnectionPool:
+    '''Returns the pool of the database, there is one per process and connection parameters (e.g. the test database has its own)'''
+    global _pools_pid
+    key = (alias, repr(sorted(conn_params.items(), key=lambda item: item[0])))
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            #A forked worker does not share the connections of its parent
+            _pools.clear()
+            _pools_pid = os.getpid()
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool.from_options(options)
+        return pool
+
+
+def close_pools(alias: str = None) -> None:
+    '''Closes the idle connections of the pools of a database (of every database when alias is None)'''
+    with _pools_lock:
+        pools = [pool for (pool_alias, _), pool in _pools.items() if alias is None or pool_alias == alias]
+    for pool in pools:
+        pool.close_all()
+
+
+def pool_stats() -> Dict[str, dict]:
+    '''Returns the statistics of the pools of this process by database alias, including the checkout wait times'''
+    with _pools_lock:
+        pools = list(_pools.items())
+    stats = {}
+    for (alias, _), pool in pools:
+        stats.setdefault(alias, []).append(pool.stats())
+    return stats
+
+
+class PooledDatabaseWrapperMixin:
+    '''Takes the connections of a DatabaseWrapper from a ConnectionPool and returns them to it when they are closed'''
+    _pool = None
+
+    def get_new_connection(self, conn_params: dict):
+        self._pool = get_pool(self.alias, conn_params, self.settings_dict.get('POOL') or {})
+        return self._pool.acquire(lambda: super(PooledDatabaseWrapperMixin, self).get_new_connection(conn_params))
+
+    def reset_connection(self, connection) -> None:
+        '''Undoes the changes to the session of a raw connection that outlive its transactions, before it goes back to the pool'''
+
+    def _close(self) -> None:
+        if self.connection is None:
+            return
+        if self._pool is None:
+            super()._close()
+            return
+        #A connection that had errors is only reused if it still works
+        discard = self.errors_occurred and not self.is_usable()
+        with self.wrap_database_errors:
+            self._pool.release(self.connection, discard=discard, reset=self.reset_connection)
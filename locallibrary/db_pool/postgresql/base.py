@@ -0,0 +1,28 @@
+'''PostgreSQL backend whose connections come from a ConnectionPool'''
+from django.db.backends.postgresql import base, creation
+from locallibrary.db_pool import PooledDatabaseWrapperMixin, close_pools
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity):
+        #The test database can not be dropped while the pool keeps connections to it open
+        close_pools(self.connection.alias)
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    def get_new_connection(self, conn_params):
+        connection = super().get_new_connection(conn_params)
+        #Only set by the postgresql backend when it opens a connection, not when the connection comes from the pool
+        self.isolation_level = self.settings_dict['OPTIONS'].get('isolation_level', connection.isolation_level)
+        return connection
+
+    def reset_connection(self, connection):
+        #Settings changed with SET (e.g. the time zone or statement_timeout) last for the whole session. SET LOCAL
+        #ones were already undone by the rollback. init_connection_state sets the time zone of Django again on checkout
+        with connection.cursor() as cursor:
+            cursor.execute('RESET ALL')
+        if not connection.autocommit:
+            connection.commit()
@@ -0,0 +1,7 @@
+'''SQLite backend whose connections come from a ConnectionPool, used to run the pool without a PostgreSQL server'''
+from django.db.backends.sqlite3 import base
+from locallibrary.db_pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    pass
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 import os # needed by code below
 from pathlib import Path
 import dj_database_url
+from locallibrary.db_pool import pooled_engine
 from datetime import timedelta
 from locallibrary.jwt_settings import (
     ACCESS_TOKEN_REFRESH_TIME,
@@ -146,11 +147,29 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 LOGIN_REDIRECT_URL = '/'
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+#Sender of the overdue notices (python manage.py send_overdue_notices)
+DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', 'library@localhost')
 
 # Heroku: Update database configuration from $DATABASE_URL.
 db_from_env = dj_database_url.config(conn_max_age=500)
 DATABASES['default'].update(db_from_env)
 
+# Set DB_POOL=1 to take the connections of every worker from an in-process pool (see locallibrary/db_pool)
+# instead of keeping one persistent connection per worker thread
+if os.environ.get('DB_POOL', '').lower() in ('1', 'true', 'yes'):
+    # Raises ImproperlyConfigured for the database engines that have no pooled backend
+    DATABASES['default']['ENGINE'] = pooled_engine(DATABASES['default']['ENGINE'])
+    # Connections go back to the pool at the end of every request
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['POOL'] = {
+        'MIN_SIZE': int(os.environ.get('DB_POOL_MIN_SIZE', 1)),
+        'MAX_SIZE': int(os.environ.get('DB_POOL_MAX_SIZE', 10)),
+        'TIMEOUT': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'MAX_LIFETIME': float(os.environ.get('DB_POOL_MAX_LIFETIME', 1800)),
+        'MAX_IDLE': float(os.environ.get('DB_POOL_MAX_IDLE', 600)),
+        'PRE_PING': os.environ.get('DB_POOL_PRE_PING', '1').lower() in ('1', 'true', 'yes'),
+    }
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/3.1/howto/static-files/
 
@@ -175,11 +194,54 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.DjangoModelPermissionsOrAnonReadOnly',
     ],
+    #JWTAuthentication that keeps the decoded token and user on the request so permissions can reuse them
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
-    )
+        'catalog.authentication.PrincipalJWTAuthentication',
+    ),
+    #List endpoints return one page at a time using cursor pagination (see catalog/pagination.py)
+    'DEFAULT_PAGINATION_CLASS': 'catalog.pagination.CatalogCursorPagination',
+    'PAGE_SIZE': int(os.environ.get('API_PAGE_SIZE', 50)),
+    #JSON is encoded and decoded with orjson when it is installed (see catalog/renderers.py)
+    'DEFAULT_RENDERER_CLASSES': (
+        'catalog.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'catalog.parsers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
 }
 
+#Number of rows the catalog export endpoints read from the database at a time (see catalog/export.py)
+EXPORT_CHUNK_SIZE = 2000
+
+#Maximum number of books accepted by a single request to the bulk book api (see catalog/bulk.py)
+BULK_MAX_ROWS = 10000
+
+#Seconds a return or renewal waits for the lock of its copy before failing, on PostgreSQL (see catalog/loans.py)
+LOAN_LOCK_TIMEOUT = 5
+#Lock waits of the loan operations longer than this many milliseconds are logged
+LOAN_SLOW_LOCK_WAIT_MS = 200
+
+#Alias from CACHES of the cache used for the versions and the responses of the read-only catalog api endpoints,
+#the cached counts and the HTML fragments (see catalog/caching.py). It must be a cache shared by all the worker
+#processes (e.g. memcached or redis): a cache local to each process would keep serving data changed by another one.
+#Nothing is cached when it is not set
+API_CACHE_ALIAS = os.environ.get('API_CACHE_ALIAS') or None
+#Seconds a list or detail response is kept in the cache
+API_CACHE_TIMEOUT = 300
+#Seconds a fragment of an HTML page is kept in the cache, the fragments are also invalidated when the catalog changes
+FRAGMENT_CACHE_TIMEOUT = 300
+
+#The home page counts are cached for a few seconds (see catalog/summary.py), 0 reads them from the database every time
+#Set CATALOG_SUMMARY_CACHE_ALIAS to an alias from CACHES to use another cache than API_CACHE_ALIAS, which has to be set too
+CATALOG_SUMMARY_CACHE_ALIAS = os.environ.get('CATALOG_SUMMARY_CACHE_ALIAS') or None
+CATALOG_SUMMARY_CACHE_TIMEOUT = 5
+
+#Text search configuration used by the PostgreSQL full-text index of books (see catalog/search.py)
+SEARCH_TEXT_CONFIG = 'english'
+
 #these are the settings for the jwt's we will be using for authentication
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': ACCESS_TOKEN_REFRESH_TIME,
@@ -210,6 +272,16 @@ SIMPLE_JWT = {
     'SLIDING_TOKEN_REFRESH_LIFETIME': SLIDING_TOKEN_REFRESH_LIFETIME,
 }
 
+#Membership of the Librarians group is cached per user (see catalog/roles.py) in a cache shared by the worker processes
+#Set LIBRARIAN_CACHE_ALIAS to an alias from CACHES to use another cache than API_CACHE_ALIAS, nothing is cached when neither is set
+LIBRARIAN_CACHE_ALIAS = os.environ.get('LIBRARIAN_CACHE_ALIAS') or None
+#Seconds a membership is kept, the entries are also invalidated when the membership changes
+LIBRARIAN_CACHE_TIMEOUT = 300
+
+#With a shared API_CACHE_ALIAS, blacklisted refresh tokens are kept in memory by every worker process (see catalog/blacklist.py)
+#Seconds after which a worker reloads them even if no token was blacklisted, e.g. to forget tokens removed in the admin
+BLACKLIST_CACHE_TIMEOUT = 60
+
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",
     "http://127.0.0.1:3000",